@@ -43,7 +43,10 @@ setup(
             'Flask>=0.9',
         ],
         'sanic': [
-            'sanic>=0.4',
+            'sanic>=18.12,<21.3',
+        ],
+        'brotli': [
+            'brotli',
         ],
         'dev': [
             'aiohttp',
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+This provide a bare ASGI application for serving a provider, such that
+it may be deployed under any ASGI server (e.g. uvicorn with a number of
+worker processes) without the routing of a framework.
+
+Example usage:
+
+>>> from nunja.serve import asgi
+>>> application = asgi.RJSProvider('/nunja/')()
+
+Requests outside of the base_url of the provider may be passed on to
+another ASGI application:
+
+>>> application = asgi.RJSProvider('/nunja/')(other_application)
+
+The responses are produced in an executor as they may involve the
+reading of files or rendering, and the files are sent by the server
+through either of the path send or zero copy send extensions where
+supported.
+
+Requires Python 3.5+
+"""
+
+import asyncio
+
+from nunja.serve import rjs
+from nunja.serve.base import not_found
+from nunja.serve.base import open_body_file
+from nunja.serve.base import respond_nunja
+from nunja.serve.base import to_bytes
+from nunja.serve.watch import EVENTS_HEADERS
+from nunja.serve.watch import EVENTS_SUBPATH
+from nunja.serve.watch import EventsForwarder
+
+PATHSEND = 'http.response.pathsend'
+ZEROCOPYSEND = 'http.response.zerocopysend'
+
+
+def encode_headers(headers):
+    return [
+        (key.lower().encode('latin-1'), value.encode('latin-1'))
+        for key, value in sorted(headers.items())
+    ]
+
+
+def request_headers(scope):
+    """
+    Return the dict of the request headers from the scope, with the
+    names in the same form as they would have been sent.
+    """
+
+    headers = {}
+    for key, value in scope.get('headers', ()):
+        key = key.decode('latin-1').title()
+        value = value.decode('latin-1')
+        headers[key] = headers[key] + ', ' + value if key in headers else value
+    return headers
+
+
+async def request_body(receive):  # noqa: E999
+    """
+    Return the body of the request, or None if the client disconnected
+    before it was received.
+    """
+
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+class Application(object):
+    """
+    The ASGI application for the provider.
+    """
+
+    def __init__(self, provider, app=None, executor=None):
+        """
+        Arguments
+
+        provider
+            The provider to serve.
+        app
+            The ASGI application for the requests outside of the
+            base_url of the provider; if not provided, they will be
+            answered with a 404.  The lifespan events are also passed
+            on to it.
+        executor
+            The executor for producing the responses; defaults to the
+            default executor of the loop.
+        """
+
+        self.provider = provider
+        self.app = app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            identifier = self.provider.to_identifier(scope['path'])
+            if identifier is not None or self.app is None:
+                await self.handle(identifier, scope, receive, send)
+                return
+        elif scope['type'] == 'lifespan' and self.app is None:
+            await self.lifespan(receive, send)
+            return
+        if self.app is not None:
+            await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """
+        Release the resources held by the provider as the server shuts
+        down.
+        """
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if getattr(self.provider, 'watcher', None) is not None:
+                    self.provider.watcher.stop()
+                if self.provider.renderer is not None:
+                    self.provider.renderer.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, identifier, scope, receive, send):
+        method = scope['method']
+        if method not in ('GET', 'HEAD', 'POST'):
+            await send({
+                'type': 'http.response.start',
+                'status': 405,
+                'headers': encode_headers({
+                    'Allow': 'GET, HEAD, POST', 'Content-Length': '0'}),
+            })
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        loop = asyncio.get_event_loop()
+        watcher = getattr(self.provider, 'watcher', None)
+        if watcher is not None and identifier == EVENTS_SUBPATH:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': encode_headers(EVENTS_HEADERS),
+            })
+            if method == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b''})
+            else:
+                await self.send_events(receive, send, watcher)
+            return
+
+        if identifier is None:
+            response = not_found()
+        else:
+            body = None
+            if method == 'POST':
+                body = await request_body(receive)
+                if body is None:
+                    return
+            query = scope.get('query_string', b'').decode('latin-1')
+            response = await loop.run_in_executor(
+                self.executor, respond_nunja, self.provider,
+                scope['path'] + ('?' + query if query else ''),
+                request_headers(scope), body)
+        await self.send(scope, send, response)
+
+    async def send(self, scope, send, response):
+        """
+        Send the response, with its body as appropriate for the request.
+        """
+
+        extensions = scope.get('extensions') or {}
+        start = {
+            'type': 'http.response.start',
+            'status': response.status,
+        }
+
+        if scope['method'] == 'HEAD':
+            if response.chunks is not None:
+                response.chunks.close()
+            start['headers'] = encode_headers(response.headers)
+            await send(start)
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if response.chunks is not None:
+            start['headers'] = encode_headers(response.headers)
+            await send(start)
+            await self.send_chunks(send, response.chunks)
+            return
+
+        source = None
+        if PATHSEND in extensions or ZEROCOPYSEND in extensions:
+            # the file is only sent while it is still the one that the
+            # validators were produced from.
+            source = open_body_file(response)
+        if source is not None:
+            with source:
+                start['headers'] = encode_headers(response.headers)
+                await send(start)
+                if ZEROCOPYSEND in extensions:
+                    # the very file that was checked.
+                    await send({'type': ZEROCOPYSEND, 'file': source})
+                else:
+                    await send({'type': PATHSEND, 'path': response.path})
+            return
+
+        start['headers'] = encode_headers(response.headers)
+        await send(start)
+        await send({
+            'type': 'http.response.body', 'body': to_bytes(response.body)})
+
+    async def send_chunks(self, send, chunks):
+        """
+        Send the chunks as they are produced by the executor.
+        """
+
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(
+                    self.executor, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+        finally:
+            try:
+                chunks.close()
+            except ValueError:
+                # still being run by the executor, and will be closed
+                # once collected.
+                pass
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def send_events(self, receive, send, watcher):
+        """
+        Send the events from the watcher until either the client or the
+        watcher is gone.  Waiting on the events blocks, so that is done
+        by a thread of its own for every stream rather than the executor,
+        such that the streams do not starve the other requests.  As the
+        sending to a client that is gone may not fail, the stream is
+        stopped once receive gives the disconnect.
+        """
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        disconnected = []
+
+        async def wait_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.append(True)
+            queue.put_nowait(None)
+
+        def callback(chunk):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            except RuntimeError:
+                # the loop is closed.
+                pass
+
+        forwarder = EventsForwarder(watcher, callback)
+        forwarder.start()
+        listener = asyncio.ensure_future(wait_disconnect())
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True,
+                })
+        finally:
+            forwarder.stop()
+            listener.cancel()
+            await asyncio.wait([listener])
+        if not disconnected:
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+class ASGIMixin(object):
+    """
+    The base mixin for combining with a provider implementation.
+    """
+
+    def __call__(self, app=None):
+        return Application(self, app)
+
+
+class RJSProvider(ASGIMixin, rjs.Provider):
+    """
+    Using the RJS version for serving base library stuff.
+
+    Example usage:
+
+    >>> from nunja.serve import asgi
+    >>> application = asgi.RJSProvider('/nunja/')()
+
+    Then serve it with an ASGI server, e.g.
+
+        $ uvicorn --workers 4 module:application
+    """
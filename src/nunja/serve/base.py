@@ -4,8 +4,46 @@ Module for providing base classes.
 """
 
 import codecs
+import json
+import logging
+import mimetypes
+from os import fstat
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from timeit import default_timer
 
 from nunja.registry import ENTRY_POINT_NAME
+from nunja.serve.cache import Content
+from nunja.serve.cache import ContentCache
+from nunja.serve.cache import RenderCache
+from nunja.serve.cache import load
+from nunja.serve.compress import compressors
+from nunja.serve.compress import default_encodings
+from nunja.serve.compress import negotiate
+from nunja.serve.compat import parse_qs
+from nunja.serve.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from nunja.serve.metrics import Metrics
+from nunja.serve.metrics import null_timer
+from nunja.serve.render import CONTENT_TYPE as RENDER_CONTENT_TYPE
+from nunja.serve.render import RENDER_PREFIX
+from nunja.serve.render import STREAM_PREFIX
+from nunja.serve.render import Renderer
+from nunja.serve.render import data_digest
+from nunja.serve.render import parse_data
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = b'404 NOT FOUND'
+INTERNAL_SERVER_ERROR = b'500 INTERNAL SERVER ERROR'
+
+# the subpath for the batch requests.
+BATCH_SUBPATH = '_batch'
+# the subpath for the metrics, if enabled.
+METRICS_SUBPATH = '_metrics'
+
+_batch_pool_lock = Lock()
 
 
 def fetch(path):
@@ -13,6 +51,212 @@ def fetch(path):
         return f.read()
 
 
+def guess_type(identifier):
+    return mimetypes.guess_type(identifier)[0] or 'text/plain'
+
+
+def normalize(subpath):
+    """
+    Normalize the subpath into an identifier by removing extra '/'s.
+    """
+
+    return '/'.join(i for i in subpath.split('/') if i)
+
+
+def is_not_modified(headers, etag, mtime):
+    """
+    Check the conditional request headers against the validators of
+    some content.  If-None-Match takes precedence over If-Modified-Since
+    as per RFC 7232.
+    """
+
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        # a weak comparison is used for GET and HEAD.
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        return '*' in tags or etag in [
+            t[2:] if t.startswith('W/') else t for t in tags]
+
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        since = parsedate_tz(if_modified_since)
+        if since is None:
+            return False
+        return int(mtime) <= mktime_tz(since)
+
+    return False
+
+
+class Response(object):
+    """
+    A response produced by a provider, for the serving implementations
+    to translate into their native response objects.
+    """
+
+    def __init__(
+            self, status, headers, body=b'', path=None, chunks=None,
+            key=None):
+        """
+        Arguments
+
+        status
+            The HTTP status code.
+        headers
+            A dict of the HTTP response headers.
+        body
+            The body of the response as bytes.
+        path
+            The path to the file with the same contents as the body, for
+            implementations that may send the file directly.
+        chunks
+            An iterator of the body as chunks of bytes, to be sent as
+            they are produced in place of the body, for the responses
+            with no known length.
+        key
+            The stat_key of the file at path at the time the body was
+            read, which the validators of the response were derived
+            from.
+        """
+
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.path = path
+        self.chunks = chunks
+        self.key = key
+
+
+def open_body_file(response):
+    """
+    Return the file at the path of the response opened for sending in
+    place of the body, or None if the body has to be sent instead, i.e.
+    the response is not backed by a file, or the file is no longer the
+    one the body and the validators of the response were produced from.
+    """
+
+    if response.status != 200 or not response.path or response.key is None:
+        return None
+    try:
+        source = open(response.path, 'rb')
+    except (IOError, OSError):
+        return None
+    st = fstat(source.fileno())
+    if (st.st_mtime, st.st_size, st.st_ino) != tuple(response.key):
+        source.close()
+        return None
+    return source
+
+
+def to_bytes(data):
+    """
+    Return the body of a response as bytes, for the implementations that
+    require them; the body may be a memoryview into a shared store.
+    """
+
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+
+def parse_batch(query='', body=None, limit=None):
+    """
+    Return the list of identifiers for a batch request, which are the
+    values for 'id' in the query string, followed by the ones from the
+    body if it is provided as a JSON encoded list.
+
+    A ValueError will be raised if the body cannot be parsed, or if
+    there are more identifiers than the limit.
+    """
+
+    identifiers = parse_qs(query).get('id', [])
+    if body:
+        if not isinstance(body, str):
+            body = body.decode('utf8')
+        extra = json.loads(body)
+        if not isinstance(extra, list):
+            raise ValueError('body must be a list of identifiers')
+        identifiers.extend(str(i) for i in extra)
+    if limit is not None and len(identifiers) > limit:
+        raise ValueError('at most %d identifiers may be requested' % limit)
+    return identifiers
+
+
+def guard_chunks(chunks, mold_id):
+    """
+    Yield from the chunks of the streamed rendering of the mold, ending
+    early if the rendering failed, as the response has been started.
+    """
+
+    try:
+        for chunk in chunks:
+            yield chunk
+    except Exception:
+        logger.exception("failed to stream mold '%s'", mold_id)
+
+
+def bad_request(reason):
+    body = ('400 BAD REQUEST: %s' % reason).encode('utf8')
+    return Response(400, {
+        'Content-Type': 'text/plain',
+        'Content-Length': str(len(body)),
+    }, body)
+
+
+def not_found():
+    return Response(404, {
+        'Content-Type': 'text/plain',
+        'Content-Length': str(len(NOT_FOUND)),
+    }, NOT_FOUND)
+
+
+def server_error():
+    return Response(500, {
+        'Content-Type': 'text/plain',
+        'Content-Length': str(len(INTERNAL_SERVER_ERROR)),
+    }, INTERNAL_SERVER_ERROR)
+
+
+def respond_nunja(provider, path, headers, body=None):
+    """
+    Produce the response from the provider for the request path, which
+    is either a batch request, a request for rendering a mold (streamed
+    or not), or a request for an object.  Only batch and rendering
+    requests may have a body.
+    """
+
+    path, _, query = path.partition('?')
+    identifier = provider.to_identifier(path)
+    if identifier is not None and identifier.startswith(RENDER_PREFIX):
+        return provider.respond_render(
+            identifier[len(RENDER_PREFIX):], body, headers)
+    if identifier is not None and identifier.startswith(STREAM_PREFIX):
+        return provider.respond_render_stream(
+            identifier[len(STREAM_PREFIX):], body, headers)
+    if identifier == BATCH_SUBPATH:
+        try:
+            identifiers = parse_batch(query, body, provider.batch_limit)
+        except ValueError as e:
+            return bad_request(str(e))
+        return provider.respond_batch(identifiers, headers)
+    if identifier is None or body is not None:
+        return not_found()
+    if identifier == METRICS_SUBPATH:
+        return provider.respond_metrics()
+    return provider.respond(identifier, headers)
+
+
+def _overrides(provider, name):
+    """
+    Return True if the method of the name is overridden from the one
+    provided by BaseProvider by the class of the provider.
+    """
+
+    method = getattr(type(provider), name)
+    base = getattr(BaseProvider, name)
+    return getattr(method, '__func__', method) is not getattr(
+        base, '__func__', base)
+
+
 class BaseProvider(object):
     """
     Base script provider implementation
@@ -23,9 +267,17 @@ class BaseProvider(object):
     implementation support the cases for multiple registries.
     """
 
+    # the maximum number of identifiers for a batch request.
+    batch_limit = 256
+    # the number of threads for fetching the items of a batch.
+    batch_workers = 4
+    _batch_pool = None
+
     def __init__(
             self, base_url, core_subpaths=(),
-            registry_names=(ENTRY_POINT_NAME,)):
+            registry_names=(ENTRY_POINT_NAME,), cache=True,
+            encodings=default_encodings, precompressed=False, metrics=None,
+            renderer=None, render_cache=None, offload=None):
         """
         Arguments
 
@@ -42,11 +294,69 @@ class BaseProvider(object):
             scripts that will initialise the front-end system.
         registry_names
             The nunja registries to load.
+        cache
+            The ContentCache for the objects read by fetch_object.  If
+            True, a default instance will be created; if False, file
+            contents will be read from the filesystem for every fetch.
+        encodings
+            The content codings (e.g. 'gzip', 'br') that responses may
+            be compressed with, in the order of preference; codings
+            without an available compressor are ignored.
+        precompressed
+            If True, use the precompressed siblings of files (i.e. the
+            files with the '.gz' or '.br' suffix) where available.
+        metrics
+            The Metrics to record the requests and the durations of the
+            phases of producing the responses with.  If True, a default
+            instance will be created.  The metrics are served at the
+            METRICS_SUBPATH under the base_url when provided.
+        renderer
+            The BaseRenderer (e.g. a Renderer, or a ProcessPoolRenderer
+            to render across multiple processes) for the molds rendered
+            at the RENDER_PREFIX subpath (i.e. '_render/<mold_id>').  If
+            True, a default Renderer for the first of the registry_names
+            will be created.  Rendering is not served if not provided.
+        render_cache
+            The RenderCache for the rendered molds, keyed by the mold
+            id, its version and the digest of the data.  If True, a
+            default instance will be created; if not provided, molds
+            are rendered for every request.
+        offload
+            The Offload for delivering the files resolved by fetch_path
+            through the front proxy, such that the responses for them
+            only carry the header for the proxy in place of the body.
+            Files are served as normal if not provided.
         """
 
         self.base_url = base_url
         self.core_subpaths = set(core_subpaths)
         self.registry_names = registry_names
+        if cache is True:
+            cache = ContentCache()
+        elif cache is False:
+            cache = None
+        self.cache = cache
+        self.encodings = tuple(c for c in encodings if c in compressors)
+        self.precompressed = precompressed
+        if metrics is True:
+            metrics = Metrics()
+        elif metrics is False:
+            metrics = None
+        self.metrics = metrics
+        if renderer is True:
+            renderer = Renderer(registry_names[0])
+        elif renderer is False:
+            renderer = None
+        self.renderer = renderer
+        if render_cache is True:
+            render_cache = RenderCache()
+        elif render_cache is False:
+            render_cache = None
+        self.render_cache = render_cache
+        self.offload = offload
+        # the Content for each of the core subpaths, such that the
+        # validators and variants are only produced once per version.
+        self._core_contents = {}
 
     def fetch_core(self, identifier):
         """
@@ -62,18 +372,60 @@ class BaseProvider(object):
 
         raise NotImplementedError
 
+    def fetch_content(self, identifier):
+        """
+        Return the Content identified by the identifier, which provides
+        the encoded form and the validators for responses.
+
+        The default implementation simply relies on the fetch_path
+        method to acquire the filesystem path for objects and load the
+        file at that location, through the cache if one is available.
+        For the providers that do not implement fetch_path but provide
+        their own fetch_object, the contents returned by the latter are
+        encoded instead.
+        """
+
+        if identifier in self.core_subpaths:
+            return self.fetch_core_content(identifier)
+
+        try:
+            with self.timing('resolve'):
+                path = self.fetch_path(identifier)
+        except NotImplementedError:
+            if not _overrides(self, 'fetch_object'):
+                raise
+            return Content(self.fetch_object(identifier).encode('utf8'))
+        try:
+            with self.timing('read'):
+                if self.cache is None:
+                    return load(path)
+                return self.cache.get(path)
+        except (IOError, OSError):
+            # the path may be gone since it was resolved.
+            raise KeyError("'%s' could not be read" % identifier)
+
+    def fetch_core_content(self, identifier):
+        """
+        Return the Content for the core subpath, which is kept for as
+        long as fetch_core produces the same contents for it.
+        """
+
+        data = self.fetch_core(identifier).encode('utf8')
+        content = self._core_contents.get(identifier)
+        if content is None or content.data != data:
+            content = self._core_contents[identifier] = Content(data)
+        return content
+
     def fetch_object(self, identifier):
         """
         Serve an object identified by the identifier; typically objects
         are the templates and/or the script files provided by the mold.
 
-        The default implementation simply relies on the fetch_path
-        method to acquire the filesystem path, and then call a function
-        that simply return the contents at that location as a string.
+        The default implementation return the decoded contents from
+        fetch_content.
         """
 
-        path = self.fetch_path(identifier)
-        return fetch(path)
+        return self.fetch_content(identifier).text
 
     def fetch(self, path):
         """
@@ -90,17 +442,350 @@ class BaseProvider(object):
         own resolution techniques.
         """
 
-        if not path.startswith(self.base_url):
+        with self.timing('normalize'):
+            identifier = self.to_identifier(path)
+        if identifier is None:
             return None
 
-        # normalize identifier by removing extra '/'s
-        identifier = '/'.join(
-            i for i in path[len(self.base_url):].split('/') if i)
-
         if identifier in self.core_subpaths:
             return self.fetch_core(identifier)
         return self.fetch_object(identifier)
 
+    def to_identifier(self, path):
+        """
+        Return the normalized identifier for the path, or None if the
+        path is not matched by the base_url of this instance.
+        """
+
+        if not path.startswith(self.base_url):
+            return None
+        return normalize(path[len(self.base_url):])
+
+    def respond(self, identifier, headers={}):
+        """
+        Produce a Response for the identifier, in the way that should
+        be done by all serving implementations.
+
+        The request headers are required for conditional requests, such
+        that a response with a 304 status will be produced without the
+        body if the client have a fresh copy as indicated by either the
+        If-None-Match or If-Modified-Since header.
+        """
+
+        start = default_timer()
+        with self.timing('normalize'):
+            identifier = normalize(identifier)
+        if self.offload is not None:
+            response = self.respond_offload(identifier)
+            if response is not None:
+                return self.record(response, start)
+        try:
+            content = self.fetch_content(identifier)
+        except KeyError:
+            return self.record(not_found(), start)
+        response = self.respond_content(
+            content, guess_type(identifier), headers)
+        cache_control = self.cache_control(identifier)
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        return self.record(response, start)
+
+    def timing(self, phase):
+        """
+        Return a context manager that time the phase of producing a
+        response, which does nothing if metrics are not enabled.  The
+        phases timed by the provider are 'normalize', 'resolve', 'read',
+        'encode' and 'render'.
+        """
+
+        if self.metrics is None:
+            return null_timer
+        return self.metrics.timer(phase)
+
+    def record(self, response, start):
+        """
+        Record the response that took since start to produce with the
+        metrics, if enabled.  Return the response.
+        """
+
+        if self.metrics is not None:
+            metrics = self.metrics
+            metrics.observe('nunja_request_seconds', default_timer() - start)
+            metrics.increment(
+                'nunja_requests_total', labels=(
+                    ('status', response.status),))
+            metrics.increment('nunja_response_bytes_total', len(
+                response.body))
+        return response
+
+    def respond_metrics(self):
+        """
+        Produce a Response with the metrics in the text exposition format,
+        or a 404 if metrics are not enabled.
+        """
+
+        if self.metrics is None:
+            return not_found()
+        extra = []
+        if self.cache is not None:
+            stats = self.cache.stats()
+            extra = [
+                ('nunja_cache_hits_total', 'counter',
+                    'Lookups served from the content cache.', stats['hits']),
+                ('nunja_cache_misses_total', 'counter',
+                    'Lookups that had to read the file.', stats['misses']),
+                ('nunja_cache_evictions_total', 'counter',
+                    'Contents evicted from the content cache.',
+                    stats['evictions']),
+                ('nunja_cache_entries', 'gauge',
+                    'Contents in the content cache.', stats['entries']),
+                ('nunja_cache_bytes', 'gauge',
+                    'Bytes held by the content cache.', stats['bytes']),
+            ]
+        if self.render_cache is not None:
+            stats = self.render_cache.stats()
+            extra.extend([
+                ('nunja_render_cache_hits_total', 'counter',
+                    'Renders served from the render cache.', stats['hits']),
+                ('nunja_render_cache_misses_total', 'counter',
+                    'Renders that had to be produced.', stats['misses']),
+                ('nunja_render_cache_coalesced_total', 'counter',
+                    'Renders that waited on an identical one in progress.',
+                    stats['coalesced']),
+                ('nunja_render_cache_entries', 'gauge',
+                    'Renders in the render cache.', stats['entries']),
+                ('nunja_render_cache_bytes', 'gauge',
+                    'Bytes held by the render cache.', stats['bytes']),
+            ])
+        body = self.metrics.render(extra).encode('utf8')
+        return Response(200, {
+            'Content-Type': METRICS_CONTENT_TYPE,
+            'Content-Length': str(len(body)),
+            'Cache-Control': 'no-store',
+        }, body)
+
+    def respond_render(self, mold_id, body=None, headers={}):
+        """
+        Produce a Response with the HTML rendered from the mold with the
+        data from the JSON encoded body, or a 404 if the mold is not
+        found or rendering is not enabled.
+        """
+
+        start = default_timer()
+        if self.renderer is None:
+            return self.record(not_found(), start)
+        try:
+            data = parse_data(body)
+        except ValueError as e:
+            return self.record(bad_request(str(e)), start)
+
+        mold_id = normalize(mold_id)
+        try:
+            content = self.render(mold_id, data)
+        except KeyError:
+            return self.record(not_found(), start)
+        except Exception:
+            logger.exception("failed to render mold '%s'", mold_id)
+            return self.record(server_error(), start)
+        return self.record(self.respond_content(
+            content, RENDER_CONTENT_TYPE, headers), start)
+
+    def respond_render_stream(self, mold_id, body=None, headers={}):
+        """
+        Produce a Response with the chunks of the HTML rendered from the
+        mold with the data from the JSON encoded body, such that large
+        renderings are sent as they are produced, or a 404 if the mold
+        is not found or rendering is not enabled.
+        """
+
+        start = default_timer()
+        if self.renderer is None:
+            return self.record(not_found(), start)
+        try:
+            data = parse_data(body)
+        except ValueError as e:
+            return self.record(bad_request(str(e)), start)
+
+        mold_id = normalize(mold_id)
+        try:
+            chunks = self.renderer.stream(mold_id, data)
+        except KeyError:
+            return self.record(not_found(), start)
+        except Exception:
+            logger.exception("failed to render mold '%s'", mold_id)
+            return self.record(server_error(), start)
+        return self.record(Response(200, {
+            'Content-Type': RENDER_CONTENT_TYPE,
+        }, chunks=guard_chunks(chunks, mold_id)), start)
+
+    def render(self, mold_id, data):
+        """
+        Return the Content of the mold rendered with the data, through
+        the render_cache if one is available.
+        """
+
+        def produce():
+            with self.timing('render'):
+                html = self.renderer.execute(mold_id, data)
+            return Content(html.encode('utf8'))
+
+        if self.render_cache is None:
+            return produce()
+        key = (mold_id, self.renderer.version(mold_id), data_digest(data))
+        return self.render_cache.get(key, produce)
+
+    def respond_offload(self, identifier):
+        """
+        Produce the Response that offload the file for the identifier to
+        the front proxy, or None if it is not to be offloaded (e.g. for
+        the core subpaths, or for identifiers that could not be resolved
+        to files), such that it will be served as normal.
+
+        The file is not read, and neither the conditional requests nor
+        the compression are handled, as they are left to the proxy.
+        """
+
+        if identifier in self.core_subpaths:
+            return None
+        try:
+            with self.timing('resolve'):
+                path = self.fetch_path(identifier)
+        except (KeyError, NotImplementedError):
+            return None
+        target = self.offload.target(path)
+        if target is None:
+            return None
+        response_headers = {
+            'Content-Type': guess_type(identifier),
+            'Content-Length': '0',
+            self.offload.header: target,
+        }
+        cache_control = self.cache_control(identifier)
+        if cache_control:
+            response_headers['Cache-Control'] = cache_control
+        return Response(200, response_headers)
+
+    def cache_control(self, identifier):
+        """
+        Return the value for the Cache-Control header for the object at
+        identifier, if any.  The default implementation return None.
+        """
+
+        return None
+
+    def respond_content(self, content, content_type, headers={}):
+        """
+        Produce a Response for the content, which may be compressed,
+        or be a 304 response if the request was conditional and the
+        client have a fresh copy.
+        """
+
+        body = content.data
+        path = content.path
+        response_headers = {
+            'Content-Type': content_type,
+            'ETag': content.etag,
+            'Last-Modified': content.last_modified,
+        }
+
+        coding = None
+        if self.encodings:
+            response_headers['Vary'] = 'Accept-Encoding'
+            coding = negotiate(
+                headers.get('Accept-Encoding'), self.encodings)
+
+        # skipped if the content is already known to be not worth it.
+        if coding and content.variants.get(coding, True) is not None:
+            encoded_headers = dict(response_headers)
+            encoded_headers['Content-Encoding'] = coding
+            # each representation need its own strong etag.
+            encoded_headers['ETag'] = '%s-%s"' % (content.etag[:-1], coding)
+            # checked before encoding, such that the content is not
+            # encoded only for a 304 response.
+            if is_not_modified(
+                    headers, encoded_headers['ETag'], content.mtime):
+                return Response(304, encoded_headers)
+            with self.timing('encode'):
+                encoded = self.encode(content, coding)
+            if encoded:
+                body = encoded
+                path = None
+                response_headers = encoded_headers
+
+        if is_not_modified(
+                headers, response_headers['ETag'], content.mtime):
+            return Response(304, response_headers)
+
+        response_headers['Content-Length'] = str(len(body))
+        return Response(200, response_headers, body, path, key=content.key)
+
+    def fetch_batch(self, identifiers):
+        """
+        Return a dict that map each of the identifiers to a dict with
+        either the decoded contents under 'content', or the reason for
+        the failure under 'error'.  The identifiers are fetched with
+        the map function from batch_map.
+        """
+
+        return dict(self.batch_map()(self._fetch_batch_item, identifiers))
+
+    def _fetch_batch_item(self, identifier):
+        try:
+            return identifier, {
+                'content': self.fetch_content(normalize(identifier)).text}
+        except KeyError:
+            return identifier, {'error': 'not found'}
+        except ValueError:
+            # UnicodeDecodeError, as the content is not text.
+            return identifier, {'error': 'not text'}
+
+    def batch_map(self):
+        """
+        Return the map function for the fetching of batches, such that
+        the items are fetched concurrently by a pool of threads of the
+        size specified by the batch_workers attribute.
+        """
+
+        if self.batch_workers < 2:
+            return map
+        with _batch_pool_lock:
+            if self._batch_pool is None:
+                self._batch_pool = ThreadPool(self.batch_workers)
+        return self._batch_pool.map
+
+    def respond_batch(self, identifiers, headers={}):
+        """
+        Produce a Response with the JSON encoded result of fetch_batch
+        for the identifiers.
+        """
+
+        start = default_timer()
+        return self.record(self.respond_results(
+            self.fetch_batch(identifiers), headers), start)
+
+    def respond_results(self, results, headers={}):
+        """
+        Produce a Response with the JSON encoded results of a batch.
+        """
+
+        body = json.dumps(results, sort_keys=True).encode('utf8')
+        return self.respond_content(
+            Content(body), 'application/json', headers)
+
+    def encode(self, content, coding):
+        """
+        Return the variant of the content for the coding, or None if
+        the content should be sent as is.
+        """
+
+        produced = coding not in content.variants
+        result = content.variant(coding, self.precompressed)
+        if produced:
+            for cache in (self.cache, self.render_cache):
+                if cache is not None:
+                    cache.update(content)
+        return result
+
     def yield_core_paths(self):
         """
         Return a generator that will list out all the core paths
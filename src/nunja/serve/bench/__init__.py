@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the serving adapters.
+
+A synthetic mold registry is built in a temporary directory, and each
+of the selected adapters is started locally and driven by a concurrent
+client for each category of requests.  The requests per second, the
+latency percentiles and the bytes transferred are reported as JSON, so
+that the results may be compared between releases.
+
+Invoke with ``python -m nunja.serve.bench``.
+"""
+
+import json
+import logging
+import platform
+import shutil
+import tempfile
+from functools import partial
+
+from calmjs.registry import _inst as default_registry
+
+from nunja.serve.bench.client import Client
+from nunja.serve.bench.servers import adapters
+from nunja.serve.testing import generate_mold_packages
+from nunja.serve.testing import make_generated_mold_registry
+from nunja.serve.testing import package_names
+from nunja.serve.testing import remove_generated_packages
+
+REGISTRY_NAME = 'nunja.bench.mold'
+PACKAGE_PREFIX = 'nunja_bench'
+PACKAGES = package_names(PACKAGE_PREFIX, 1)
+
+script_head = u'define([\'nunja/core\'], function(core) {\n'
+script_line = u'    // %s\n' % ('filler ' * 9)
+script_tail = u'    return {};\n});\n'
+
+
+def make_registry(root, molds=20, script_size=262144):
+    """
+    Write a package with the number of molds into root, each with a
+    small template and a script of about script_size bytes.  Return the
+    list of the mold ids.
+    """
+
+    lines = max(script_size // len(script_line), 1)
+    return generate_mold_packages(
+        root, 1, molds, PACKAGE_PREFIX,
+        script=script_head + script_line * lines + script_tail)
+
+
+def register(root, name=REGISTRY_NAME):
+    """
+    Make the package written by make_registry at root available as the
+    registry with name.
+    """
+
+    default_registry.records[name] = make_generated_mold_registry(
+        root, PACKAGES, name)
+
+
+def make_categories(mold_ids, name=REGISTRY_NAME):
+    """
+    Return the categories of requests, which map to the paths and the
+    expected statuses of the responses.
+    """
+
+    prefix = '/nunja/' + name + '/'
+    return {
+        'core': (['/nunja/config.js', '/nunja/init.js'], (200,)),
+        'template': ([
+            prefix + mold_id + '/template.nja' for mold_id in mold_ids
+        ], (200,)),
+        'script': ([
+            prefix + mold_id + '/index.js' for mold_id in mold_ids
+        ], (200,)),
+        'not_found': ([
+            prefix + mold_id + '/missing.js' for mold_id in mold_ids
+        ], (404,)),
+    }
+
+
+def run(names, categories, requests=1000, concurrency=8, headers={},
+        setup=None):
+    """
+    Benchmark the adapters by names against the categories, return a
+    dict of the summaries for each category under the adapters; the
+    adapters that are not available have the reason under 'error'.
+    """
+
+    results = {}
+    for name in names:
+        try:
+            server = adapters[name](
+                (REGISTRY_NAME,), workers=concurrency, setup=setup)
+        except ImportError as e:
+            results[name] = {'error': 'unavailable: %s' % e}
+            continue
+
+        client = Client(server.host, server.port, concurrency=concurrency)
+        try:
+            results[name] = {
+                category: client.run(paths, requests, headers, expect)
+                for category, (paths, expect) in categories.items()
+            }
+        finally:
+            server.stop()
+    return results
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='benchmark the nunja.serve adapters')
+    parser.add_argument('--adapter', action='append', dest='adapters',
+                        choices=sorted(adapters),
+                        help='The adapter to benchmark; may be specified '
+                             'multiple times [default: all]')
+    parser.add_argument('--requests', '-n', default=1000, type=int,
+                        metavar='N',
+                        help='The number of requests for each category '
+                             '[default: 1000]')
+    parser.add_argument('--concurrency', '-c', default=8, type=int,
+                        metavar='N',
+                        help='The number of concurrent connections '
+                             '[default: 8]')
+    parser.add_argument('--molds', default=20, type=int, metavar='N',
+                        help='The number of molds to generate [default: 20]')
+    parser.add_argument('--script-size', default=262144, type=int,
+                        metavar='BYTES',
+                        help='The size of the generated scripts '
+                             '[default: 262144]')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Request gzip encoded responses')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Write the JSON report to FILE '
+                             '[default: standard output]')
+    args = parser.parse_args(args)
+    # the generated entry points have no distributions to be warned of.
+    logging.getLogger('calmjs').setLevel(logging.ERROR)
+
+    root = tempfile.mkdtemp()
+    try:
+        mold_ids = make_registry(root, args.molds, args.script_size)
+        setup = partial(register, root)
+        setup()
+        report = {
+            'python': platform.python_version(),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'molds': args.molds,
+            'script_size': args.script_size,
+            'gzip': args.gzip,
+            'results': run(
+                args.adapters or sorted(adapters), make_categories(mold_ids),
+                requests=args.requests, concurrency=args.concurrency,
+                headers={'Accept-Encoding': 'gzip'} if args.gzip else {},
+                setup=setup,
+            ),
+        }
+    finally:
+        default_registry.records.pop(REGISTRY_NAME, None)
+        remove_generated_packages(root, PACKAGES)
+        shutil.rmtree(root)
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output + '\n')
+    else:
+        print(output)
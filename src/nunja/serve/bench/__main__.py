@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from nunja.serve.bench import main
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
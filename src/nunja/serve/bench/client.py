@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+A concurrent HTTP client for load generation, and the summary of the
+measurements it produces.
+"""
+
+import threading
+from time import time
+
+from nunja.serve.compat import HTTPConnection
+
+
+def percentile(values, fraction):
+    """
+    Return the value at the fraction (from 0 to 1) of the sorted list of
+    values, using the nearest-rank method.
+    """
+
+    if not values:
+        return None
+    rank = max(int(round(fraction * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(latencies, sizes, errors, elapsed):
+    """
+    Return a dict summarizing a run, with the latencies in milliseconds.
+    """
+
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p95': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'bytes': sum(sizes),
+    }
+
+
+class Client(object):
+    """
+    Drive a number of requests for the paths against a server, over the
+    specified number of concurrent persistent connections.
+    """
+
+    def __init__(self, host, port, concurrency=8, timeout=10):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def connect(self):
+        return HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, connection, path, headers):
+        """
+        Issue a single request, return the status and the size of the
+        body.  A new connection is returned if the server closed it.
+        """
+
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+            connection = self.connect()
+        return connection, response.status, len(body)
+
+    def run(self, paths, requests, headers={}, expect=(200,)):
+        """
+        Make the number of requests by cycling through the paths, and
+        return the summary.  Responses with a status not in expect are
+        counted as errors.
+        """
+
+        lock = threading.Lock()
+        latencies = []
+        sizes = []
+        counters = {'next': 0, 'errors': 0}
+
+        def claim():
+            with lock:
+                index = counters['next']
+                if index >= requests:
+                    return None
+                counters['next'] += 1
+                return paths[index % len(paths)]
+
+        def worker():
+            connection = self.connect()
+            try:
+                while True:
+                    path = claim()
+                    if path is None:
+                        return
+                    start = time()
+                    try:
+                        connection, status, size = self.request(
+                            connection, path, headers)
+                    except Exception:
+                        connection.close()
+                        connection = self.connect()
+                        with lock:
+                            counters['errors'] += 1
+                        continue
+                    latency = time() - start
+                    with lock:
+                        latencies.append(latency)
+                        sizes.append(size)
+                        if status not in expect:
+                            counters['errors'] += 1
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker) for i in range(self.concurrency)]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(latencies, sizes, counters['errors'], time() - start)
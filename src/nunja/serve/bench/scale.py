@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for how the construction of the registry and the Provider,
+the generated configuration and the lookups scale with the number of
+molds in the registry.
+
+Invoke with ``python -m nunja.serve.bench.scale``.
+"""
+
+import json
+import logging
+import platform
+import shutil
+import tempfile
+from time import time
+
+try:  # pragma: no cover
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+from calmjs.registry import _inst as default_registry
+
+from nunja.serve.rjs import Provider
+from nunja.serve.testing import generate_mold_packages
+from nunja.serve.testing import make_generated_mold_registry
+from nunja.serve.testing import package_names
+from nunja.serve.testing import remove_generated_packages
+
+REGISTRY_NAME = 'nunja.scale.mold'
+DEFAULT_SIZES = (100, 1000, 10000)
+
+
+def time_lookups(lookup, identifiers, rounds=3, reset=None):
+    """
+    Return the mean number of microseconds per call of lookup for the
+    identifiers; a KeyError is counted as a completed lookup.  If reset
+    is provided, it is called before every round, such that the rounds
+    after the first are not served by whatever the lookups cached.
+    """
+
+    start = time()
+    for i in range(rounds):
+        if reset is not None:
+            reset()
+        for identifier in identifiers:
+            try:
+                lookup(identifier)
+            except KeyError:
+                pass
+    return (time() - start) * 1e6 / (rounds * len(identifiers) or 1)
+
+
+def measure(molds, per_package=10, samples=1000):
+    """
+    Generate a registry with the number of molds spread over packages
+    with per_package molds each, and return the measurements.
+    """
+
+    per_package = min(per_package, molds)
+    prefix = 'nunja_scale%d_' % molds
+    packages = package_names(prefix, max(molds // per_package, 1))
+    root = tempfile.mkdtemp()
+    try:
+        mold_ids = generate_mold_packages(
+            root, len(packages), per_package, prefix)
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+        start = time()
+        default_registry.records[REGISTRY_NAME] = (
+            make_generated_mold_registry(root, packages, REGISTRY_NAME))
+        registry_seconds = time() - start
+        start = time()
+        provider = Provider('/nunja/', registry_names=(REGISTRY_NAME,))
+        provider_seconds = time() - start
+        peak_bytes = None
+        if tracemalloc is not None:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        step = max(len(mold_ids) // samples, 1)
+        identifiers = [
+            REGISTRY_NAME + '/' + mold_id + '/index.js'
+            for mold_id in mold_ids[::step]
+        ]
+        missing = [
+            REGISTRY_NAME + '/' + mold_id + '/missing.js'
+            for mold_id in mold_ids[::step]
+        ]
+        index_entries = len(provider.index)
+        lookup_us = time_lookups(provider.fetch_path, identifiers)
+        # without the index, the registry has to verify the paths; the
+        # paths it resolved are kept by the provider, so those go too.
+        provider.index = {}
+
+        def reset():
+            provider.resolved = {}
+
+        fallback_lookup_us = time_lookups(
+            provider.fetch_path, identifiers, reset=reset)
+        miss_us = time_lookups(provider.fetch_path, missing, reset=reset)
+
+        return {
+            'molds': len(mold_ids),
+            'packages': len(packages),
+            'registry_seconds': registry_seconds,
+            'provider_seconds': provider_seconds,
+            'peak_bytes': peak_bytes,
+            'config_bytes': len(provider.fetch_content('config.js').data),
+            'index_entries': index_entries,
+            'lookup_us': lookup_us,
+            'fallback_lookup_us': fallback_lookup_us,
+            'miss_us': miss_us,
+        }
+    finally:
+        default_registry.records.pop(REGISTRY_NAME, None)
+        remove_generated_packages(root, packages)
+        shutil.rmtree(root)
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='benchmark nunja.serve against large registries')
+    parser.add_argument('sizes', nargs='*', type=int, metavar='MOLDS',
+                        help='The numbers of molds to measure with '
+                             '[default: %s]' % ' '.join(
+                                 str(size) for size in DEFAULT_SIZES))
+    parser.add_argument('--per-package', default=10, type=int, metavar='N',
+                        help='The number of molds for each package '
+                             '[default: 10]')
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='Write the JSON report to FILE '
+                             '[default: standard output]')
+    args = parser.parse_args(args)
+    # the generated entry points have no distributions to be warned of.
+    logging.getLogger('calmjs').setLevel(logging.ERROR)
+
+    report = {
+        'python': platform.python_version(),
+        'per_package': args.per_package,
+        'results': [
+            measure(size, args.per_package)
+            for size in args.sizes or DEFAULT_SIZES
+        ],
+    }
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Start the serving adapters locally for benchmarking.
+
+Each of the start functions return a Server that is ready to accept
+connections, which must be stopped after use.  Every adapter is served
+by a subprocess, without the logging of the requests, such that their
+results are comparable.
+"""
+
+import logging
+import socket
+from multiprocessing import Process
+from time import sleep
+from time import time
+
+from nunja.serve.rjs import Provider
+
+
+def free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def wait_for(host, port, timeout=30):
+    """
+    Wait until the port at host accepts connections.
+    """
+
+    deadline = time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except (IOError, OSError):
+            if time() > deadline:
+                raise
+            sleep(0.05)
+
+
+class Server(object):
+
+    def __init__(self, host, port, stop):
+        self.host = host
+        self.port = port
+        self._stop = stop
+
+    def stop(self):
+        self._stop()
+
+
+def start_process(target, registry_names, host, workers, setup):
+    """
+    Start the target in a subprocess to serve at a free port, such that
+    every adapter is served by a process of its own apart from the
+    clients; setup is called in there such that the registries are
+    available.
+    """
+
+    port = free_port(host)
+    process = Process(
+        target=target, args=(registry_names, host, port, workers, setup))
+    process.daemon = True
+    process.start()
+
+    def stop():
+        process.terminate()
+        process.join()
+
+    try:
+        wait_for(host, port)
+    except Exception:
+        stop()
+        raise
+    return Server(host, port, stop)
+
+
+def _run_simple(registry_names, host, port, workers, setup):
+    from nunja.serve.simple import NunjaHTTPRequestHandler
+    from nunja.serve.simple import NunjaHTTPRequestHandlerFactory
+    from nunja.serve.simple import ThreadPoolHTTPServer
+
+    class QuietHandler(NunjaHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    if setup is not None:
+        setup()
+    provider = Provider('/nunja', registry_names=registry_names)
+    handler = NunjaHTTPRequestHandlerFactory(
+        provider, nunja_prefix='/nunja', registry_names=registry_names,
+        handler_cls=QuietHandler, protocol_version='HTTP/1.1')
+    server = ThreadPoolHTTPServer((host, port), handler, workers=workers)
+    server.serve_forever()
+
+
+def start_simple(registry_names, host='127.0.0.1', workers=8, setup=None):
+    """
+    The simple server, with a pool of worker threads over persistent
+    HTTP/1.1 connections.
+    """
+
+    return start_process(_run_simple, registry_names, host, workers, setup)
+
+
+def _run_flask(registry_names, host, port, workers, setup):
+    from flask import Flask
+    from werkzeug.serving import make_server
+    from nunja.serve.flask import RJSProvider
+    # the requests are otherwise logged.
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if setup is not None:
+        setup()
+    app = RJSProvider('/nunja/', registry_names=registry_names)(
+        Flask(__name__))
+    make_server(host, port, app, threaded=True).serve_forever()
+
+
+def start_flask(registry_names, host='127.0.0.1', workers=8, setup=None):
+    """
+    The flask adapter, served by the threaded werkzeug server.
+    """
+
+    # fail early if flask is not available
+    import flask  # noqa: F401
+    return start_process(_run_flask, registry_names, host, workers, setup)
+
+
+def _run_sanic(registry_names, host, port, workers, setup):
+    from sanic import Sanic
+    from nunja.serve.sanic import RJSProvider
+    if setup is not None:
+        setup()
+    app = RJSProvider('/nunja/', registry_names=registry_names)(
+        Sanic('nunja_bench'))
+    app.run(host=host, port=port, access_log=False)
+
+
+def start_sanic(registry_names, host='127.0.0.1', workers=8, setup=None):
+    """
+    The sanic adapter, which runs its own loop.
+    """
+
+    # fail early if sanic is not available
+    import sanic  # noqa: F401
+    return start_process(_run_sanic, registry_names, host, workers, setup)
+
+
+adapters = {
+    'simple': start_simple,
+    'flask': start_flask,
+    'sanic': start_sanic,
+}
@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+Module for caching the contents of the files served by providers.
+"""
+
+import os
+from collections import OrderedDict
+from email.utils import formatdate
+from hashlib import sha1
+from threading import Event
+from threading import Lock
+from time import time
+
+from nunja.serve.compress import compress
+from nunja.serve.compress import read_sibling
+
+# 16 MiB should be sufficient for the templates and scripts of a
+# typical set of molds.
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+# the rendered molds are kept for this many seconds by default.
+DEFAULT_RENDER_TTL = 60
+
+
+def stat_key(path):
+    """
+    Return a cheap to compute key for the file at path, which will
+    change whenever the file is modified or replaced.
+    """
+
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class Content(object):
+    """
+    A single version of some content to be served, i.e. the contents of
+    a file at the time it was read, along with the validators derived
+    from it.
+    """
+
+    def __init__(self, data, key=None, path=None, mtime=None):
+        """
+        Arguments
+
+        data
+            The encoded contents, as bytes.
+        key
+            The key returned by stat_key for the file at the time it
+            was read, if the content is backed by a file.
+        path
+            The filesystem path of the file, if any.
+        mtime
+            The modification time; defaults to the one from the key,
+            or the current time if there is no key.
+        """
+
+        self.data = data
+        self.key = key
+        self.path = path
+        if mtime is None:
+            mtime = key[0] if key else time()
+        self.mtime = mtime
+        self.variants = {}
+        self._etag = None
+        self._last_modified = None
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def footprint(self):
+        """
+        The total size of the data held, including the variants.
+        """
+
+        return len(self.data) + sum(
+            len(v) for v in self.variants.values() if v)
+
+    @property
+    def text(self):
+        return self.data.decode('utf8')
+
+    @property
+    def etag(self):
+        """
+        A strong entity tag derived from a hash of the content.
+        """
+
+        if self._etag is None:
+            self._etag = '"%s"' % sha1(self.data).hexdigest()
+        return self._etag
+
+    @property
+    def last_modified(self):
+        """
+        The modification time formatted as a HTTP date.
+        """
+
+        if self._last_modified is None:
+            self._last_modified = formatdate(self.mtime, usegmt=True)
+        return self._last_modified
+
+    def variant(self, coding, precompressed=False):
+        """
+        Return the content encoded with the coding, or None if encoding
+        does not make it any smaller.  The result is kept with this
+        Content such that it is only produced once.
+
+        If precompressed is True and this is backed by a file, its
+        precompressed sibling (e.g. 'index.js.gz') will be used if that
+        is not older than the file.
+        """
+
+        if coding in self.variants:
+            return self.variants[coding]
+
+        data = None
+        if precompressed and self.path:
+            data = read_sibling(self.path, coding, self.mtime)
+        if data is None:
+            data = compress(self.data, coding)
+        self.variants[coding] = data
+        return data
+
+
+def load(path):
+    """
+    Read the file at path into a new Content.
+    """
+
+    key = stat_key(path)
+    with open(path, 'rb') as fd:
+        return Content(fd.read(), key, path)
+
+
+class ContentCache(object):
+    """
+    A least recently used cache of file contents, keyed by the resolved
+    filesystem path and bounded by the total size of the contents held.
+
+    Every lookup will stat the underlying file to ensure that stale
+    contents are never returned.
+    """
+
+    def __init__(self, loader=load, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Arguments
+
+        loader
+            A callable that accept a path and return a new Content for
+            the file at that path.
+        max_bytes
+            The maximum total size of all contents held by this cache.
+        """
+
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # the footprint of each of the entries as accounted for.
+        self._sizes = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def _lookup(self, path, key):
+        with self._lock:
+            content = self._entries.get(path)
+            if content is None or content.key != key:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # move to the most recently used position
+            self._entries[path] = self._entries.pop(path)
+            return content
+
+    def _store(self, content):
+        with self._lock:
+            self._discard(content.path)
+            self._account(content)
+
+    def _account(self, content):
+        # lock must be held by caller.
+        size = content.footprint
+        if size > self.max_bytes:
+            return
+        self._entries[content.path] = content
+        self._sizes[content.path] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            path = next(iter(self._entries))
+            self._discard(path)
+            self.evictions += 1
+
+    def _discard(self, path):
+        # lock must be held by caller.
+        content = self._entries.pop(path, None)
+        if content is not None:
+            self.total_bytes -= self._sizes.pop(path)
+        return content
+
+    def get(self, path):
+        """
+        Return the Content for the file at path, reading it with the
+        loader only if it is not cached or the cached version is stale.
+        """
+
+        content = self._lookup(path, stat_key(path))
+        if content is None:
+            content = self.loader(path)
+            self._store(content)
+        return content
+
+    def peek(self, path, key):
+        """
+        Return the cached Content for the file at path if it is of the
+        version of the key, otherwise None; the file is never read.
+        """
+
+        return self._lookup(path, key)
+
+    def update(self, content):
+        """
+        Account for the change in the footprint of a cached content,
+        such as after a new variant was produced for it.
+        """
+
+        with self._lock:
+            if self._entries.get(content.path) is not content:
+                return
+            self._discard(content.path)
+            self._account(content)
+
+    def invalidate(self, path):
+        """
+        Remove the contents for path from the cache.
+        """
+
+        with self._lock:
+            return self._discard(path) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """
+        Return a dict of the counters for this cache.
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.total_bytes,
+        }
+
+
+class Flight(object):
+    """
+    The production of a value in progress, for others to wait on.
+    """
+
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.error = None
+
+    def set(self, value, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class RenderCache(object):
+    """
+    A least recently used cache of the contents of rendered molds, keyed
+    by a tuple of the mold id, the version of the mold and the digest of
+    the data, bounded by the total size of the contents held and with
+    the entries expiring after a fixed number of seconds.
+
+    Concurrent lookups for the same key that is not cached are coalesced
+    such that the content is only produced once.
+    """
+
+    def __init__(
+            self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_RENDER_TTL,
+            timer=time):
+        """
+        Arguments
+
+        max_bytes
+            The maximum total size of all contents held by this cache.
+        ttl
+            The number of seconds that a content is kept for.
+        timer
+            The callable that return the current time in seconds.
+        """
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timer = timer
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        # the expiry time and the accounted footprint of the entries.
+        self._expiries = {}
+        self._sizes = {}
+        # the keys for the ids of the contents held.
+        self._keys = {}
+        self._flights = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _account(self, key, content, expiry):
+        # lock must be held by caller.
+        size = content.footprint
+        if size > self.max_bytes:
+            return
+        self._entries[key] = content
+        self._expiries[key] = expiry
+        self._sizes[key] = size
+        self._keys[id(content)] = key
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key):
+        # lock must be held by caller.
+        content = self._entries.pop(key, None)
+        if content is not None:
+            self.total_bytes -= self._sizes.pop(key)
+            del self._expiries[key]
+            del self._keys[id(content)]
+        return content
+
+    def get(self, key, produce):
+        """
+        Return the Content for key, calling produce for it if it is
+        not cached or has expired.  Any exception raised by produce is
+        raised for every lookup that was waiting on it.
+        """
+
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                if self._expiries[key] > self.timer():
+                    self.hits += 1
+                    # move to the most recently used position
+                    self._entries[key] = self._entries.pop(key)
+                    return content
+                self._discard(key)
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                leader = self._flights[key] = Flight()
+
+        if flight is not None:
+            return flight.wait()
+
+        try:
+            content = produce()
+        except Exception as e:
+            with self._lock:
+                del self._flights[key]
+            leader.set(None, e)
+            raise
+
+        with self._lock:
+            del self._flights[key]
+            self._discard(key)
+            self._account(key, content, self.timer() + self.ttl)
+        leader.set(content)
+        return content
+
+    def update(self, content):
+        """
+        Account for the change in the footprint of a cached content,
+        such as after a new variant was produced for it.
+        """
+
+        with self._lock:
+            key = self._keys.get(id(content))
+            if key is None or self._entries.get(key) is not content:
+                return
+            expiry = self._expiries[key]
+            self._discard(key)
+            self._account(key, content, expiry)
+
+    def invalidate(self, mold_id):
+        """
+        Remove the contents rendered from the mold from the cache.
+        Return the number of contents removed.
+        """
+
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == mold_id]
+            for key in keys:
+                self._discard(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiries.clear()
+            self._sizes.clear()
+            self._keys.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """
+        Return a dict of the counters for this cache.
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'coalesced': self.coalesced,
+            'entries': len(self._entries),
+            'bytes': self.total_bytes,
+        }
@@ -10,13 +10,26 @@ if sys.version_info > (3,):  # pragma: no cover
     from http.server import SimpleHTTPRequestHandler
     from http.server import CGIHTTPRequestHandler
     from http.client import HTTPConnection
+    from http.client import responses
+    from queue import Empty
+    from queue import Queue
+    from io import StringIO
+    from urllib.parse import parse_qs
+    from urllib.parse import quote
 else:  # pragma: no cover
     from BaseHTTPServer import HTTPServer
     from SimpleHTTPServer import SimpleHTTPRequestHandler
     from CGIHTTPServer import CGIHTTPRequestHandler
     from httplib import HTTPConnection
+    from httplib import responses
+    from Queue import Empty
+    from Queue import Queue
+    from StringIO import StringIO
+    from urlparse import parse_qs
+    from urllib import quote
 
 __all__ = [
     'HTTPServer', 'CGIHTTPRequestHandler', 'SimpleHTTPRequestHandler',
-    'HTTPConnection',
+    'HTTPConnection', 'responses', 'Empty', 'Queue', 'StringIO', 'parse_qs',
+    'quote',
 ]
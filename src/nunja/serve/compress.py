@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Module for the negotiation and production of compressed content.
+"""
+
+import zlib
+from os.path import exists
+from os.path import getmtime
+
+try:  # pragma: no cover
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+def gzip_compress(data):
+    # a fixed gzip header (i.e. no mtime), such that the result for the
+    # same input is always identical.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+compressors = {
+    'gzip': gzip_compress,
+}
+
+if brotli is not None:  # pragma: no cover
+    compressors['br'] = brotli.compress
+
+# filename suffixes for the precompressed siblings of files.
+suffixes = {
+    'gzip': '.gz',
+    'br': '.br',
+}
+
+# the default codings, in the order of preference by the server.
+default_encodings = tuple(c for c in ('br', 'gzip') if c in compressors)
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    Return a dict of codings to their qvalues from the value of an
+    Accept-Encoding header.
+    """
+
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        fragments = item.split(';')
+        coding = fragments[0].strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in fragments[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+    return qvalues
+
+
+def negotiate(accept_encoding, encodings=default_encodings):
+    """
+    Return the coding from encodings that is most acceptable to the
+    client as indicated by the Accept-Encoding header, or None if the
+    content should be sent as is.  The order of encodings is used for
+    codings of equal preference to the client.
+    """
+
+    if not accept_encoding:
+        return None
+
+    qvalues = parse_accept_encoding(accept_encoding)
+    default = qvalues.get('*', 0.0)
+    result = None
+    best = 0.0
+    for coding in encodings:
+        qvalue = qvalues.get(coding, default)
+        if qvalue > best:
+            result = coding
+            best = qvalue
+    return result
+
+
+def read_sibling(path, coding, mtime):
+    """
+    Return the contents of the precompressed sibling of the file at
+    path for the coding, if it exists and is not older than mtime.
+    """
+
+    sibling = path + suffixes[coding]
+    if not exists(sibling) or getmtime(sibling) < mtime:
+        return None
+    with open(sibling, 'rb') as fd:
+        return fd.read()
+
+
+def compress(data, coding):
+    """
+    Compress data with the coding.  Return None if the result is not
+    any smaller than the original.
+    """
+
+    result = compressors[coding](data)
+    if len(result) >= len(data):
+        return None
+    return result
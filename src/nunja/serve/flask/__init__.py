@@ -5,10 +5,21 @@ This provide integration with Flask.
 Requires Flask>=0.9
 """
 
-import mimetypes
+from flask import Response
 from flask import make_response
+from flask import request
 
 from nunja.serve import rjs
+from nunja.serve.base import BATCH_SUBPATH
+from nunja.serve.base import METRICS_SUBPATH
+from nunja.serve.base import bad_request
+from nunja.serve.base import parse_batch
+from nunja.serve.base import to_bytes
+from nunja.serve.render import RENDER_PREFIX
+from nunja.serve.render import STREAM_PREFIX
+from nunja.serve.watch import EVENTS_HEADERS
+from nunja.serve.watch import EVENTS_SUBPATH
+from nunja.serve.watch import iter_events
 
 
 class FlaskMixin(object):
@@ -17,23 +28,64 @@ class FlaskMixin(object):
     """
 
     def serve(self, identifier):
-        mimetype = mimetypes.guess_type(identifier)[0] or 'text/plain'
-        if identifier in self.core_subpaths:
-            response = make_response(self.fetch_core(identifier))
+        result = self.respond(identifier, request.headers)
+        return make_response(
+            to_bytes(result.body), result.status, result.headers)
+
+    def serve_batch(self):
+        try:
+            identifiers = parse_batch(
+                request.query_string.decode('utf8'), request.get_data(),
+                self.batch_limit)
+        except ValueError as e:
+            result = bad_request(str(e))
         else:
-            try:
-                response = make_response(self.fetch_object(identifier))
-            except (KeyError, OSError):
-                return make_response('404 NOT FOUND', 404)
+            result = self.respond_batch(identifiers, request.headers)
+        return make_response(result.body, result.status, result.headers)
+
+    def serve_metrics(self):
+        result = self.respond_metrics()
+        return make_response(result.body, result.status, result.headers)
+
+    def serve_render(self, mold_id):
+        result = self.respond_render(
+            mold_id, request.get_data(), request.headers)
+        return make_response(result.body, result.status, result.headers)
 
-        response.headers['Content-Type'] = mimetype
-        return response
+    def serve_stream(self, mold_id):
+        result = self.respond_render_stream(
+            mold_id, request.get_data(), request.headers)
+        if result.chunks is None:
+            return make_response(result.body, result.status, result.headers)
+        # the generator is sent as it is produced.
+        return Response(result.chunks, result.status, result.headers)
+
+    def serve_events(self):
+        return Response(iter_events(self.watcher), 200, EVENTS_HEADERS)
 
     def setup(self, app):
         """
         Set up the app with routes.
         """
 
+        app.add_url_rule(
+            self.base_url + BATCH_SUBPATH, 'nunja_batch', self.serve_batch,
+            methods=['GET', 'POST'])
+        if self.metrics is not None:
+            app.add_url_rule(
+                self.base_url + METRICS_SUBPATH, 'nunja_metrics',
+                self.serve_metrics)
+        if getattr(self, 'watcher', None) is not None:
+            app.add_url_rule(
+                self.base_url + EVENTS_SUBPATH, 'nunja_events',
+                self.serve_events)
+        if self.renderer is not None:
+            app.add_url_rule(
+                self.base_url + RENDER_PREFIX + '<path:mold_id>',
+                'nunja_render', self.serve_render, methods=['GET', 'POST'])
+            app.add_url_rule(
+                self.base_url + STREAM_PREFIX + '<path:mold_id>',
+                'nunja_stream', self.serve_stream, methods=['GET', 'POST'])
         app.add_url_rule(
             self.base_url + '<path:identifier>', 'nunja', self.serve)
 
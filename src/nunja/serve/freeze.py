@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Freeze everything served by a provider into a directory, such that it
+can be served as static files by any web server or CDN.
+
+Invoke with ``python -m nunja.serve.freeze <output_directory>``.
+"""
+
+import json
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+from os.path import dirname
+from os.path import join
+
+from nunja.registry import ENTRY_POINT_NAME
+from nunja.serve.compress import default_encodings
+from nunja.serve.compress import suffixes
+from nunja.serve.rjs import BUNDLE_PREFIX
+from nunja.serve.rjs import Provider
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def to_target(provider, identifier):
+    """
+    Return the subpath for the identifier in the frozen output, which
+    will have the fingerprint of the mold, if any.
+    """
+
+    fragments = identifier.split('/', 3)
+    if len(fragments) == 4:
+        mold = '/'.join(fragments[:3])
+        fingerprint = provider.fingerprints.get(mold)
+        if fingerprint:
+            return mold + '.' + fingerprint + '/' + fragments[3]
+    return identifier
+
+
+def iter_identifiers(provider):
+    """
+    Yield every identifier served by the provider, starting with the
+    core subpaths.
+    """
+
+    for identifier in provider.core_names:
+        yield identifier
+    for identifier in sorted(provider.index):
+        yield identifier
+    if provider.bundles_enabled:
+        for mold_id in sorted(provider.bundle_index):
+            yield BUNDLE_PREFIX + mold_id + '.js'
+
+
+def write(output, target, content, encodings=()):
+    """
+    Write the content to target under the output directory, along with
+    the variants for the encodings as its precompressed siblings.
+    """
+
+    path = join(output, *target.split('/'))
+    if not os.path.isdir(dirname(path)):
+        try:
+            os.makedirs(dirname(path))
+        except OSError:
+            # another thread may have just created it.
+            if not os.path.isdir(dirname(path)):
+                raise
+
+    if content.path:
+        shutil.copyfile(content.path, path)
+    else:
+        with open(path, 'wb') as fd:
+            fd.write(content.data)
+
+    written = [target]
+    for coding in encodings:
+        data = content.variant(coding)
+        if data is None:
+            continue
+        with open(path + suffixes[coding], 'wb') as fd:
+            fd.write(data)
+        written.append(target + suffixes[coding])
+    return written
+
+
+def freeze(provider, output, encodings=(), workers=4):
+    """
+    Write every file served by the provider into the output directory,
+    with precompressed siblings for the encodings, using a pool of
+    worker threads.  A manifest that map the identifiers to the details
+    of the written files is also written, and returned.
+    """
+
+    def freeze_identifier(identifier):
+        target = to_target(provider, identifier)
+        content = provider.fetch_content(identifier)
+        return identifier, {
+            'path': target,
+            'size': content.size,
+            'etag': content.etag,
+            'files': write(output, target, content, encodings),
+        }
+
+    pool = ThreadPool(workers)
+    try:
+        manifest = dict(pool.map(
+            freeze_identifier, list(iter_identifiers(provider))))
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(join(output, MANIFEST_NAME), 'w') as fd:
+        json.dump(manifest, fd, indent=4, sort_keys=True)
+    return manifest
+
+
+def main(provider_cls=Provider, args=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=(
+        'write all the files served by nunja.serve to a directory'))
+    parser.add_argument('output', metavar='DIRECTORY',
+                        help='The directory to write the files to')
+    parser.add_argument('--base-url', default='/nunja/', metavar='URL',
+                        help='The url the directory will be served from '
+                             '[default: /nunja/]')
+    parser.add_argument('--registry', action='append', dest='registries',
+                        metavar='NAME',
+                        help='The registry to export; may be specified '
+                             'multiple times [default: %s]' % (
+                                 ENTRY_POINT_NAME))
+    parser.add_argument('--fingerprint', action='store_true',
+                        help='Write the molds under fingerprinted paths')
+    parser.add_argument('--bundles', action='store_true',
+                        help='Write and configure the bundles for molds')
+    parser.add_argument('--compress', action='store_true',
+                        help='Write precompressed siblings for the files')
+    parser.add_argument('--workers', default=4, type=int, metavar='N',
+                        help='The number of threads to copy files with '
+                             '[default: 4]')
+    args = parser.parse_args(args)
+
+    provider = provider_cls(
+        args.base_url,
+        registry_names=tuple(args.registries or (ENTRY_POINT_NAME,)),
+        fingerprint=args.fingerprint, bundles=args.bundles)
+    manifest = freeze(
+        provider, args.output,
+        encodings=default_encodings if args.compress else (),
+        workers=args.workers,
+    )
+    print('Wrote %d files to %s' % (
+        sum(len(v['files']) for v in manifest.values()), args.output))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
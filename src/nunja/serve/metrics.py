@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight counters and histograms for the instrumentation of the
+providers, rendered in the Prometheus text exposition format.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from timeit import default_timer
+
+# the content type for the text exposition format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# the upper bounds of the buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+descriptions = {
+    'nunja_requests_total': (
+        'counter', 'Requests handled by the provider, by status.'),
+    'nunja_response_bytes_total': (
+        'counter', 'Bytes in the bodies of the responses.'),
+    'nunja_request_seconds': (
+        'histogram', 'Time taken to produce the responses.'),
+    'nunja_phase_seconds': (
+        'histogram', 'Time spent in each phase of producing responses.'),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # the counts are not cumulative until rendered.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels=()):
+        """
+        Yield the lines for the buckets, the sum and the count.
+        """
+
+        cumulative = 0
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            yield '%s_bucket%s %d' % (
+                name, format_labels(labels + (('le', bound),)), cumulative)
+        yield '%s_sum%s %s' % (name, format_labels(labels), repr(self.sum))
+        yield '%s_count%s %d' % (name, format_labels(labels), self.count)
+
+
+class Timer(object):
+    """
+    A context manager that observe the duration of its block.
+    """
+
+    def __init__(self, metrics, name, labels=()):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(
+            self.name, default_timer() - self.start, self.labels)
+
+
+class NullTimer(object):
+    """
+    The stand-in for Timer when metrics are not collected.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class Metrics(object):
+    """
+    A thread-safe collection of counters and histograms, identified by
+    their names and a tuple of (name, value) pairs for the labels.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, phase):
+        """
+        Return a context manager that time a phase.
+        """
+
+        return Timer(self, 'nunja_phase_seconds', (('phase', phase),))
+
+    def render(self, extra=()):
+        """
+        Return the text exposition of the metrics, followed by the extra
+        samples, which is an iterable of (name, type, help, value).
+        """
+
+        # sorted for stable output between scrapes.
+        with self.lock:
+            series = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                series.setdefault(name, []).append(
+                    '%s%s %s' % (name, format_labels(labels), value))
+            for key in sorted(self.histograms):
+                name, labels = key
+                series.setdefault(name, []).extend(
+                    self.histograms[key].samples(name, labels))
+
+        lines = []
+        for name in sorted(series):
+            type_, help_ = descriptions.get(name, ('untyped', name))
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, type_))
+            lines.extend(series[name])
+        for name, type_, help_, value in extra:
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, type_))
+            lines.append('%s %s' % (name, format_value(value)))
+        return '\n'.join(lines) + '\n'
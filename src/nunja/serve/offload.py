@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Module for offloading the delivery of files to a front proxy, such that
+the response produced for a file only carry the header that tell the
+proxy (e.g. nginx with X-Accel-Redirect, or Apache and lighttpd with
+X-Sendfile) which file to send in its place.
+"""
+
+from os.path import normpath
+from os.path import sep
+
+from nunja.serve.compat import quote
+
+X_ACCEL_REDIRECT = 'X-Accel-Redirect'
+X_SENDFILE = 'X-Sendfile'
+
+headers = {
+    'x-accel-redirect': X_ACCEL_REDIRECT,
+    'x-sendfile': X_SENDFILE,
+}
+
+
+def parse_mapping(value):
+    """
+    Parse the mapping in the form of 'directory=prefix' into the pair.
+    """
+
+    directory, eq, prefix = value.partition('=')
+    if not eq or not directory:
+        raise ValueError(
+            "mapping '%s' is not in the form of 'directory=prefix'" % value)
+    return directory, prefix
+
+
+class Offload(object):
+    """
+    The header and the mapping of directories to prefixes for the files
+    to be delivered by the front proxy.
+    """
+
+    def __init__(self, header=X_ACCEL_REDIRECT, mapping=()):
+        """
+        Arguments
+
+        header
+            The name of the header for the proxy.  For X-Accel-Redirect
+            the value is an uri for an internal location, which will be
+            quoted.
+        mapping
+            The pairs of (directory, prefix), or a dict of the same.  A
+            file under the directory is offloaded as the prefix joined
+            with the path relative to the directory; the longest of the
+            matching directories is used.  Files not under any of the
+            directories are not offloaded, but if no mapping is provided
+            every file is offloaded with its own path, which is only of
+            use for X-Sendfile.
+        """
+
+        self.header = headers.get(header.lower(), header)
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        self.mapping = sorted((
+            (normpath(directory), prefix) for directory, prefix in mapping
+        ), key=lambda item: len(item[0]), reverse=True)
+
+    def target(self, path):
+        """
+        Return the value of the header for the file at path, or None if
+        the file is not to be offloaded.
+        """
+
+        if not self.mapping:
+            return path
+        for directory, prefix in self.mapping:
+            if path.startswith(directory.rstrip(sep) + sep):
+                rest = path[len(directory):].lstrip(sep)
+                break
+        else:
+            return None
+        if self.header != X_ACCEL_REDIRECT:
+            return prefix.rstrip(sep) + sep + rest
+        return prefix.rstrip('/') + '/' + quote(rest.replace(sep, '/'))
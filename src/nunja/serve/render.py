@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Server side rendering of the molds into HTML, for clients that should
+not have to wait for the scripts to be loaded before anything could be
+shown.
+
+Rendering is bound by the processor, so a ProcessPoolRenderer may be
+used in place of the Renderer to spread the work across the cores.
+"""
+
+import codecs
+import json
+import logging
+from hashlib import sha1
+from multiprocessing import Pool
+
+from calmjs.registry import get
+from nunja.engine import Engine
+from nunja.registry import DEFAULT_WRAPPER_NAME
+from nunja.registry import ENTRY_POINT_NAME
+from nunja.registry import REQ_TMPL_NAME
+
+from nunja.serve.cache import stat_key
+
+logger = logging.getLogger(__name__)
+
+# the prefix of the subpaths for the rendering of the molds, i.e.
+# '_render/<mold_id>'.
+RENDER_PREFIX = '_render/'
+# the prefix of the subpaths for the streamed rendering of the molds.
+STREAM_PREFIX = '_stream/'
+
+# the minimum size of the chunks of streamed renderings.
+STREAM_CHUNK_SIZE = 16384
+
+# the content type for the rendered molds.
+CONTENT_TYPE = 'text/html; charset=utf-8'
+
+
+def parse_data(body=None):
+    """
+    Return the data for rendering from the JSON encoded body, which
+    must be an object if provided.  A ValueError will be raised if the
+    body cannot be parsed.
+    """
+
+    if not body:
+        return {}
+    if not isinstance(body, str):
+        body = body.decode('utf8')
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError('data must be an object')
+    return data
+
+
+def data_digest(data):
+    """
+    Return the digest of the canonical JSON encoding of the data, such
+    that equal data produce the same digest regardless of ordering.
+    """
+
+    return sha1(json.dumps(
+        data, sort_keys=True, separators=(',', ':')).encode('utf8')
+    ).hexdigest()
+
+
+def iter_chunks(fragments, size=STREAM_CHUNK_SIZE):
+    """
+    Yield the encoded fragments of text joined into chunks of at least
+    the size, except for the last one.
+    """
+
+    buffered = []
+    length = 0
+    for fragment in fragments:
+        buffered.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield u''.join(buffered).encode('utf8')
+            buffered = []
+            length = 0
+    if buffered:
+        yield u''.join(buffered).encode('utf8')
+
+
+class BaseRenderer(object):
+    """
+    The interface for the rendering of molds by the providers.
+    """
+
+    registry_name = ENTRY_POINT_NAME
+
+    def version(self, mold_id):
+        """
+        Return a key for the current version of the mold, which changes
+        whenever any of the files of the mold are modified.  A KeyError
+        will be raised if the mold is not found.
+        """
+
+        registry = get(self.registry_name)
+        record = registry.get_record(mold_id) if registry else None
+        if not record:
+            raise KeyError("mold '%s' not found" % mold_id)
+        try:
+            return tuple(stat_key(record[name]) for name in sorted(record))
+        except (IOError, OSError):
+            raise KeyError("mold '%s' could not be read" % mold_id)
+
+    def execute(self, mold_id, data, wrapper_tag='div'):
+        """
+        Return the mold rendered with the data, wrapped like how it is
+        done by the engine, such that the scripts for the mold will be
+        executed by the client.  A KeyError will be raised if the mold
+        is not found.
+        """
+
+        raise NotImplementedError
+
+    def stream(self, mold_id, data, wrapper_tag='div'):
+        """
+        Return an iterator of the encoded chunks of what execute would
+        return.  A KeyError will be raised if the mold is not found.
+
+        The default implementation produce the rendering in full as a
+        single chunk.
+        """
+
+        return iter([self.execute(mold_id, data, wrapper_tag).encode('utf8')])
+
+    def close(self):
+        """
+        Release the resources held for rendering.
+        """
+
+
+class Renderer(BaseRenderer):
+    """
+    Render molds through a nunja engine in the calling thread.  The
+    compiled templates are kept, and only compiled again once their
+    files are changed.
+    """
+
+    def __init__(self, registry_name=ENTRY_POINT_NAME, engine=None):
+        """
+        Arguments
+
+        registry_name
+            The name of the mold registry for the engine.
+        engine
+            The nunja Engine to render with; if not provided, one for
+            the registry will be created.
+        """
+
+        self.registry_name = registry_name
+        self.engine = Engine(registry_name) if engine is None else engine
+        # the name of the templates to their stat_key and template.
+        self.templates = {}
+
+    def load_template(self, name):
+        """
+        Return the compiled template for name, which is compiled again
+        if its file has changed since.  A KeyError will be raised if
+        the template is not found.
+        """
+
+        try:
+            path = self.engine.lookup_path(name)
+            key = stat_key(path)
+        except (IOError, OSError):
+            raise KeyError("template '%s' not found" % name)
+
+        entry = self.templates.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        with codecs.open(path, encoding='utf-8') as fd:
+            source = fd.read()
+        env = self.engine.env
+        template = env.template_class.from_code(
+            env, env.compile(source, name, path), env.make_globals(None))
+        self.templates[name] = key, template
+        return template
+
+    def load_mold(self, mold_id):
+        """
+        Return the compiled template for the mold.
+        """
+
+        return self.load_template(mold_id + '/' + REQ_TMPL_NAME)
+
+    def preload(self):
+        """
+        Compile the templates of all the molds in the registry ahead of
+        their use.  Return the list of the mold ids loaded.
+        """
+
+        loaded = []
+        registry = get(self.registry_name)
+        for mold_id, mapping in (registry.iter_records() if registry else ()):
+            # records not keyed by a mold_id are not part of any molds.
+            if '/' not in mold_id:
+                continue
+            try:
+                self.load_mold(mold_id)
+            except KeyError:
+                # molds without the template, i.e. only scripts.
+                continue
+            except Exception:
+                logger.exception("failed to compile mold '%s'", mold_id)
+                continue
+            loaded.append(mold_id)
+        return loaded
+
+    def wrapped(self, mold_id, data, wrapper_tag='div'):
+        """
+        Return the wrapper template along with the arguments for it to
+        render the mold with the data.
+        """
+
+        kwargs = dict(data)
+        kwargs['_nunja_data_'] = 'data-nunja="%s"' % mold_id
+        kwargs['_template_'] = self.load_mold(mold_id)
+        kwargs['_wrapper_tag_'] = wrapper_tag
+        return self.load_mold(DEFAULT_WRAPPER_NAME), kwargs
+
+    def execute(self, mold_id, data, wrapper_tag='div'):
+        template, kwargs = self.wrapped(mold_id, data, wrapper_tag)
+        return template.render(**kwargs)
+
+    def stream(self, mold_id, data, wrapper_tag='div'):
+        # the templates are loaded before anything is produced.
+        template, kwargs = self.wrapped(mold_id, data, wrapper_tag)
+        return iter_chunks(template.generate(**kwargs))
+
+    def render(self, mold_id, data):
+        """
+        Return the mold rendered with the data, without the wrapper.
+        """
+
+        return self.load_mold(mold_id).render(**data)
+
+
+# the Renderer of the worker processes of a ProcessPoolRenderer.
+_worker_renderer = None
+
+
+def _init_worker(registry_name, preload):
+    global _worker_renderer
+    _worker_renderer = Renderer(registry_name)
+    if preload:
+        _worker_renderer.preload()
+
+
+def _execute(mold_id, data, wrapper_tag):
+    return _worker_renderer.execute(mold_id, data, wrapper_tag)
+
+
+class ProcessPoolRenderer(BaseRenderer):
+    """
+    Render molds in a pool of worker processes, each with their own
+    Renderer for the registry, such that rendering is not serialized
+    by the interpreter lock of the process serving the requests.  Only
+    the mold id and the data are sent to the workers.
+    """
+
+    def __init__(
+            self, registry_name=ENTRY_POINT_NAME, processes=None,
+            preload=True):
+        """
+        Arguments
+
+        registry_name
+            The name of the mold registry for the workers.
+        processes
+            The number of worker processes; defaults to the number of
+            processors.
+        preload
+            If True, the workers compile the templates of all the molds
+            in the registry as they are started.
+        """
+
+        self.registry_name = registry_name
+        self.pool = Pool(processes, _init_worker, (registry_name, preload))
+
+    def execute(self, mold_id, data, wrapper_tag='div'):
+        # exceptions raised by the workers are raised here.
+        return self.pool.apply(_execute, (mold_id, data, wrapper_tag))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -7,7 +7,10 @@ The goal is to provide a live-reloading server implementation for usage
 during the development phase of a given library.
 """
 
+import json
 import logging
+from hashlib import sha1
+from os.path import splitext
 
 from calmjs.utils import json_dumps
 from calmjs.registry import get
@@ -16,6 +19,12 @@ from calmjs.rjs.umdjs import UMD_REQUIREJS_JSON_EXPORT_FOOTER
 from nunja.registry import ENTRY_POINT_NAME
 
 from nunja.serve import base
+from nunja.serve.cache import Content
+from nunja.serve.cache import load
+from nunja.serve.cache import stat_key
+from nunja.serve.watch import EVENTS_SUBPATH
+from nunja.serve.watch import live_reload_script
+from nunja.serve.watch import make_watcher
 
 logger = logging.getLogger(__name__)
 
@@ -26,12 +35,89 @@ default_init_script = """'use strict';
 require(['nunja/index'], function() {});
 """
 
+# the subpath for the bundles of the molds.
+BUNDLE_PREFIX = '_bundle/'
 
-def make_config(base_url, registry_names=(ENTRY_POINT_NAME,)):
+# the length of the fingerprints for molds.
+FINGERPRINT_LENGTH = 12
+
+# for responses with fingerprinted urls, which never change.
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+# for the configuration that reference the fingerprinted urls.
+CACHE_REVALIDATE = 'no-cache'
+
+# Templates are provided as the string values of the modules that will
+# be produced by the requirejs text plugin.
+bundle_template = """define(%s, [], function() {
+    return %s;
+});
+"""
+
+# Scripts from molds are anonymous modules, so the global define is
+# shadowed by one that will provide the name.
+bundle_script = """(function(define) {
+%s
+}((function(name) {
+    var named = function() {
+        var args = Array.prototype.slice.call(arguments);
+        if (typeof args[0] !== 'string') {
+            args.unshift(name);
+        }
+        return define.apply(this, args);
+    };
+    named.amd = define.amd;
+    return named;
+}(%s))));
+"""
+
+
+def iter_mold_records(registry_names=(ENTRY_POINT_NAME,)):
+    """
+    Yield the registry name, mold_id and the mapping of module names to
+    paths for all the molds in the registries.
+    """
+
+    for name in registry_names:
+        registry = get(name)
+        if not registry:
+            continue
+
+        for mold_id, mapping in registry.iter_records():
+            # records not keyed by a mold_id are the discarded files
+            # that are not part of any molds.
+            if '/' not in mold_id:
+                continue
+            yield name, mold_id, mapping
+
+
+def make_bundle(modules):
+    """
+    Return a requirejs bundle for the list of module name and source
+    text pairs.  Module names with a plugin prefix (i.e. 'text!') are
+    templates.
+    """
+
+    return ''.join(
+        bundle_template % (json.dumps(name), json.dumps(text))
+        if '!' in name else
+        bundle_script % (text, json.dumps(name))
+        for name, text in modules
+    )
+
+
+def make_config(
+        base_url, registry_names=(ENTRY_POINT_NAME,), bundles=False,
+        fingerprints=None):
     """
     Return a configuration for requirejs to function against some end
     point.
 
+    If bundles is True, the modules of each of the molds will be loaded
+    through the bundle for the mold.
+
+    If fingerprints are provided, as returned by make_fingerprints, the
+    paths for the molds will have the fingerprint appended.
+
     Do note that this implementation is geared towards development
     servers, and not for production usage.
 
@@ -39,6 +125,7 @@ def make_config(base_url, registry_names=(ENTRY_POINT_NAME,)):
     """
 
     paths = {}
+    fingerprints = fingerprints or {}
 
     for name in registry_names:
         registry = get(name)
@@ -49,16 +136,111 @@ def make_config(base_url, registry_names=(ENTRY_POINT_NAME,)):
         for key, value in registry.iter_records():
             # will simply overwrite with subsequent keys, much like how
             # the rest of the calmjs framework functions.
-            paths[key] = name + '/' + key
+            path = name + '/' + key
+            if path in fingerprints:
+                path += '.' + fingerprints[path]
+            paths[key] = path
 
     template = {
         "paths": paths,
         "baseUrl": base_url,
     }
 
+    if bundles:
+        template['bundles'] = {
+            BUNDLE_PREFIX + mold_id: sorted(mapping.keys())
+            for name, mold_id, mapping in iter_mold_records(registry_names)
+        }
+
     return template
 
 
+def to_mold_id_path(key, path):
+    """
+    Convert a module name from a registry record, such as the ones
+    that are prefixed by the requirejs text plugin or the ones with the
+    implied '.js' filename extension omitted, to the mold_id_path of
+    the file at path.
+    """
+
+    mold_id_path = key.split('!', 1)[-1]
+    ext = splitext(path)[1]
+    if not mold_id_path.endswith(ext):
+        mold_id_path += ext
+    return mold_id_path
+
+
+def make_index(registry_names=(ENTRY_POINT_NAME,)):
+    """
+    Return a dict that map every identifier for the files provided by
+    the molds in the registries to their filesystem paths.
+
+    Identifiers are in the form of 'registry_name/mold_id/filename',
+    which is the same form as accepted by Provider.fetch_path.
+    """
+
+    index = {}
+
+    for name, mold_id, mapping in iter_mold_records(registry_names):
+        for key, path in mapping.items():
+            index[name + '/' + to_mold_id_path(key, path)] = path
+
+    return index
+
+
+def make_bundle_index(registry_names=(ENTRY_POINT_NAME,)):
+    """
+    Return a dict that map every mold_id to the mapping of the module
+    names to the paths for the files that make up the mold, for the
+    production of bundles.
+    """
+
+    return {
+        mold_id: mapping
+        for name, mold_id, mapping in iter_mold_records(registry_names)
+    }
+
+
+def make_fingerprints(registry_names=(ENTRY_POINT_NAME,), loader=load):
+    """
+    Return a dict that map the 'registry_name/mold_id' for every mold to
+    a fingerprint derived from the contents of all its files, which are
+    read using the loader.
+    """
+
+    fingerprints = {}
+
+    for name, mold_id, mapping in iter_mold_records(registry_names):
+        digest = sha1()
+        for key in sorted(mapping):
+            digest.update(key.encode('utf8'))
+            digest.update(loader(mapping[key]).etag.encode('utf8'))
+        fingerprints[name + '/' + mold_id] = digest.hexdigest()[
+            :FINGERPRINT_LENGTH]
+
+    return fingerprints
+
+
+def make_fingerprint_keys(registry_names=(ENTRY_POINT_NAME,)):
+    """
+    Return a dict that map the 'registry_name/mold_id' for every mold to
+    the dict of the paths of its files to their current stat_key, for
+    finding out whether a mold was modified since it was fingerprinted.
+    """
+
+    keys = {}
+
+    for name, mold_id, mapping in iter_mold_records(registry_names):
+        stats = keys[name + '/' + mold_id] = {}
+        for path in mapping.values():
+            try:
+                stats[path] = stat_key(path)
+            except OSError:
+                stats[path] = None
+
+    return keys
+
+
 def get_path(registry_name, mold_id_path):
     registry = get(registry_name)
     if not registry:
@@ -84,19 +266,95 @@ class Provider(base.BaseProvider):
             core_subpaths=('config.js', 'init.js',),
             init_script=default_init_script,
             registry_names=(ENTRY_POINT_NAME,),
-            ):
+            bundles=False,
+            fingerprint=False,
+            watch=False,
+            **kw):
+        """
+        Arguments as per BaseProvider, with the addition of
+
+        init_script
+            The contents for init.js.
+        bundles
+            If True, configure requirejs to load the modules of each
+            mold through its bundle, served at the BUNDLE_PREFIX
+            subpath (i.e. '_bundle/<mold_id>.js').  Bundles are served
+            regardless of this setting.
+        fingerprint
+            If True, the paths for the molds in the configuration will
+            have a fingerprint of their contents appended, such that
+            the files under them may be cached by clients indefinitely.
+            The configuration will have to be revalidated, and the
+            provider refreshed whenever the molds are changed.
+        watch
+            If True, start a watcher for the files of the molds, which
+            will invalidate the cached contents of the changed files and
+            broadcast them as server-sent events at the EVENTS_SUBPATH
+            (i.e. '_events'), for the script appended to init.js to load
+            the changed modules again.  Alternatively, a dict of keyword
+            arguments for make_watcher.
+
+        Any other keyword arguments will be passed to BaseProvider.
+        """
+
         super(Provider, self).__init__(
-            base_url, core_subpaths, registry_names)
+            base_url, core_subpaths, registry_names, **kw)
 
+        if watch:
+            init_script += live_reload_script % json.dumps(
+                base_url + EVENTS_SUBPATH)
         self.init_script = init_script
-        self.requirejs_config = make_config(self.base_url, self.registry_names)
-
-        self.core_subpaths = dict(zip(
-            core_subpaths, [self.build_config(), init_script]))
+        self.core_names = tuple(core_subpaths)
+        self.bundles_enabled = bundles
+        self.fingerprint = fingerprint
+        self.refresh()
+        self.watcher = None
+        if watch:
+            self.watcher = make_watcher(
+                self, **(watch if isinstance(watch, dict) else {})).start()
 
     def fetch_core(self, identifier):
         return self.core_subpaths[identifier]
 
+    def fetch_content(self, identifier):
+        content = self.core_contents.get(identifier)
+        if content is not None:
+            return content
+        if identifier.startswith(BUNDLE_PREFIX) and identifier.endswith(
+                '.js'):
+            return self.fetch_bundle(identifier[len(BUNDLE_PREFIX):-3])
+        return super(Provider, self).fetch_content(identifier)
+
+    def fetch_bundle(self, mold_id):
+        """
+        Return the Content of the bundle for the mold.  The bundle will
+        be rebuilt whenever any of the files of the mold changed.
+        """
+
+        mapping = self.bundle_index.get(mold_id)
+        if mapping is None:
+            raise KeyError("mold '%s' not found" % mold_id)
+
+        names = sorted(mapping)
+        try:
+            keys = [stat_key(mapping[name]) for name in names]
+            keys_, content = self.bundles.get(mold_id, (None, None))
+            if keys == keys_:
+                return content
+            content = Content(make_bundle(
+                (name, self._load(mapping[name]).text) for name in names
+            ).encode('utf8'), mtime=max([key[0] for key in keys] or [None]))
+        except (IOError, OSError):
+            raise KeyError("mold '%s' could not be read" % mold_id)
+
+        self.bundles[mold_id] = keys, content
+        return content
+
+    def _load(self, path):
+        if self.cache is None:
+            return load(path)
+        return self.cache.get(path)
+
     def build_config(self):
         return (
             UMD_REQUIREJS_JSON_EXPORT_HEADER +
@@ -104,11 +362,96 @@ class Provider(base.BaseProvider):
             UMD_REQUIREJS_JSON_EXPORT_FOOTER
         )
 
+    def refresh(self):
+        """
+        Rebuild the index of identifiers to paths, the index for the
+        bundles, the fingerprints and the configuration from the
+        registries, for when their records have been changed.
+        """
+
+        self.index = make_index(self.registry_names)
+        # the paths resolved through the registries for the identifiers
+        # not in the index, such that the lookups are not repeated.
+        self.resolved = {}
+        self.bundle_index = make_bundle_index(self.registry_names)
+        self.bundles = {}
+        # taken before the files are read for the fingerprints, such
+        # that any modification in between is still noticed.
+        self.fingerprint_keys = make_fingerprint_keys(
+            self.registry_names) if self.fingerprint else {}
+        self.fingerprints = make_fingerprints(
+            self.registry_names, self._load) if self.fingerprint else {}
+        self.requirejs_config = make_config(
+            self.base_url, self.registry_names, bundles=self.bundles_enabled,
+            fingerprints=self.fingerprints)
+
+        self.core_subpaths = dict(zip(
+            self.core_names, [self.build_config(), self.init_script]))
+        self.core_contents = {
+            key: Content(value.encode('utf8'))
+            for key, value in self.core_subpaths.items()
+        }
+
+    def split_fingerprint(self, identifier):
+        """
+        Return the identifier with the fingerprint removed, the key for
+        the mold in the fingerprints, and the fingerprint.  If the
+        identifier is not fingerprinted, the latter two will be None.
+        """
+
+        fragments = identifier.split('/', 3)
+        if len(fragments) == 4:
+            basename, _, fingerprint = fragments[2].rpartition('.')
+            mold = '/'.join(fragments[:2] + [basename])
+            if basename and mold in self.fingerprints:
+                return mold + '/' + fragments[3], mold, fingerprint
+        return identifier, None, None
+
+    def cache_control(self, identifier):
+        if not self.fingerprints:
+            return None
+        if identifier in self.core_contents:
+            return CACHE_REVALIDATE
+        identifier, mold, fingerprint = self.split_fingerprint(identifier)
+        # only the current version is immutable.
+        if mold and self.fingerprints[mold] == fingerprint:
+            if self.is_fingerprint_current(mold):
+                return CACHE_IMMUTABLE
+            # modified since, so the contents may not match it until the
+            # provider is refreshed.
+            return CACHE_REVALIDATE
+        return None
+
+    def is_fingerprint_current(self, mold):
+        """
+        Return True if none of the files of the mold were modified since
+        its fingerprint was produced.
+        """
+
+        for path, key in self.fingerprint_keys.get(mold, {}).items():
+            try:
+                if stat_key(path) != key:
+                    return False
+            except OSError:
+                return False
+        return True
+
     def fetch_path(self, identifier):
         """
         Return the path of the source identified by the identifier.
+
+        Identifiers found in the index are returned directly, otherwise
+        the registry will be queried, with the resolved path kept until
+        the provider is refreshed.
         """
 
+        if self.fingerprints:
+            identifier = self.split_fingerprint(identifier)[0]
+
+        path = self.index.get(identifier) or self.resolved.get(identifier)
+        if path is not None:
+            return path
+
         # grab the first fragment
         fragments = identifier.split('/', 1)
         if len(fragments) < 2:
@@ -119,4 +462,6 @@ class Provider(base.BaseProvider):
         if registry_name not in self.registry_names:
             raise KeyError("registry '%s' unavailable" % registry_name)
 
-        return get_path(registry_name, mold_id_path)
+        path = self.resolved[identifier] = get_path(
+            registry_name, mold_id_path)
+        return path
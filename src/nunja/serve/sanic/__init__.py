@@ -2,41 +2,284 @@
 """
 This provide integration with sanic.
 
+The responses are produced in an executor, as the resolution of the
+identifiers that are not indexed and the reading of the files may block,
+such that the loop is never held up by the filesystem; the files that
+are large are streamed from the filesystem instead of being read.
+
 Requires Python 3.5+
 """
 
+import asyncio
+import os
+from email.utils import formatdate
+from timeit import default_timer
+
 from sanic import response
 from sanic.router import REGEX_TYPES
 
 from nunja.serve import rjs
+from nunja.serve.base import BATCH_SUBPATH
+from nunja.serve.base import METRICS_SUBPATH
+from nunja.serve.base import Response
+from nunja.serve.base import bad_request
+from nunja.serve.base import guess_type
+from nunja.serve.base import is_not_modified
+from nunja.serve.base import normalize
+from nunja.serve.base import parse_batch
+from nunja.serve.base import to_bytes
+from nunja.serve.render import RENDER_PREFIX
+from nunja.serve.render import STREAM_PREFIX
+from nunja.serve.watch import EVENTS_HEADERS
+from nunja.serve.watch import EVENTS_SUBPATH
+from nunja.serve.watch import EventsForwarder
 
 # Sanic 0.5.2 introduced the path type, however it also has additional
 # support discerning the root parameter, so there is a bit of difference
 # between the pattern we are patching for <=0.5.1.
 REGEX_TYPES['path'] = REGEX_TYPES.get('path', (str, r'[^/]?.*?'))
 
+# files of at least this many bytes are streamed from the filesystem.
+STREAM_THRESHOLD = 1048576
+STREAM_CHUNK_SIZE = 65536
+
+
+def to_response(result):
+    """
+    Convert the Response produced by the provider to a sanic response.
+    """
+
+    headers = dict(result.headers)
+    content_type = headers.pop('Content-Type', 'text/plain')
+    # sanic provides the length.
+    headers.pop('Content-Length', None)
+    return response.raw(
+        to_bytes(result.body), status=result.status, headers=headers,
+        content_type=content_type)
+
 
 class SanicMixin(object):
     """
     The base mixin for combining with a provider implementation.
     """
 
-    async def serve(self, request, identifier):  # noqa: E999
+    def __init__(
+            self, *a, executor=None, concurrency=None,  # noqa: E999
+            stream_threshold=STREAM_THRESHOLD, **kw):
+        """
+        Arguments as per the provider, with the addition of
+
+        executor
+            The executor for producing the responses; defaults to the
+            default executor of the loop.
+        concurrency
+            The maximum number of responses being produced at a time,
+            with the requests beyond that waiting for their turn; if
+            not provided, the requests are only limited by the executor.
+        stream_threshold
+            The size in bytes from which the files are streamed from
+            the filesystem, without compression, rather than being read
+            into memory; if None, files are never streamed.
+        """
+
+        super(SanicMixin, self).__init__(*a, **kw)
+        self.executor = executor
+        self.concurrency = concurrency
+        self.stream_threshold = stream_threshold
+        self.limit = None
+
+    def start(self, app, loop):
+        # the semaphore must be created within the loop of the server.
+        if self.concurrency:
+            self.limit = asyncio.Semaphore(self.concurrency)
+
+    async def run(self, func, *args):
+        """
+        Run the func with the args in the executor, within the limit of
+        the concurrency.
+        """
+
+        loop = asyncio.get_event_loop()
+        if self.limit is None:
+            return await loop.run_in_executor(self.executor, func, *args)
+        async with self.limit:
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def respond_streamed(self, identifier, headers={}):
+        """
+        Produce the Response for the identifier as per respond, except
+        for the files of at least the stream_threshold in size, which
+        are not read; the Response will only have the path of the file
+        for the file to be streamed.  Its validators are the ones of the
+        contents if they are already in the cache, as they would be for
+        the other adapters; otherwise the file is not read for them, so
+        the entity tag is a weak one derived from the modification time
+        and the size of the file.
+        """
+
+        if self.stream_threshold is None or self.offload is not None:
+            return self.respond(identifier, headers)
+
+        start = default_timer()
+        identifier = normalize(identifier)
         if identifier in self.core_subpaths:
-            return response.text(self.fetch_core(identifier), headers={
-                'Content-Type': 'application/javascript',
-            })
+            return self.respond(identifier, headers)
         try:
             path = self.fetch_path(identifier)
-        except KeyError:
-            return response.text('404 NOT FOUND', status=404)
-        return await response.file(path)
+            st = os.stat(path)
+        except (KeyError, NotImplementedError, OSError):
+            return self.respond(identifier, headers)
+        if st.st_size < self.stream_threshold:
+            return self.respond(identifier, headers)
+
+        content = None
+        if self.cache is not None:
+            content = self.cache.peek(
+                path, (st.st_mtime, st.st_size, st.st_ino))
+        if content is not None:
+            etag, mtime = content.etag, content.mtime
+        else:
+            etag, mtime = 'W/"%x-%x"' % (
+                int(st.st_mtime), st.st_size), st.st_mtime
+        response_headers = {
+            'Content-Type': guess_type(identifier),
+            'ETag': etag,
+            'Last-Modified': formatdate(mtime, usegmt=True),
+        }
+        cache_control = self.cache_control(identifier)
+        if cache_control:
+            response_headers['Cache-Control'] = cache_control
+        if is_not_modified(headers, etag, mtime):
+            return self.record(Response(304, response_headers), start)
+        response_headers['Content-Length'] = str(st.st_size)
+        return self.record(
+            Response(200, response_headers, path=path), start)
+
+    async def serve(self, request, identifier):
+        result = await self.run(
+            self.respond_streamed, identifier, request.headers)
+        if result.status != 200 or result.path is None or result.body:
+            return to_response(result)
+        headers = dict(result.headers)
+        content_type = headers.pop('Content-Type')
+        # the length is marked by the chunks as they are streamed.
+        headers.pop('Content-Length', None)
+        return await response.file_stream(
+            result.path, chunk_size=STREAM_CHUNK_SIZE, headers=headers,
+            mime_type=content_type)
+
+    async def serve_batch(self, request):
+        try:
+            identifiers = parse_batch(
+                request.query_string, request.body, self.batch_limit)
+        except ValueError as e:
+            return to_response(bad_request(str(e)))
+
+        start = default_timer()
+        results = await asyncio.gather(*[
+            self.run(self._fetch_batch_item, identifier)
+            for identifier in identifiers
+        ])
+        return to_response(self.record(self.respond_results(
+            dict(results), request.headers), start))
+
+    async def serve_metrics(self, request):
+        return to_response(self.respond_metrics())
+
+    async def serve_render(self, request, mold_id):
+        # rendering is bound by the processor, so not in the loop; with
+        # a ProcessPoolRenderer the thread only waits for the result.
+        return to_response(await self.run(
+            self.respond_render, mold_id, request.body, request.headers))
+
+    async def serve_stream(self, request, mold_id):
+        loop = asyncio.get_event_loop()
+        result = await self.run(
+            self.respond_render_stream, mold_id, request.body,
+            request.headers)
+        if result.chunks is None:
+            return to_response(result)
+        headers = dict(result.headers)
+        content_type = headers.pop('Content-Type')
+
+        async def stream(stream_response):
+            chunks = result.chunks
+            try:
+                while True:
+                    # the chunks are rendered as they are produced.
+                    chunk = await loop.run_in_executor(
+                        self.executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                    await stream_response.write(chunk)
+            finally:
+                try:
+                    chunks.close()
+                except ValueError:
+                    # still being rendered by the executor.
+                    pass
+
+        return response.stream(
+            stream, status=result.status, headers=headers,
+            content_type=content_type)
+
+    async def serve_events(self, request):
+        loop = asyncio.get_event_loop()
+        headers = dict(EVENTS_HEADERS)
+        content_type = headers.pop('Content-Type')
+
+        async def stream(stream_response):
+            queue = asyncio.Queue()
+
+            def callback(chunk):
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+                except RuntimeError:
+                    # the loop is closed.
+                    pass
+
+            # waiting on the events blocks, so that is done by a thread
+            # of its own for every stream rather than by the executor,
+            # such that the streams do not starve the other requests.
+            forwarder = EventsForwarder(self.watcher, callback)
+            forwarder.start()
+            try:
+                while True:
+                    chunk = await queue.get()
+                    if chunk is None:
+                        break
+                    await stream_response.write(chunk)
+            finally:
+                forwarder.stop()
+
+        return response.stream(
+            stream, headers=headers, content_type=content_type)
 
     def setup(self, app):
         """
         Set up the app with routes.
         """
 
+        app.listener('before_server_start')(self.start)
+
+        app.add_route(
+            self.serve_batch, self.base_url + BATCH_SUBPATH,
+            methods=['GET', 'POST'])
+        if self.metrics is not None:
+            app.add_route(
+                self.serve_metrics, self.base_url + METRICS_SUBPATH)
+        if getattr(self, 'watcher', None) is not None:
+            app.add_route(
+                self.serve_events, self.base_url + EVENTS_SUBPATH)
+        if self.renderer is not None:
+            app.add_route(
+                self.serve_render,
+                self.base_url + RENDER_PREFIX + '<mold_id:path>',
+                methods=['GET', 'POST'])
+            app.add_route(
+                self.serve_stream,
+                self.base_url + STREAM_PREFIX + '<mold_id:path>',
+                methods=['GET', 'POST'])
         app.add_route(self.serve, self.base_url + '<identifier:path>')
 
     def __call__(self, app):
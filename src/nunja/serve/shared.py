@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+A content store backed by a memory mapped file, for sharing the contents
+of the files served (along with their compressed variants) between the
+worker processes of a server, such that they are not held by each of
+them separately.
+
+The store file has the contents laid out one after another, followed by
+a table that map each of the source paths to the offsets and lengths of
+its contents and variants; the offset of the table is in the header.  A
+store is never modified once written; a new one is written in its place
+with the current contents of the files whenever any of them changed, and
+the processes will map the new one as they find out.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from os.path import basename
+from os.path import dirname
+from os.path import exists
+from tempfile import mkstemp
+
+from nunja.serve.cache import Content
+from nunja.serve.cache import load
+from nunja.serve.cache import stat_key
+
+try:  # pragma: no cover
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'NJSTORE1'
+# the magic followed by the offset of the table.
+HEADER = struct.Struct('!8sQ')
+
+replace = getattr(os, 'replace', os.rename)
+
+
+class SharedContent(Content):
+    """
+    A Content with the data and the variants as memoryviews into the
+    store, which will not be copied unless it is decoded.
+    """
+
+    @property
+    def text(self):
+        return self.data.tobytes().decode('utf8')
+
+    def variant(self, coding, precompressed=False):
+        if coding in self.variants:
+            return self.variants[coding]
+        # produced privately for the codings not in the store.
+        data = Content(self.data.tobytes(), self.key, self.path)
+        self.variants[coding] = data.variant(coding, precompressed)
+        return self.variants[coding]
+
+
+def write_store(target, paths, encodings=(), precompressed=False):
+    """
+    Write a new store with the contents of the files at paths along with
+    their variants for the encodings to target, which is replaced as a
+    whole once done.  Files that cannot be read are skipped.  Return the
+    table of the store.
+    """
+
+    fd, tmp = mkstemp(dir=dirname(target), prefix='.' + basename(target))
+    table = {}
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(HEADER.pack(MAGIC, 0))
+            offset = HEADER.size
+            for path in sorted(set(paths)):
+                try:
+                    content = load(path)
+                except (IOError, OSError):
+                    continue
+                variants = {}
+                record = [
+                    list(content.key), content.etag, offset,
+                    len(content.data), variants,
+                ]
+                stream.write(content.data)
+                offset += len(content.data)
+                for coding in encodings:
+                    data = content.variant(coding, precompressed)
+                    if not data:
+                        # not worth encoding with the coding.
+                        variants[coding] = None
+                        continue
+                    variants[coding] = [offset, len(data)]
+                    stream.write(data)
+                    offset += len(data)
+                table[path] = record
+            stream.write(json.dumps(table).encode('utf8'))
+            stream.seek(0)
+            stream.write(HEADER.pack(MAGIC, offset))
+        replace(tmp, target)
+    except Exception:
+        if exists(tmp):
+            os.remove(tmp)
+        raise
+    return table
+
+
+def read_store(target):
+    """
+    Return the memory map of the store at target, its table and the
+    stat_key of the store itself.
+    """
+
+    with open(target, 'rb') as stream:
+        # of the file opened, in case it has been replaced since.
+        st = os.fstat(stream.fileno())
+        key = (st.st_mtime, st.st_size, st.st_ino)
+        mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, offset = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        raise ValueError("'%s' is not a content store" % target)
+    table = json.loads(mapped[offset:].decode('utf8'))
+    return mapped, table, key
+
+
+class SharedContentStore(object):
+    """
+    The memory mapped store of contents, for use in place of the cache
+    of a provider.  The contents are looked up by the path of the file
+    like the ContentCache, with the file checked for modification on
+    every lookup; the contents of the modified files are read from the
+    filesystem while a new store is written in the background.
+
+    The store should be built by the parent process before the workers
+    are forked.
+    """
+
+    def __init__(self, target, paths=(), encodings=(), precompressed=False):
+        """
+        Arguments
+
+        target
+            The path of the store file.
+        paths
+            The paths of the files to build the store with; if none
+            are provided, the existing store at target will be used.
+        encodings
+            The content codings for the variants to include.
+        precompressed
+            If True, use the precompressed siblings of the files for the
+            variants where available.
+        """
+
+        self.target = target
+        self.encodings = tuple(encodings)
+        self.precompressed = precompressed
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self._lock = threading.Lock()
+        self._rebuilding = None
+        self.key = None
+        if paths or not exists(target):
+            self.build(paths)
+        self.attach()
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, path):
+        return path in self.table
+
+    def build(self, paths):
+        """
+        Write a new store for the files at paths.
+        """
+
+        write_store(
+            self.target, paths, self.encodings, self.precompressed)
+
+    def attach(self):
+        """
+        Map the current store, if it is not already mapped.
+        """
+
+        key = stat_key(self.target)
+        if self.key == key:
+            return False
+        mapped, table, key = read_store(self.target)
+        with self._lock:
+            # the previous map is released once the contents from it are
+            # no longer referenced.
+            self.mapped = mapped
+            self.view = memoryview(mapped)
+            self.table = table
+            self.key = key
+            self.contents = {}
+        return True
+
+    def _lookup(self, path, key):
+        with self._lock:
+            record = self.table.get(path)
+            if record is None or tuple(record[0]) != key:
+                return None
+            content = self.contents.get(path)
+            if content is not None:
+                return content
+            key, etag, offset, length, variants = record
+            view = self.view
+            content = SharedContent(
+                view[offset:offset + length], tuple(key), path)
+            content._etag = etag
+            for coding, item in variants.items():
+                content.variants[coding] = item and view[
+                    item[0]:item[0] + item[1]]
+            self.contents[path] = content
+            return content
+
+    def peek(self, path, key):
+        """
+        Return the Content for the file at path from the store if it is
+        of the version of the key, otherwise None; the file is never
+        read.
+        """
+
+        return self._lookup(path, key)
+
+    def get(self, path):
+        """
+        Return the Content for the file at path, from the store if its
+        contents there are current; otherwise the file is read, and a
+        new store is written in the background.
+        """
+
+        key = stat_key(path)
+        content = self._lookup(path, key)
+        if content is None and self.attach():
+            # another process has written a new store in the meantime.
+            content = self._lookup(path, key)
+        if content is not None:
+            self.hits += 1
+            return content
+        self.misses += 1
+        self.rebuild(path)
+        return load(path)
+
+    def rebuild(self, path=None):
+        """
+        Write a new store in a background thread, which will include the
+        file at path, unless one is already being written.
+        """
+
+        with self._lock:
+            if self._rebuilding is not None:
+                return None
+            paths = set(self.table)
+            if path is not None:
+                paths.add(path)
+            self._rebuilding = threading.Thread(
+                target=self._rebuild, args=(paths,))
+            self._rebuilding.daemon = True
+            self._rebuilding.start()
+            return self._rebuilding
+
+    def _rebuild(self, paths):
+        try:
+            with open(self.target + '.lock', 'a') as lock:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except (IOError, OSError):
+                        # being written by another process.
+                        return
+                self.build(paths)
+                self.rebuilds += 1
+            self.attach()
+        except Exception:
+            logger.exception("failed to rebuild '%s'", self.target)
+        finally:
+            self._rebuilding = None
+
+    def update(self, content):
+        """
+        The contents of the store are never modified.
+        """
+
+    def invalidate(self, path):
+        """
+        Write a new store, as the file at path was changed.
+        """
+
+        if path not in self.table:
+            return False
+        self.rebuild()
+        return True
+
+    def clear(self):
+        self.rebuild()
+
+    def stats(self):
+        """
+        Return a dict of the counters for this store.
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': 0,
+            'rebuilds': self.rebuilds,
+            'entries': len(self.table),
+            'bytes': len(self.mapped),
+        }
@@ -10,17 +10,44 @@ if the option is set, Python scripts will be executed for the generation
 of templates.
 """
 
+import os
 import sys
 import posixpath
+import threading
+import time
+from select import select
+from functools import partial
 from io import BytesIO
 from os import getcwd
 from os.path import exists
 from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from types import MethodType
 
 from nunja.registry import ENTRY_POINT_NAME
+from nunja.serve.base import open_body_file
+from nunja.serve.base import respond_nunja
 from nunja.serve.compat import HTTPServer
 from nunja.serve.compat import CGIHTTPRequestHandler
+from nunja.serve.compat import Queue
+from nunja.serve.offload import Offload
+from nunja.serve.offload import headers as offload_headers
+from nunja.serve.offload import parse_mapping
+from nunja.serve.render import ProcessPoolRenderer
+from nunja.serve.render import Renderer
+from nunja.serve.shared import SharedContentStore
+from nunja.serve.simple.scripts import ScriptRunner
+from nunja.serve.watch import EVENTS_HEADERS
+from nunja.serve.watch import EVENTS_SUBPATH
+from nunja.serve.watch import iter_events
+
+# the seconds an idle persistent connection is kept open for.
+KEEPALIVE_TIMEOUT = 15
+
+# the interval in seconds an idle persistent connection is checked for
+# whether its worker is needed by the other connections.
+KEEPALIVE_POLL = 0.05
 
 
 def normpath(path):
@@ -59,6 +86,36 @@ def _is_cgi(path):
     return False, '/'.join(resolved), query
 
 
+class ChunkedReader(object):
+    """
+    A file-like object for the copying of an iterator of chunks, which
+    are framed for the chunked transfer coding if chunked is True.
+    """
+
+    def __init__(self, chunks, chunked=True):
+        self.chunks = chunks
+        self.chunked = chunked
+        self.done = False
+
+    def read(self, size=-1):
+        if self.done:
+            return b''
+        for chunk in self.chunks:
+            if not chunk:
+                # an empty chunk would end the body.
+                continue
+            if not self.chunked:
+                return chunk
+            return ('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n'
+        self.done = True
+        return b'0\r\n\r\n' if self.chunked else b''
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
 class NunjaHTTPRequestHandler(CGIHTTPRequestHandler):
     """
     Same as simple HTTP request heandler for serving local files, but
@@ -68,18 +125,86 @@ class NunjaHTTPRequestHandler(CGIHTTPRequestHandler):
 
     def __init__(
             self, request, client_address, server,
-            nunja_prefix, provider):
+            nunja_prefix, provider, protocol_version=None, scripts=None):
         """
         In addition to the request, client_address and server arguments,
         nunja also need to know the prefix, have an instance of the js
-        provider.
+        provider.  The protocol_version may be specified as "HTTP/1.1"
+        for persistent connections.  If a ScriptRunner is provided as
+        scripts, Python scripts will be run in-process by it instead of
+        as CGI scripts.
         """
 
         self.nunja_prefix = nunja_prefix
         self.provider = provider
+        self.scripts = scripts
+        if protocol_version is not None:
+            self.protocol_version = protocol_version
+            if protocol_version >= 'HTTP/1.1':
+                # do not let idle connections be held open forever.
+                self.timeout = KEEPALIVE_TIMEOUT
+                # the headers and the body are written separately, so
+                # the body must not wait for the ack of the headers.
+                self.disable_nagle_algorithm = True
         CGIHTTPRequestHandler.__init__(
             self, request, client_address, server)
 
+    def handle(self):
+        """
+        Handle the requests on the connection, with the connection
+        released from the worker whenever it is idle while there are
+        other connections waiting for a worker of the server.
+        """
+
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_request():
+            self.handle_one_request()
+
+    def wait_request(self):
+        """
+        Wait for the next request on the persistent connection.  Return
+        False if the connection is to be closed, as it has been idle for
+        the timeout, or as the server has other connections waiting.
+        """
+
+        if self.buffered():
+            # already sent along with the previous request.
+            return True
+        waiting = getattr(self.server, 'waiting', None)
+        deadline = time.time() + (self.timeout or KEEPALIVE_TIMEOUT)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            # polled before the check for the waiting connections, such
+            # that a client that follow up right away is not cut off.
+            if select([self.connection], [], [], min(
+                    remaining, KEEPALIVE_POLL))[0]:
+                return True
+            if waiting is not None and waiting():
+                return False
+
+    def buffered(self):
+        """
+        Return True if there is data of the next request that has been
+        read from the connection but not yet handled.
+        """
+
+        peek = getattr(self.rfile, 'peek', None)
+        if peek is None:
+            # not buffered (as rbufsize is 0), except for the lines read
+            # by the socket file object on Python 2.
+            rbuf = getattr(self.rfile, '_rbuf', None)
+            return bool(rbuf is not None and rbuf.tell())
+        self.connection.settimeout(0.0)
+        try:
+            return bool(peek(1))
+        except (IOError, OSError):
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
     def is_cgi(self):
         """
         Doing the somewhat dangerous thing of permitting _any_ Python
@@ -114,25 +239,199 @@ class NunjaHTTPRequestHandler(CGIHTTPRequestHandler):
             return True
         return CGIHTTPRequestHandler.is_cgi(self)
 
+    def run_cgi(self):
+        if self.scripts is not None and self.path.endswith('.py'):
+            return self.run_script()
+        # the output of scripts is not delimited by a Content-Length,
+        # so the connection must be closed for the response to end.
+        self.close_connection = True
+        return CGIHTTPRequestHandler.run_cgi(self)
+
+    def run_script(self):
+        """
+        Run the Python script for the current request in-process.
+        """
+
+        query = self.cgi_info[1].partition('?')[2]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        response = self.scripts.run(
+            join(getcwd(), *self.path.split('/')),
+            self.script_environ(query, body), body)
+        source = self.send_nunja(response)
+        try:
+            if self.command != 'HEAD':
+                self.copyfile(source, self.wfile)
+        finally:
+            source.close()
+
+    def script_environ(self, query, body):
+        """
+        Return the CGI environment variables for the current request.
+        """
+
+        host, port = self.server.server_address[:2]
+        environ = {
+            'SERVER_SOFTWARE': self.version_string(),
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': self.protocol_version,
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': self.path,
+            'PATH_INFO': '',
+            'QUERY_STRING': query,
+            'REMOTE_ADDR': self.client_address[0],
+            'CONTENT_TYPE': self.headers.get('Content-Type') or '',
+            'CONTENT_LENGTH': str(len(body)),
+        }
+        for key, value in self.headers.items():
+            key = key.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ['HTTP_' + key] = value
+        return environ
+
     def send_head(self):
         if not self.path.startswith(self.nunja_prefix + '/'):
             return CGIHTTPRequestHandler.send_head(self)
             # TODO maybe have an option to merge the two "trees"?
 
+        watcher = getattr(self.provider, 'watcher', None)
+        if watcher is not None and self.provider.to_identifier(
+                self.path.partition('?')[0]) == EVENTS_SUBPATH:
+            return self.send_events(watcher)
+        return self.send_nunja(self.respond_nunja())
+
+    def send_events(self, watcher):
+        """
+        Stream the server-sent events from the watcher, until either the
+        client disconnects or the watcher is stopped.
+        """
+
+        self.send_response(200)
+        for key, value in sorted(EVENTS_HEADERS.items()):
+            self.send_header(key, value)
+        # the stream is not delimited, so the connection ends with it.
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return None
+
+        events = iter_events(watcher)
+        detach = getattr(self.server, 'detach', None)
+        if detach is None:
+            self.stream_events(events)
+            return None
+        # every stream holds on to a thread for as long as it is open,
+        # so it is given a thread of its own rather than a worker.
+        detach(self.request)
+        thread = threading.Thread(
+            target=self.stream_events, args=(events, True))
+        thread.daemon = True
+        thread.start()
+        return None
+
+    def stream_events(self, events, detached=False):
+        """
+        Send the events to the client until either of them ends.  If
+        detached, the connection is shut down once done.
+        """
+
         try:
-            text = self.provider.fetch(self.path)
-        except KeyError:
-            text = '404 NOT FOUND'
-            self.send_response(404)
-            self.send_header("Content-type", 'text/plain')
-        else:
-            self.send_response(200)
-            # XXX fix headers
-            self.send_header("Content-type", 'text/plain')
+            for chunk in events:
+                self.connection.sendall(chunk)
+        except (IOError, OSError):
+            # the client is gone.
+            pass
+        finally:
+            events.close()
+            if detached:
+                self.server.shutdown_request(self.request)
+
+    def do_POST(self):
+        if not self.path.startswith(self.nunja_prefix + '/'):
+            return CGIHTTPRequestHandler.do_POST(self)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        source = self.send_nunja(self.respond_nunja(self.rfile.read(length)))
+        try:
+            self.copyfile(source, self.wfile)
+        finally:
+            source.close()
+
+    def respond_nunja(self, body=None):
+        """
+        Produce the response from the provider for the current request.
+        """
+
+        return respond_nunja(self.provider, self.path, self.headers, body)
 
-        self.send_header("Content-Length", str(len(text)))
+    def send_nunja(self, response):
+        """
+        Send the status and headers of the response, and return the
+        file-like object for the body.
+        """
+
+        if response.chunks is not None:
+            return self.send_chunks(response)
+
+        # the file is only sent in place of the body while it is still
+        # the one that the validators were produced from.
+        source = None
+        if self.can_sendfile():
+            source = open_body_file(response)
+
+        self.send_response(response.status)
+        for key, value in sorted(response.headers.items()):
+            self.send_header(key, value)
+        self.end_headers()
+        return source or BytesIO(response.body)
+
+    def send_chunks(self, response):
+        """
+        Send the status and headers of the response with its body to be
+        sent as chunks, and return the file-like object for the chunks.
+        The chunked transfer coding is used for HTTP/1.1, otherwise the
+        end of the body is marked by closing the connection.
+        """
+
+        chunked = (
+            self.protocol_version >= 'HTTP/1.1' and
+            self.request_version >= 'HTTP/1.1'
+        )
+        self.send_response(response.status)
+        for key, value in sorted(response.headers.items()):
+            self.send_header(key, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
         self.end_headers()
-        return BytesIO(text.encode('utf8'))
+        return ChunkedReader(response.chunks, chunked)
+
+    def can_sendfile(self):
+        return hasattr(self.connection, 'sendfile')
+
+    def sendfile(self, source):
+        self.wfile.flush()
+        self.connection.sendfile(source)
+
+    def copyfile(self, source, outputfile):
+        """
+        Send files directly from their file descriptors to the socket,
+        where supported.
+        """
+
+        if outputfile is self.wfile and self.can_sendfile():
+            try:
+                source.fileno()
+            except (AttributeError, ValueError, IOError, OSError):
+                # not backed by a file descriptor (e.g. BytesIO)
+                pass
+            else:
+                return self.sendfile(source)
+        return CGIHTTPRequestHandler.copyfile(self, source, outputfile)
 
 
 class NunjaHTTPRequestHandlerFactory(object):
@@ -145,6 +444,8 @@ class NunjaHTTPRequestHandlerFactory(object):
             self, provider,
             nunja_prefix='/nunja', registry_names=(ENTRY_POINT_NAME,),
             handler_cls=NunjaHTTPRequestHandler,
+            protocol_version=None,
+            scripts=None,
             ):
         """
         Parameters
@@ -154,18 +455,117 @@ class NunjaHTTPRequestHandlerFactory(object):
             must start with a '/'.
         registry_names
             The names of registries.  Defaults to just nunja.mold
+        protocol_version
+            The HTTP protocol version for the handlers.  Defaults to
+            the one defined by the handler class.
+        scripts
+            The ScriptRunner for running Python scripts in-process; if
+            not provided, they will be run as CGI scripts.
         """
 
         self.nunja_prefix = nunja_prefix
         self.provider = provider
         self.handler_cls = handler_cls
+        self.protocol_version = protocol_version
+        self.scripts = scripts
 
     def __call__(self, request, client_address, server):
         cls = self.handler_cls(
-            request, client_address, server, self.nunja_prefix, self.provider)
+            request, client_address, server, self.nunja_prefix, self.provider,
+            protocol_version=self.protocol_version, scripts=self.scripts)
         return cls
 
 
+class ThreadPoolMixIn(object):
+    """
+    Mix-in class for servers to handle each request with one of a
+    bounded pool of worker threads.  Connections accepted while all
+    workers are busy are queued, and the workers holding on to idle
+    persistent connections will release them for the queued ones.
+    """
+
+    workers = 8
+
+    def start_workers(self):
+        # not bounded, so that the accepting is never blocked.
+        self._requests = Queue()
+        self._detached = set()
+        self._idle = 0
+        self._idle_lock = threading.Lock()
+        self._workers = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def _work(self):
+        while True:
+            with self._idle_lock:
+                self._idle += 1
+            item = self._requests.get()
+            with self._idle_lock:
+                self._idle -= 1
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if request in self._detached:
+                    self._detached.discard(request)
+                else:
+                    self.shutdown_request(request)
+
+    def detach(self, request):
+        """
+        Take the request from the worker handling it, such that it will
+        not be shut down once handled, as it is to be continued by the
+        handler in another thread, which will shut it down when done.
+        """
+
+        self._detached.add(request)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def waiting(self):
+        """
+        Return True if there are connections waiting for a worker, i.e.
+        more than the idle workers are about to take.
+        """
+
+        return self._requests.qsize() > self._idle
+
+    def stop_workers(self):
+        for thread in self._workers:
+            self._requests.put(None)
+        for thread in self._workers:
+            thread.join()
+        self._workers = []
+
+
+class ThreadPoolHTTPServer(ThreadPoolMixIn, HTTPServer):
+    """
+    The HTTPServer with a pool of worker threads.
+    """
+
+    def __init__(
+            self, server_address, RequestHandlerClass, workers=None,
+            bind_and_activate=True):
+        if workers is not None:
+            self.workers = workers
+        HTTPServer.__init__(
+            self, server_address, RequestHandlerClass, bind_and_activate)
+        self.start_workers()
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.stop_workers()
+
+
 def serve_nunja(
         provider_cls,
         server=None,
@@ -175,31 +575,142 @@ def serve_nunja(
         registry_names=(ENTRY_POINT_NAME,),
         bind='',
         port=8000,
-        protocol="HTTP/1.0",
+        protocol=None,
+        threads=0,
+        metrics=False,
+        watch=False,
+        in_process=False,
+        render=False,
+        render_processes=0,
+        render_cache=False,
+        aio=False,
+        processes=0,
+        shared_cache=False,
+        offload=None,
         ):
     """
     Simple requirejs based server.
+
+    If threads is specified, a ThreadPoolHTTPServer with that number of
+    workers will be used, and the protocol will default to "HTTP/1.1"
+    so that connections may be persistent; otherwise the default is a
+    single threaded server with "HTTP/1.0".
+
+    If metrics is True, the provider will collect metrics and serve them
+    at the '_metrics' subpath of the nunja_prefix.
+
+    If watch is True, the provider will watch the files of the molds
+    and stream the changes at the '_events' subpath; a pool of threads
+    is always used, with every stream served by a thread of its own
+    such that the open streams do not hold on to the workers.
+
+    If in_process is True, Python scripts will be loaded once and run
+    within the server process, rather than as a CGI script in a new
+    process for every request.
+
+    If render is True, the molds will be rendered into HTML at the
+    '_render/<mold_id>' subpath of the nunja_prefix.  If render_processes
+    is specified, the rendering will be done by a pool of that number of
+    processes, such that the threads serving the requests only wait on
+    the results.  If render_cache is True, the rendered molds are cached
+    by the mold and the data.
+
+    If aio is True, the asyncio based server will be used instead, with
+    the threads only for the producing of the responses; scripts are
+    not run and the changes of the molds are not streamed by it.
+
+    If processes is specified, that number of worker processes will be
+    forked to serve from the same listening socket, each with their own
+    server (with threads if specified), after the provider is created.
+    The workers are restarted if they exit, until SIGTERM is received.
+
+    If shared_cache is True, the contents of the files in the index of
+    the provider and their compressed variants are kept in a memory
+    mapped SharedContentStore, such that the worker processes do not
+    each hold a copy of them.
+
+    If offload is specified, the files of the molds will be delivered by
+    the front proxy the server is behind as directed by that Offload,
+    with the responses only carrying the header for it.
     """
 
+    if watch and not threads:
+        threads = ThreadPoolMixIn.workers
+
+    if protocol is None:
+        protocol = 'HTTP/1.1' if threads else 'HTTP/1.0'
+
     # TODO should the config_subpath be configurable?
-    provider = provider_cls(nunja_prefix, registry_names=registry_names)
+    kw = {'watch': True} if watch else {}
+    if render_processes:
+        kw['renderer'] = ProcessPoolRenderer(
+            registry_names[0], processes=render_processes)
+    elif render:
+        kw['renderer'] = True
+    if render_cache:
+        kw['render_cache'] = True
+    if offload is not None:
+        kw['offload'] = offload
+    provider = provider_cls(
+        nunja_prefix, registry_names=registry_names, metrics=metrics, **kw)
+    store_dir = None
+    if shared_cache:
+        store_dir = mkdtemp(prefix='nunja-store-')
+        provider.cache = SharedContentStore(
+            join(store_dir, 'contents'),
+            getattr(provider, 'index', {}).values(),
+            provider.encodings, provider.precompressed)
     addr = (bind, port)
     handler = NunjaHTTPRequestHandlerFactory(
         provider,
         handler_cls=handler_cls,
         nunja_prefix=nunja_prefix,
         registry_names=registry_names,
+        protocol_version=protocol,
+        scripts=ScriptRunner() if in_process else None,
     )
-    if server is None:
-        server = server_factory(addr, handler)
-    sa = server.socket.getsockname()
-    print('Serving HTTP on %s:%s...' % sa)
+    if aio:
+        from nunja.serve.simple.aio import AsyncHTTPServer
+        from nunja.serve.simple.aio import DEFAULT_WORKERS
+        server = AsyncHTTPServer(
+            provider, nunja_prefix, workers=threads or DEFAULT_WORKERS)
+        serve = partial(server.serve_forever, bind, port)
+    else:
+        if server is None and processes:
+            from nunja.serve.simple.prefork import PreforkServer
+            if threads:
+                factory = partial(
+                    ThreadPoolHTTPServer, addr, handler, workers=threads,
+                    bind_and_activate=False)
+            else:
+                factory = partial(
+                    server_factory, addr, handler, bind_and_activate=False)
+            if isinstance(provider.renderer, Renderer):
+                # compiled once for all the workers.
+                provider.renderer.preload()
+            server = PreforkServer(
+                server_factory(addr, handler), factory, processes)
+        elif server is None:
+            if threads:
+                server = ThreadPoolHTTPServer(addr, handler, workers=threads)
+            else:
+                server = server_factory(addr, handler)
+        sa = server.socket.getsockname()
+        print('Serving HTTP on %s:%s...' % sa)
+        serve = server.serve_forever
     try:
-        server.serve_forever()
+        serve()
     except KeyboardInterrupt:
         print('\nKeyboard interrupt received, shutting down...')
-        server.server_close()
-        sys.exit(0)
+    # a PreforkServer also returns once stopped by SIGTERM.
+    if getattr(provider, 'watcher', None) is not None:
+        provider.watcher.stop()
+    if provider.renderer is not None:
+        provider.renderer.close()
+    server.server_close()
+    if store_dir is not None:
+        rmtree(store_dir, ignore_errors=True)
+    sys.exit(0)
 
 
 def main(provider_cls):
@@ -212,5 +723,74 @@ def main(provider_cls):
                         default=8000, type=int,
                         nargs='?',
                         help='Specify alternate port [default: 8000]')
+    parser.add_argument('--threads', '--workers', '-t', default=0, type=int,
+                        metavar='N', dest='threads',
+                        help='Serve with a pool of N worker threads over '
+                             'persistent HTTP/1.1 connections '
+                             '[default: single threaded]')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Collect metrics and serve them at '
+                             '/nunja/_metrics')
+    parser.add_argument('--watch', action='store_true',
+                        help='Watch the files of the molds and push the '
+                             'changes to the browsers')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run Python scripts within the server process, '
+                             'reloading them only when modified')
+    parser.add_argument('--render', action='store_true',
+                        help='Render the molds into HTML at '
+                             '/nunja/_render/<mold_id>')
+    parser.add_argument('--render-processes', default=0, type=int,
+                        metavar='N',
+                        help='Render the molds with a pool of N processes '
+                             '(implies --render)')
+    parser.add_argument('--render-cache', action='store_true',
+                        help='Cache the rendered molds by the mold and the '
+                             'data')
+    parser.add_argument('--asyncio', action='store_true', dest='aio',
+                        help='Serve with the asyncio based server, with the '
+                             'threads only for producing the responses')
+    parser.add_argument('--processes', '-p', default=0, type=int,
+                        metavar='N',
+                        help='Serve with N forked worker processes from '
+                             'the same socket, which are restarted if they '
+                             'exit [default: no worker processes]')
+    parser.add_argument('--shared-cache', action='store_true',
+                        help='Keep the contents of the molds in a memory '
+                             'mapped store shared by the worker processes')
+    parser.add_argument('--offload', choices=sorted(offload_headers),
+                        type=str.lower, metavar='HEADER',
+                        help='Leave the delivery of the files of the molds '
+                             'to the front proxy through the header (one '
+                             'of: %(choices)s)')
+    parser.add_argument('--offload-map', action='append', default=[],
+                        type=parse_mapping, metavar='DIRECTORY=PREFIX',
+                        help='Offload the files under DIRECTORY as PREFIX '
+                             'joined with their relative paths (repeatable; '
+                             'required for x-accel-redirect)')
     args = parser.parse_args()
-    serve_nunja(provider_cls=provider_cls, port=args.port, bind=args.bind)
+    if args.aio and (args.watch or args.in_process):
+        parser.error(
+            '--asyncio cannot be used with --watch or --in-process')
+    if args.processes and (
+            args.watch or args.aio or args.render_processes):
+        parser.error(
+            '--processes cannot be used with --watch, --asyncio or '
+            '--render-processes')
+    if args.processes and not hasattr(os, 'fork'):
+        parser.error('--processes is not supported on this platform')
+    if args.offload_map and not args.offload:
+        parser.error('--offload-map requires --offload')
+    if args.offload == 'x-accel-redirect' and not args.offload_map:
+        parser.error('--offload x-accel-redirect requires --offload-map')
+    offload = None
+    if args.offload:
+        offload = Offload(args.offload, args.offload_map)
+    serve_nunja(
+        provider_cls=provider_cls, port=args.port, bind=args.bind,
+        threads=args.threads, metrics=args.metrics, watch=args.watch,
+        in_process=args.in_process, render=args.render,
+        render_processes=args.render_processes,
+        render_cache=args.render_cache, aio=args.aio,
+        processes=args.processes, shared_cache=args.shared_cache,
+        offload=offload)
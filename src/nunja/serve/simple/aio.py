@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio based HTTP/1.1 server for the simple serving mode, such that
+idle persistent connections are held without a thread for each of them.
+
+Requests on a connection are handled in order, so pipelined requests
+are answered in sequence.  The responses are produced by the provider
+in a pool of threads, as they may involve the reading of files.
+
+Requires Python 3.5+
+"""
+
+import asyncio
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from http.client import responses
+from os import getcwd
+from os.path import isdir
+from os.path import isfile
+from os.path import join
+from urllib.parse import unquote
+
+from nunja.serve.base import Response
+from nunja.serve.base import bad_request
+from nunja.serve.base import guess_type
+from nunja.serve.base import not_found
+from nunja.serve.base import server_error
+from nunja.serve.cache import load
+from nunja.serve.simple import KEEPALIVE_TIMEOUT
+from nunja.serve.simple import respond_nunja
+
+logger = logging.getLogger(__name__)
+
+# the limits for the request line and headers.
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+# the default number of threads for producing the responses.
+DEFAULT_WORKERS = 8
+
+SERVER = 'nunja.serve.simple.aio'
+
+
+class Headers(dict):
+    """
+    The request headers, with the names looked up case-insensitively.
+    """
+
+    def __setitem__(self, key, value):
+        super(Headers, self).__setitem__(key.lower(), value)
+
+    def __getitem__(self, key):
+        return super(Headers, self).__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super(Headers, self).__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super(Headers, self).get(key.lower(), default)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def translate_path(root, path):
+    """
+    Return the filesystem path under root for the request path, or None
+    if it would escape the root.
+    """
+
+    path = posixpath.normpath(unquote(path.partition('?')[0]))
+    fragments = [f for f in path.split('/') if f]
+    if any(f in ('.', '..') for f in fragments):
+        return None
+    return join(root, *fragments)
+
+
+def respond_file(provider, root, path, headers):
+    """
+    Produce the response for a file under root, with the directories
+    served by their 'index.html'.  Scripts are not run.
+    """
+
+    target = translate_path(root, path)
+    if target is not None and isdir(target):
+        target = join(target, 'index.html')
+    if target is None or target.endswith('.py') or not isfile(target):
+        return not_found()
+    try:
+        content = load(target)
+    except (IOError, OSError):
+        return not_found()
+    return provider.respond_content(content, guess_type(target), headers)
+
+
+async def read_line(reader):  # noqa: E999
+    try:
+        return await reader.readline()
+    except ValueError:
+        # the limit of the reader was exceeded.
+        raise BadRequest('line too long')
+
+
+async def read_request(reader):
+    """
+    Read the next request from the reader, and return the method, path,
+    version, headers and body, or None if the connection was closed.
+    A BadRequest will be raised for malformed requests.
+    """
+
+    line = await read_line(reader)
+    while line in (b'\r\n', b'\n'):
+        # tolerate the empty lines in between requests.
+        line = await read_line(reader)
+    if not line:
+        return None
+    if len(line) > MAX_LINE:
+        raise BadRequest('request line too long')
+
+    try:
+        method, path, version = line.decode('latin-1').split()
+    except ValueError:
+        raise BadRequest('malformed request line')
+    if not version.startswith('HTTP/1.'):
+        raise BadRequest('unsupported version')
+
+    headers = Headers()
+    while True:
+        line = await read_line(reader)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(line) > MAX_LINE or len(headers) >= MAX_HEADERS:
+            raise BadRequest('headers too large')
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep:
+            raise BadRequest('malformed header')
+        headers[name.strip()] = value.strip()
+
+    if 'Transfer-Encoding' in headers:
+        raise BadRequest('request bodies must have a Content-Length')
+    try:
+        length = int(headers.get('Content-Length') or 0)
+    except ValueError:
+        raise BadRequest('invalid Content-Length')
+    body = await reader.readexactly(length) if length else None
+    return method, path, version, headers, body
+
+
+def keep_alive(version, headers):
+    """
+    Return whether the connection should persist after the request.
+    """
+
+    connection = headers.get('Connection', '').lower()
+    if version >= 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+def format_head(version, response, keep):
+    lines = ['%s %d %s' % (
+        version, response.status, responses.get(response.status, ''))]
+    lines.append('Server: %s' % SERVER)
+    for key, value in sorted(response.headers.items()):
+        lines.append('%s: %s' % (key, value))
+    if response.chunks is not None and keep:
+        lines.append('Transfer-Encoding: chunked')
+    lines.append('Connection: %s' % ('keep-alive' if keep else 'close'))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class AsyncHTTPServer(object):
+    """
+    Serve the provider at the nunja_prefix, and the files under root
+    for everything else.
+    """
+
+    def __init__(
+            self, provider, nunja_prefix='/nunja', root=None,
+            workers=DEFAULT_WORKERS, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        """
+        Arguments
+
+        provider
+            The provider to serve.
+        nunja_prefix
+            The path prefix for the provider.
+        root
+            The directory with the files to serve; defaults to the
+            current working directory.
+        workers
+            The number of threads for producing the responses.
+        keepalive_timeout
+            The seconds an idle persistent connection is kept open for.
+        """
+
+        self.provider = provider
+        self.nunja_prefix = nunja_prefix
+        self.root = getcwd() if root is None else root
+        self.executor = ThreadPoolExecutor(workers)
+        self.keepalive_timeout = keepalive_timeout
+        self.loop = None
+        self.server = None
+        # the writers of the open connections to the futures that are
+        # done once they are closed.
+        self.connections = {}
+
+    def respond(self, method, path, headers, body):
+        """
+        Produce the Response for the request, which is done in one of
+        the threads of the executor.
+        """
+
+        if method not in ('GET', 'HEAD', 'POST'):
+            return Response(501, {'Content-Length': '0'})
+        if path.startswith(self.nunja_prefix + '/'):
+            return respond_nunja(self.provider, path, headers, body)
+        if method == 'POST':
+            return Response(501, {'Content-Length': '0'})
+        return respond_file(self.provider, self.root, path, headers)
+
+    async def handle(self, reader, writer):
+        """
+        Handle the requests on a connection until it is closed.
+        """
+
+        loop = asyncio.get_event_loop()
+        self.connections[writer] = loop.create_future()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        read_request(reader), self.keepalive_timeout)
+                except BadRequest as e:
+                    response = bad_request(str(e))
+                    writer.write(format_head('HTTP/1.1', response, False))
+                    writer.write(response.body)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                keep = keep_alive(version, headers)
+                try:
+                    response = await loop.run_in_executor(
+                        self.executor, self.respond, method, path, headers,
+                        body)
+                except Exception:
+                    logger.exception("failed to respond to '%s'", path)
+                    response = server_error()
+                if response.chunks is not None and version < 'HTTP/1.1':
+                    # the end is marked by the closing of the connection.
+                    keep = False
+                writer.write(format_head(version, response, keep))
+                if method != 'HEAD':
+                    await self.write_body(writer, response, keep)
+                elif response.chunks is not None:
+                    response.chunks.close()
+                await writer.drain()
+                if not keep:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        except OSError:
+            # the client is gone.
+            pass
+        finally:
+            writer.close()
+            self.connections.pop(writer).set_result(None)
+
+    async def write_body(self, writer, response, chunked):
+        if response.chunks is None:
+            writer.write(response.body)
+            return
+        loop = asyncio.get_event_loop()
+        chunks = response.chunks
+        try:
+            while True:
+                chunk = await loop.run_in_executor(
+                    self.executor, next, chunks, None)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                if chunked:
+                    writer.write(('%x\r\n' % len(chunk)).encode('ascii'))
+                    writer.write(chunk)
+                    writer.write(b'\r\n')
+                else:
+                    writer.write(chunk)
+                await writer.drain()
+        finally:
+            try:
+                chunks.close()
+            except ValueError:
+                # still being rendered by the executor.
+                pass
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+
+    async def start(self, host='', port=8000):
+        """
+        Start listening, and return the asyncio server.
+        """
+
+        self.server = await asyncio.start_server(
+            self.handle, host or None, port)
+        return self.server
+
+    def serve_forever(self, host='', port=8000):
+        """
+        Serve on a new event loop until interrupted.
+        """
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(self.start(host, port))
+        print('Serving HTTP on %s:%s...' % server.sockets[0].getsockname()[:2])
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        if self.server is not None:
+            self.server.close()
+            # the persistent connections are closed, such that their
+            # handlers will finish instead of waiting for requests.
+            closed = list(self.connections.values())
+            for writer in list(self.connections):
+                writer.close()
+            if closed:
+                self.loop.run_until_complete(asyncio.wait(closed))
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.server = None
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forked worker processes for the simple server, such that more than
+one core may be used for serving.
+
+The listening socket and the provider are created once by the parent
+process before the workers are forked, so that the indexing of the
+registries and the building of the configuration are not repeated and
+the resulting objects are shared by the workers until modified.  The
+workers accept the connections from the shared socket, and the parent
+only supervise them.
+"""
+
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# the seconds a worker must have been running for before it is restarted
+# right away once it exits; otherwise the restart is delayed by that.
+RESTART_DELAY = 1.0
+
+# the seconds the workers are given to finish before they are killed.
+STOP_TIMEOUT = 10.0
+
+# the seconds in between the checks for the exited workers.
+WAIT_POLL = 0.05
+
+
+class PreforkServer(object):
+    """
+    Supervise the worker processes serving from the listener.
+    """
+
+    def __init__(
+            self, listener, server_factory, processes,
+            restart_delay=RESTART_DELAY, stop_timeout=STOP_TIMEOUT):
+        """
+        Arguments
+
+        listener
+            The server with the bound and listening socket, which will
+            not serve any requests itself.
+        server_factory
+            A callable that return a new server for a worker without
+            binding, i.e. one created with bind_and_activate=False.
+        processes
+            The number of worker processes.
+        restart_delay
+            The seconds a worker is given to start before its exit is
+            taken as a crash, such that it is restarted after a delay.
+        stop_timeout
+            The seconds the workers are given to finish the requests in
+            progress once they are stopped, before they are killed.
+        """
+
+        self.listener = listener
+        self.socket = listener.socket
+        self.server_factory = server_factory
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        # the pid of the workers to the time they were started.
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self):
+        """
+        Fork a new worker process, and return its pid in the parent.
+        """
+
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+
+        status = 0
+        try:
+            self.serve_worker()
+        except BaseException:
+            logger.exception('worker %d failed', os.getpid())
+            status = 1
+        finally:
+            # never return into the code of the parent process.
+            os._exit(status)
+
+    def serve_worker(self):
+        """
+        Serve in the worker process until it is told to stop.
+        """
+
+        # interrupts from the terminal are left to the parent.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        server = self.server_factory()
+        server.socket.close()
+        server.socket = self.socket
+        server.server_address = self.listener.server_address
+        server.server_name = self.listener.server_name
+        server.server_port = self.listener.server_port
+
+        def stop(signum, frame):
+            # the shutdown waits for the loop, so it cannot be done from
+            # within the same thread.
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def serve_forever(self):
+        """
+        Start the workers, and restart any that exit until stopped by
+        either SIGTERM or an interrupt.
+        """
+
+        self.stopping = False
+        previous = signal.signal(signal.SIGTERM, self.handle_term)
+        try:
+            while len(self.children) < self.processes:
+                self.spawn()
+            while self.children:
+                if self.stopping:
+                    # the workers are given the stop_timeout to exit.
+                    self.reap()
+                    break
+                try:
+                    # not blocking, such that the stopping is noticed.
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError as e:
+                    if e.errno == errno.ECHILD:
+                        self.children.clear()
+                    continue
+                if not pid:
+                    time.sleep(WAIT_POLL)
+                    continue
+                started = self.children.pop(pid, None)
+                if started is None or self.stopping:
+                    continue
+                logger.warning(
+                    'worker %d exited with status %d; restarting',
+                    pid, status)
+                if time.time() - started < self.restart_delay:
+                    time.sleep(self.restart_delay)
+                if not self.stopping:
+                    self.spawn()
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+    def handle_term(self, signum, frame):
+        self.stop()
+
+    def stop(self):
+        """
+        Tell the workers to stop, which is done after the requests in
+        progress are finished.
+        """
+
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.children.pop(pid, None)
+
+    def reap(self):
+        """
+        Wait for the stopped workers to exit, and kill the ones that are
+        still running after the stop_timeout.
+        """
+
+        deadline = time.time() + self.stop_timeout
+        while self.children:
+            for pid in list(self.children):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        self.children.pop(pid)
+                except OSError:
+                    self.children.pop(pid)
+            if self.children and time.time() > deadline:
+                for pid in list(self.children):
+                    logger.warning('killing worker %d', pid)
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        self.children.pop(pid)
+                deadline = float('inf')
+            if self.children:
+                time.sleep(WAIT_POLL)
+
+    def server_close(self):
+        self.stop()
+        self.reap()
+        self.listener.server_close()
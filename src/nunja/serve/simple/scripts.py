@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+In-process execution of the Python scripts for the simple server, as an
+alternative to running them as CGI scripts in a new process for every
+request.
+
+A script that defines an ``application`` WSGI callable is executed once,
+and the callable is invoked for every request.  Other scripts are taken
+as CGI scripts; their compiled code is executed for every request with
+the output captured, but the modules imported by them (e.g. the nunja
+engine along with the molds loaded by it) will stay loaded in between.
+Scripts are loaded again once they are modified.
+"""
+
+import logging
+import os
+import sys
+from io import BytesIO
+from threading import RLock
+
+from nunja.serve.base import Response
+from nunja.serve.base import server_error
+from nunja.serve.cache import stat_key
+from nunja.serve.compat import StringIO
+
+logger = logging.getLogger(__name__)
+
+
+def parse_output(output):
+    """
+    Produce a Response from the output of a CGI script, which is the
+    headers followed by an empty line then the body.
+    """
+
+    output = output.replace('\r\n', '\n')
+    if output.startswith('\n'):
+        # no headers at all.
+        head, body = '', output[1:]
+    else:
+        head, _, body = output.partition('\n\n')
+    status = 200
+    headers = {}
+    for line in head.split('\n'):
+        name, _, value = line.partition(':')
+        if not value:
+            continue
+        if name.strip().lower() == 'status':
+            status = int(value.split()[0])
+        else:
+            headers[name.strip()] = value.strip()
+    body = body.encode('utf8')
+    headers['Content-Length'] = str(len(body))
+    return Response(status, headers, body)
+
+
+class Script(object):
+    """
+    A loaded script, which may provide a WSGI application.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.key = stat_key(path)
+        with open(path, 'rb') as fd:
+            self.code = compile(fd.read(), path, 'exec')
+        self.application = None
+
+    def namespace(self, name='__main__'):
+        return {
+            '__name__': name,
+            '__file__': self.path,
+            '__builtins__': __builtins__,
+        }
+
+
+class ScriptRunner(object):
+    """
+    Load and run the scripts.  As the execution of CGI scripts require
+    the replacement of the process wide standard streams and environment
+    variables, they are executed one at a time; WSGI applications are
+    invoked concurrently.
+    """
+
+    def __init__(self):
+        self.scripts = {}
+        self.lock = RLock()
+
+    def load(self, path):
+        """
+        Return the Script at path, which is loaded again if modified.
+        """
+
+        script = self.scripts.get(path)
+        if script is not None and script.key == stat_key(path):
+            return script
+
+        with self.lock:
+            script = self.scripts.get(path)
+            if script is not None and script.key == stat_key(path):
+                # loaded by another thread in the meantime.
+                return script
+            script = Script(path)
+            if 'application' in script.code.co_names:
+                # as a module rather than as the main program, such that
+                # the ``if __name__ == '__main__':`` block which usually
+                # start a server for the application is not executed.
+                namespace = script.namespace(
+                    os.path.splitext(os.path.basename(path))[0])
+                # any output from the scripts that are CGI scripts after
+                # all are discarded.
+                self.execute(script, namespace, {}, b'')
+                application = namespace.get('application')
+                if callable(application):
+                    script.application = application
+            self.scripts[path] = script
+        return script
+
+    def execute(self, script, namespace, environ, body):
+        """
+        Execute the code of the script in namespace with environ as the
+        environment variables and body as the standard input, return
+        the standard output.
+        """
+
+        stdout = StringIO()
+        with self.lock:
+            saved = sys.stdout, sys.stdin
+            restore = dict((key, os.environ.get(key)) for key in environ)
+            sys.stdout = stdout
+            sys.stdin = StringIO(body.decode('utf8', 'replace'))
+            os.environ.update(environ)
+            try:
+                exec(script.code, namespace)
+            except SystemExit:
+                pass
+            finally:
+                sys.stdout, sys.stdin = saved
+                for key, value in restore.items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+        return stdout.getvalue()
+
+    def run(self, path, environ, body=b''):
+        """
+        Produce the Response from the script at path, for the request
+        with the CGI environ and the body.
+        """
+
+        try:
+            script = self.load(path)
+            if script.application is not None:
+                return self.call(script.application, environ, body)
+            return parse_output(self.execute(
+                script, script.namespace(), environ, body))
+        except Exception:
+            logger.exception("failed to run script '%s'", path)
+            return server_error()
+
+    def call(self, application, environ, body):
+        """
+        Produce the Response from the WSGI application.
+        """
+
+        environ = dict(environ)
+        environ.update({
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        })
+        chunks = []
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = status
+            started['headers'] = headers
+            return chunks.append
+
+        result = application(environ, start_response)
+        try:
+            for chunk in result:
+                chunks.append(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        body = b''.join(chunks)
+        headers = dict(started['headers'])
+        headers['Content-Length'] = str(len(body))
+        return Response(
+            int(started['status'].split()[0]), headers, body)
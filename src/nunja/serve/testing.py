@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+from os.path import dirname
+from os.path import join
 from pkg_resources import Distribution
 
 from calmjs.registry import _inst as default_registry
 from calmjs.testing import mocks
+from calmjs.testing.utils import mkdtemp
 
 from nunja.serve.base import BaseProvider
+from nunja import engine
 from nunja.registry import MoldRegistry
 
 js_mimetypes = (
     'text/javascript', 'application/x-javascript', 'application/javascript')
 
+generated_template = u'<div class="{{ cls }}">{{ value }}</div>\n'
+generated_script = (
+    u"define(['nunja/core'], function(core) {\n    return {};\n});\n")
+
 
 class DummyProvider(BaseProvider):
 
@@ -22,6 +33,19 @@ class DummyProvider(BaseProvider):
         return 'object:' + identifier
 
 
+def write_file(path, text, mtime=None):
+    """
+    Write the text to the file at path, with the modification time set
+    to mtime if provided, such that the change will be noticed by the
+    stat keys regardless of the resolution of the filesystem.
+    """
+
+    with open(path, 'w') as fd:
+        fd.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
 def setup_test_mold_registry(testcase, name='nunja.mold'):
     def cleanup():
         default_registry.records.pop(name, None)
@@ -30,8 +54,110 @@ def setup_test_mold_registry(testcase, name='nunja.mold'):
         name: [
             'nunja.testing.mold = nunja.testing:mold',
         ]},
-        dist=Distribution(project_name='nunja.testing')
+        dist=Distribution(project_name='nunja.testing', version='0.0')
     )
     registry = MoldRegistry(name, _working_set=working_set)
     testcase.addCleanup(cleanup)
     default_registry.records[name] = registry
+
+
+def package_names(prefix, packages):
+    """
+    Return the names of the packages generated with the prefix.
+    """
+
+    return ['%s%d' % (prefix, i) for i in range(packages)]
+
+
+def generate_mold_packages(
+        root, packages=1, molds=1, prefix='nunja_generated',
+        template=generated_template, script=generated_script):
+    """
+    Write the number of importable packages into the root directory,
+    each providing the number of molds named 'm0', 'm1' and so on, with
+    the template and script as their template.nja and index.js.  Return
+    the list of the mold ids.
+    """
+
+    mold_ids = []
+    for name in package_names(prefix, packages):
+        package = join(root, name)
+        os.makedirs(package)
+        with open(join(package, '__init__.py'), 'w'):
+            pass
+        for i in range(molds):
+            mold = 'm%d' % i
+            target = join(package, 'mold', mold)
+            os.makedirs(target)
+            with open(join(target, 'template.nja'), 'w') as fd:
+                fd.write(template)
+            with open(join(target, 'index.js'), 'w') as fd:
+                fd.write(script)
+            mold_ids.append(name + '.mold/' + mold)
+    return mold_ids
+
+
+def generate_core_molds(root, package):
+    """
+    Copy the core molds of nunja (i.e. the wrapper used by the engine)
+    into the generated package, for registries that are to be rendered
+    with.  Return the entry point entry for them.
+    """
+
+    shutil.copytree(join(dirname(engine.__file__), '_core_'),
+                    join(root, package, '_core_'))
+    return '_core_ = %s:_core_' % package
+
+
+def make_generated_mold_registry(
+        root, packages, name='nunja.mold', entries=()):
+    """
+    Return a MoldRegistry for the packages generated at root, which is
+    made importable, with any extra entry point entries.
+    """
+
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    for package in packages:
+        # may have been imported from a previously generated root.
+        sys.modules.pop(package, None)
+    working_set = mocks.WorkingSet({name: list(entries) + [
+        '%s.mold = %s:mold' % (package, package) for package in packages
+    ]}, dist=None)
+    return MoldRegistry(name, _working_set=working_set)
+
+
+def remove_generated_packages(root, packages):
+    """
+    Undo the import side effects of make_generated_mold_registry.
+    """
+
+    if root in sys.path:
+        sys.path.remove(root)
+    for package in packages:
+        sys.modules.pop(package, None)
+
+
+def setup_generated_mold_registry(
+        testcase, packages=1, molds=1, name='nunja.mold',
+        prefix='nunja_generated', core=False, **kw):
+    """
+    Generate the packages and molds in a temporary directory and set up
+    the registry with name for them, for the duration of the test.  If
+    core is True, the core molds are included for rendering.  Return
+    the list of the mold ids.
+    """
+
+    root = mkdtemp(testcase)
+    mold_ids = generate_mold_packages(root, packages, molds, prefix, **kw)
+    packages = package_names(prefix, packages)
+    entries = [generate_core_molds(root, packages[0])] if core else []
+
+    def cleanup():
+        default_registry.records.pop(name, None)
+        remove_generated_packages(root, packages)
+
+    testcase.addCleanup(cleanup)
+    default_registry.records[name] = make_generated_mold_registry(
+        root, packages, name, entries)
+    return mold_ids
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import unittest
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_item_attr_value
+from calmjs.testing.utils import stub_stdouts
+
+from nunja.serve.compat import HTTPConnection
+from nunja.serve.simple import aio
+from nunja.serve.simple import serve_nunja
+from nunja.serve.simple.aio import AsyncHTTPServer
+from nunja.serve.simple.aio import Headers
+from nunja.serve.simple.aio import keep_alive
+from nunja.serve.simple.aio import respond_file
+from nunja.serve.simple.aio import translate_path
+from nunja.serve.testing import DummyProvider
+
+
+def make_root(testcase):
+    root = mkdtemp(testcase)
+    with open(os.path.join(root, 'file.txt'), 'w') as fd:
+        fd.write('hello')
+    with open(os.path.join(root, 'script.py'), 'w') as fd:
+        fd.write('print("Hello World")\n')
+    os.mkdir(os.path.join(root, 'dir'))
+    with open(os.path.join(root, 'dir', 'index.html'), 'w') as fd:
+        fd.write('<html></html>')
+    return root
+
+
+class SupportTestCase(unittest.TestCase):
+
+    def test_headers(self):
+        headers = Headers()
+        headers['Content-Length'] = '1'
+        self.assertIn('content-length', headers)
+        self.assertEqual(headers['CONTENT-LENGTH'], '1')
+        self.assertEqual(headers.get('Content-length'), '1')
+        self.assertIsNone(headers.get('Connection'))
+
+    def test_translate_path(self):
+        self.assertEqual(
+            translate_path('/root', '/dir/file.txt?x=1'),
+            os.path.join('/root', 'dir', 'file.txt'))
+        self.assertEqual(
+            translate_path('/root', '/dir/../file%2Etxt'),
+            os.path.join('/root', 'file.txt'))
+        # kept under the root.
+        self.assertEqual(
+            translate_path('/root', '/../etc/passwd'),
+            os.path.join('/root', 'etc', 'passwd'))
+        self.assertIsNone(translate_path('/root', '../etc/passwd'))
+
+    def test_respond_file(self):
+        root = make_root(self)
+        provider = DummyProvider('/nunja')
+        response = respond_file(provider, root, '/file.txt', {})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b'hello')
+        self.assertEqual(response.headers['Content-Type'], 'text/plain')
+
+        response = respond_file(provider, root, '/dir/', {})
+        self.assertEqual(response.body, b'<html></html>')
+        self.assertEqual(
+            respond_file(provider, root, '/script.py', {}).status, 404)
+        self.assertEqual(
+            respond_file(provider, root, '/missing', {}).status, 404)
+        self.assertEqual(
+            respond_file(provider, root, '../file.txt', {}).status, 404)
+
+    def test_keep_alive(self):
+        def headers(**kw):
+            result = Headers()
+            result.update(kw)
+            return result
+
+        self.assertTrue(keep_alive('HTTP/1.1', headers()))
+        self.assertFalse(keep_alive('HTTP/1.1', headers(connection='close')))
+        self.assertFalse(keep_alive('HTTP/1.0', headers()))
+        self.assertTrue(
+            keep_alive('HTTP/1.0', headers(connection='Keep-Alive')))
+
+
+class AsyncHTTPServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = make_root(self)
+        self.provider = DummyProvider('/nunja', renderer=True)
+        self.server = AsyncHTTPServer(
+            self.provider, '/nunja', root=self.root, workers=2)
+        self.server.loop = loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(
+            self.server.start('127.0.0.1', 0))
+        self.port = server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=loop.run_forever)
+        self.thread.start()
+        self.addCleanup(loop.close)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+
+    def connect(self):
+        conn = HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def raw(self, data):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(data)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def test_get_object_and_file(self):
+        conn = self.connect()
+        conn.request('GET', '/nunja/some/object.js')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'object:some/object.js')
+        # the same connection is kept for the next request.
+        conn.request('GET', '/file.txt')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'hello')
+        self.assertEqual(response.getheader('Connection'), 'keep-alive')
+
+        conn.request('GET', '/nunja/notfound.js')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+        response.read()
+
+    def test_not_modified(self):
+        conn = self.connect()
+        conn.request('GET', '/file.txt')
+        response = conn.getresponse()
+        response.read()
+        conn.request('GET', '/file.txt', headers={
+            'If-None-Match': response.getheader('ETag')})
+        response = conn.getresponse()
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.read(), b'')
+
+    def test_head(self):
+        conn = self.connect()
+        conn.request('HEAD', '/file.txt')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Length'), '5')
+        self.assertEqual(response.read(), b'')
+        conn.request('GET', '/file.txt')
+        self.assertEqual(conn.getresponse().read(), b'hello')
+
+    def test_pipelined(self):
+        data = self.raw(
+            b'GET /file.txt HTTP/1.1\r\nHost: localhost\r\n\r\n'
+            b'GET /nunja/some/object.js HTTP/1.1\r\nHost: localhost\r\n'
+            b'Connection: close\r\n\r\n'
+        )
+        first, _, second = data.partition(b'HTTP/1.1 200 OK\r\n')[2].partition(
+            b'HTTP/1.1 200 OK\r\n')
+        self.assertTrue(first.endswith(b'\r\n\r\nhello'))
+        self.assertTrue(second.endswith(b'\r\n\r\nobject:some/object.js'))
+        self.assertIn(b'Connection: close', second)
+
+    def test_http10(self):
+        data = self.raw(b'GET /file.txt HTTP/1.0\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.0 200 OK\r\n'))
+        self.assertIn(b'Connection: close', data)
+        self.assertTrue(data.endswith(b'hello'))
+
+    def test_bad_request(self):
+        data = self.raw(b'GARBAGE\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 400 Bad Request\r\n'))
+        data = self.raw(b'GET / SPDY/3\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 400 Bad Request\r\n'))
+        data = self.raw(b'GET / HTTP/1.1\r\nX' + b'x' * 70000 + b'\r\n\r\n')
+        self.assertTrue(data.startswith(b'HTTP/1.1 400 Bad Request\r\n'))
+
+    def test_not_implemented(self):
+        conn = self.connect()
+        conn.request('DELETE', '/file.txt')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 501)
+        response.read()
+        conn.request('POST', '/file.txt', body=b'')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 501)
+        response.read()
+        # scripts are never run.
+        conn.request('GET', '/script.py')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+        response.read()
+
+    def test_server_error(self):
+        def explode(*a, **kw):
+            raise Exception('explosion')
+
+        stub_item_attr_value(self, self.server, 'respond', explode)
+        stub_item_attr_value(self, aio.logger, 'disabled', True)
+        conn = self.connect()
+        conn.request('GET', '/file.txt')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 500)
+        response.read()
+
+    def test_stream(self):
+        chunks = []
+
+        def stream(mold_id, data, wrapper_tag='div'):
+            chunks.append(mold_id)
+            return iter([b'<div>', b'', b'</div>'])
+
+        stub_item_attr_value(self, self.provider.renderer, 'stream', stream)
+        conn = self.connect()
+        conn.request('POST', '/nunja/_stream/pkg.mold/x', body=b'{}')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(response.read(), b'<div></div>')
+        self.assertEqual(chunks, ['pkg.mold/x'])
+
+        data = self.raw(
+            b'POST /nunja/_stream/pkg.mold/x HTTP/1.0\r\n'
+            b'Content-Length: 2\r\n\r\n{}')
+        self.assertNotIn(b'Transfer-Encoding', data)
+        self.assertTrue(data.endswith(b'\r\n\r\n<div></div>'))
+
+
+class ServeTestCase(unittest.TestCase):
+
+    def test_server_flow(self):
+        stub_stdouts(self)
+
+        class NeuteredServer(AsyncHTTPServer):
+            def serve_forever(self, host, port):
+                self.loop = asyncio.new_event_loop()
+                self.loop.run_until_complete(self.start(host, port))
+                print('Serving HTTP on %s:%s...' % (host, port))
+                raise KeyboardInterrupt
+
+        stub_item_attr_value(self, aio, 'AsyncHTTPServer', NeuteredServer)
+        with self.assertRaises(SystemExit):
+            serve_nunja(DummyProvider, port=0, aio=True)
+        stdout = sys.stdout.getvalue()
+        self.assertIn('Serving HTTP on', stdout)
+        self.assertIn('Keyboard interrupt received, shutting down...', stdout)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+import unittest
+import asyncio
+import json
+
+from calmjs.testing.utils import stub_item_attr_value
+
+from nunja.serve import asgi
+from nunja.serve.asgi import Application
+from nunja.serve.asgi import PATHSEND
+from nunja.serve.asgi import RJSProvider
+from nunja.serve.asgi import ZEROCOPYSEND
+from nunja.serve.asgi import request_headers
+from nunja.serve.compat import Queue
+from nunja.serve.watch import EventsForwarder
+from nunja.serve.testing import DummyProvider
+from nunja.serve.testing import setup_generated_mold_registry
+
+script = 'nunja.mold/nunja_generated0.mold/m0/index.js'
+
+
+def call(
+        application, path, method='GET', body=None, headers=(),
+        disconnect=False, **scope):
+    path, _, query = path.partition('?')
+    scope.update({
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query.encode('latin-1'),
+        'headers': [
+            (k.lower().encode('latin-1'), v.encode('latin-1'))
+            for k, v in headers],
+    })
+    received = [{
+        'type': 'http.request', 'body': body or b'', 'more_body': False}]
+    if disconnect:
+        received.append({'type': 'http.disconnect'})
+    sent = []
+
+    async def receive():
+        if not received:
+            # the client is still there.
+            await asyncio.get_event_loop().create_future()
+        return received.pop(0)
+
+    async def send(message):
+        if message['type'] == ZEROCOPYSEND:
+            message = dict(message, file=message['file'].read())
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(application(scope, receive, send))
+    finally:
+        loop.close()
+    return sent
+
+
+def parse(sent):
+    start = sent[0]
+    headers = dict(
+        (k.decode('latin-1'), v.decode('latin-1'))
+        for k, v in start['headers'])
+    body = b''.join(m.get('body', b'') for m in sent[1:])
+    return start['status'], headers, body
+
+
+class FakeRenderer(object):
+
+    closed = False
+
+    def stream(self, mold_id, data, wrapper_tag='div'):
+        return iter([b'<div>', b'', b'</div>'])
+
+    def close(self):
+        self.closed = True
+
+
+class SupportTestCase(unittest.TestCase):
+
+    def test_request_headers(self):
+        self.assertEqual(request_headers({'headers': [
+            (b'if-none-match', b'"abc"'),
+            (b'accept-encoding', b'gzip'),
+            (b'accept-encoding', b'br'),
+        ]}), {
+            'If-None-Match': '"abc"',
+            'Accept-Encoding': 'gzip, br',
+        })
+
+
+class ApplicationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = DummyProvider('/nunja/', renderer=True)
+        self.application = Application(self.provider)
+
+    def test_object(self):
+        status, headers, body = parse(call(
+            self.application, '/nunja/some/object.js'))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'object:some/object.js')
+        self.assertEqual(headers['content-length'], '21')
+
+        status, headers, body = parse(call(
+            self.application, '/nunja/some/object.js',
+            headers=[('If-None-Match', headers['etag'])]))
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_head(self):
+        status, headers, body = parse(call(
+            self.application, '/nunja/some/object.js', method='HEAD'))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-length'], '21')
+        self.assertEqual(body, b'')
+
+    def test_not_found(self):
+        status, headers, body = parse(call(
+            self.application, '/nunja/notfound.js'))
+        self.assertEqual(status, 404)
+        status, headers, body = parse(call(self.application, '/elsewhere'))
+        self.assertEqual(status, 404)
+        self.assertEqual(body, b'404 NOT FOUND')
+
+    def test_method_not_allowed(self):
+        status, headers, body = parse(call(
+            self.application, '/nunja/a.js', method='DELETE'))
+        self.assertEqual(status, 405)
+        self.assertEqual(headers['allow'], 'GET, HEAD, POST')
+
+    def test_batch(self):
+        status, headers, body = parse(call(
+            self.application, '/nunja/_batch?id=b.js', method='POST',
+            body=b'["a.js"]'))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf8')), {
+            'a.js': {'content': 'object:a.js'},
+            'b.js': {'content': 'object:b.js'},
+        })
+
+    def test_stream(self):
+        self.provider.renderer = FakeRenderer()
+        sent = call(
+            self.application, '/nunja/_stream/pkg.mold/x', method='POST',
+            body=b'{}')
+        status, headers, body = parse(sent)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'<div></div>')
+        self.assertNotIn('content-length', headers)
+        self.assertEqual([m.get('more_body') for m in sent[1:]], [
+            True, True, None])
+
+    def test_events(self):
+        class FakeWatcher(object):
+            queue = Queue()
+
+            def subscribe(self):
+                return self.queue
+
+            def unsubscribe(self, queue):
+                pass
+
+        class NoExecutor(object):
+            def submit(self, fn, *a, **kw):
+                raise AssertionError('event streams must not use executor')
+
+        self.provider.watcher = FakeWatcher()
+        FakeWatcher.queue.put({'identifiers': ['a'], 'modules': []})
+        FakeWatcher.queue.put(None)
+        application = Application(self.provider, executor=NoExecutor())
+        sent = call(application, '/nunja/_events')
+        status, headers, body = parse(sent)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'text/event-stream')
+        self.assertEqual(body, (
+            b'retry: 1000\n\n'
+            b'data: {"identifiers": ["a"], "modules": []}\n\n'
+        ))
+        self.assertFalse(sent[-1].get('more_body'))
+
+    def test_events_disconnect(self):
+        class FakeWatcher(object):
+            queue = Queue()
+
+            def subscribe(self):
+                return self.queue
+
+            def unsubscribe(self, queue):
+                pass
+
+        stopped = []
+
+        class Forwarder(EventsForwarder):
+            def stop(self):
+                stopped.append(self)
+                EventsForwarder.stop(self)
+
+        stub_item_attr_value(self, asgi, 'EventsForwarder', Forwarder)
+        self.provider.watcher = FakeWatcher()
+        # the stream of the watcher never ends by itself.
+        sent = call(
+            Application(self.provider), '/nunja/_events', disconnect=True)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(len(stopped), 1)
+        # nothing more to be sent to the client that is gone.
+        self.assertTrue(all(m.get('more_body') for m in sent[1:]))
+
+    def test_lifespan(self):
+        self.provider.renderer = FakeRenderer()
+        messages = [
+            {'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(
+            self.application({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, [
+            'lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(self.provider.renderer.closed)
+
+    def test_fallback_app(self):
+        scopes = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope['type'])
+            await send({
+                'type': 'http.response.start', 'status': 200,
+                'headers': []})
+            await send({'type': 'http.response.body', 'body': b'app'})
+
+        application = Application(self.provider, app)
+        status, headers, body = parse(call(application, '/elsewhere'))
+        self.assertEqual(body, b'app')
+        status, headers, body = parse(call(application, '/nunja/a.js'))
+        self.assertEqual(body, b'object:a.js')
+        self.assertEqual(scopes, ['http'])
+
+
+class RJSProviderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_generated_mold_registry(self)
+        self.application = RJSProvider('/nunja/')()
+
+    def test_pathsend(self):
+        self.assertTrue(isinstance(self.application, Application))
+        sent = call(
+            self.application, '/nunja/' + script,
+            extensions={PATHSEND: {}})
+        self.assertEqual(sent[1]['type'], PATHSEND)
+        self.assertEqual(
+            sent[1]['path'], self.application.provider.index[script])
+        with open(sent[1]['path'], 'rb') as fd:
+            self.assertEqual(
+                dict(sent[0]['headers'])[b'content-length'],
+                str(len(fd.read())).encode('ascii'))
+
+    def test_zerocopysend(self):
+        sent = call(
+            self.application, '/nunja/' + script,
+            extensions={ZEROCOPYSEND: {}})
+        self.assertEqual(sent[1]['type'], ZEROCOPYSEND)
+        self.assertIn(b'define(', sent[1]['file'])
+
+    def test_both_extensions(self):
+        sent = call(
+            self.application, '/nunja/' + script,
+            extensions={PATHSEND: {}, ZEROCOPYSEND: {}})
+        self.assertEqual(sent[1]['type'], ZEROCOPYSEND)
+
+    def test_extensions_modified(self):
+        respond_nunja = asgi.respond_nunja
+
+        # modified after the body and validators were produced.
+        def respond_modified(provider, path, headers, body):
+            response = respond_nunja(provider, path, headers, body)
+            with open(response.path, 'w') as fd:
+                fd.write('modified')
+            return response
+
+        stub_item_attr_value(self, asgi, 'respond_nunja', respond_modified)
+        status, headers, body = parse(call(
+            self.application, '/nunja/' + script,
+            extensions={PATHSEND: {}, ZEROCOPYSEND: {}}))
+        self.assertEqual(headers['content-length'], str(len(body)))
+        self.assertIn(b'define(', body)
+
+    def test_no_extensions(self):
+        status, headers, body = parse(call(
+            self.application, '/nunja/' + script))
+        self.assertEqual(status, 200)
+        self.assertIn(b'define(', body)
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 import unittest
+import json
+import zlib
 
 from flask import Flask
 
 from nunja.serve.flask import RJSProvider
+from nunja.serve.offload import Offload
+from nunja.serve.offload import X_SENDFILE
+from nunja.serve.testing import setup_generated_mold_registry
 from nunja.serve.testing import setup_test_mold_registry
 from nunja.serve.testing import js_mimetypes
 
@@ -45,6 +50,151 @@ class RJSProviderTestCase(unittest.TestCase):
             '/nunja/nunja.mold/nunja.testing.mold/itemlist/index.js')
         self.assertIn(rv.headers['Content-Type'], js_mimetypes)
 
+    def test_acquire_conditional(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        url = '/nunja/nunja.mold/nunja.testing.mold/basic/template.nja'
+        rv = self.test_client.get(url)
+        etag = rv.headers['ETag']
+        self.assertIn('Last-Modified', rv.headers)
+        rv = self.test_client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+        rv = self.test_client.get('/nunja/config.js', headers={
+            'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+
+    def test_acquire_encoded(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        rv = self.test_client.get('/nunja/config.js', headers={
+            'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(rv.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(zlib.decompress(
+            rv.data, 16 + zlib.MAX_WBITS).startswith(b"(function() {"))
+
+    def test_acquire_bundle(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        rv = self.test_client.get('/nunja/_bundle/nunja.testing.mold/basic.js')
+        self.assertIn(rv.headers['Content-Type'], js_mimetypes)
+        self.assertTrue(rv.data.startswith(
+            b'define("text!nunja.testing.mold/basic/template.nja"'))
+
+    def test_acquire_batch(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        template = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        rv = self.test_client.get(
+            '/nunja/_batch?id=init.js&id=' + template)
+        self.assertEqual(rv.headers['Content-Type'], 'application/json')
+        result = json.loads(rv.data.decode('utf8'))
+        self.assertEqual(result[template], {
+            'content': '<span>{{ value }}</span>\n'})
+        self.assertTrue(
+            result['init.js']['content'].startswith("'use strict';"))
+
+        rv = self.test_client.post('/nunja/_batch', data=json.dumps([
+            'nunja.mold/missing']))
+        self.assertEqual(json.loads(rv.data.decode('utf8')), {
+            'nunja.mold/missing': {'error': 'not found'}})
+        rv = self.test_client.post('/nunja/_batch', data='invalid')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_acquire_metrics(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', metrics=True)
+        provider(self.app)
+        self.test_client.get('/nunja/config.js')
+        self.test_client.get('/nunja/nunja.mold/missing')
+        rv = self.test_client.get('/nunja/_metrics')
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+        text = rv.data.decode('utf8')
+        self.assertIn('nunja_requests_total{status="200"} 1\n', text)
+        self.assertIn('nunja_requests_total{status="404"} 1\n', text)
+
+    def test_acquire_metrics_disabled(self):
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        rv = self.test_client.get('/nunja/_metrics')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_acquire_events(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', watch={'inotify': False})
+        self.addCleanup(provider.watcher.stop)
+        provider(self.app)
+        rv = self.test_client.get('/nunja/_events', buffered=False)
+        self.assertEqual(rv.headers['Content-Type'], 'text/event-stream')
+        chunks = iter(rv.response)
+        self.assertEqual(next(chunks), b'retry: 1000\n\n')
+        provider.watcher.publish({'identifiers': [], 'modules': []})
+        self.assertEqual(
+            next(chunks), b'data: {"identifiers": [], "modules": []}\n\n')
+        rv.close()
+
+    def test_acquire_render(self):
+        setup_generated_mold_registry(self, core=True)
+        provider = RJSProvider('/nunja/', renderer=True)
+        provider(self.app)
+        rv = self.test_client.post(
+            '/nunja/_render/nunja_generated0.mold/m0',
+            data=json.dumps({'value': 'hello'}))
+        self.assertEqual(
+            rv.headers['Content-Type'], 'text/html; charset=utf-8')
+        self.assertIn(b'<div class="">hello</div>', rv.data)
+        rv = self.test_client.get('/nunja/_render/nunja_generated0.mold/m0')
+        self.assertEqual(rv.status_code, 200)
+        rv = self.test_client.get('/nunja/_render/nunja_generated0.mold/none')
+        self.assertEqual(rv.status_code, 404)
+        rv = self.test_client.post(
+            '/nunja/_render/nunja_generated0.mold/m0', data='invalid')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_acquire_stream(self):
+        setup_generated_mold_registry(self, core=True)
+        provider = RJSProvider('/nunja/', renderer=True)
+        provider(self.app)
+        rv = self.test_client.post(
+            '/nunja/_stream/nunja_generated0.mold/m0',
+            data=json.dumps({'value': 'hello'}), buffered=False)
+        self.assertTrue(rv.is_streamed)
+        self.assertNotIn('Content-Length', rv.headers)
+        self.assertIn(b'<div class="">hello</div>', b''.join(rv.response))
+        rv.close()
+        rv = self.test_client.get('/nunja/_stream/nunja_generated0.mold/none')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_acquire_fingerprinted(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', fingerprint=True)
+        provider(self.app)
+        path = provider.requirejs_config['paths']['nunja.testing.mold/basic']
+        rv = self.test_client.get('/nunja/' + path + '/template.nja')
+        self.assertEqual(rv.data, b'<span>{{ value }}</span>\n')
+        self.assertEqual(
+            rv.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        rv = self.test_client.get('/nunja/config.js')
+        self.assertEqual(rv.headers['Cache-Control'], 'no-cache')
+
+    def test_acquire_offloaded(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', offload=Offload(X_SENDFILE))
+        provider(self.app)
+        identifier = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        rv = self.test_client.get('/nunja/' + identifier)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(
+            rv.headers['X-Sendfile'], provider.fetch_path(identifier))
+        self.assertEqual(rv.data, b'')
+        rv = self.test_client.get('/nunja/config.js')
+        self.assertNotIn('X-Sendfile', rv.headers)
+
     def test_acquire_missing(self):
         provider = RJSProvider('/nunja/')
         provider(self.app)
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 import unittest
+import asyncio
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from sanic import Sanic
 from sanic import config
 
+from nunja.serve.compat import Queue
 from nunja.serve.sanic import RJSProvider
+from nunja.serve.offload import Offload
+from nunja.serve.offload import X_SENDFILE
+from nunja.serve.testing import setup_generated_mold_registry
 from nunja.serve.testing import setup_test_mold_registry
 from nunja.serve.testing import js_mimetypes
 
@@ -21,7 +28,8 @@ class RJSProviderTestCase(unittest.TestCase):
             self.LOGGING.update(config.LOGGING)
             config.LOGGING.clear()
 
-        self.app = Sanic('rjs_provider_test')
+        # the names of the apps are registered by the newer releases.
+        self.app = Sanic('rjs_provider_' + self._testMethodName)
 
     def tearDown(self):
         _log.level = self._log_level
@@ -56,6 +64,191 @@ class RJSProviderTestCase(unittest.TestCase):
             '/nunja/nunja.mold/nunja.testing.mold/itemlist/index.js')
         self.assertIn(response.headers['Content-Type'], js_mimetypes)
 
+    def test_acquire_conditional(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        url = '/nunja/nunja.mold/nunja.testing.mold/basic/template.nja'
+        request, response = self.app.test_client.get(url)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        request, response = self.app.test_client.get(url, headers={
+            'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+
+    def test_acquire_encoded(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        request, response = self.app.test_client.get(
+            '/nunja/config.js', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+    def test_acquire_bundle(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        request, response = self.app.test_client.get(
+            '/nunja/_bundle/nunja.testing.mold/basic.js')
+        self.assertIn(response.headers['Content-Type'], js_mimetypes)
+        self.assertTrue(response.text.startswith(
+            'define("text!nunja.testing.mold/basic/template.nja"'))
+
+    def test_acquire_batch(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/')
+        provider(self.app)
+        template = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        request, response = self.app.test_client.get(
+            '/nunja/_batch?id=init.js&id=' + template)
+        result = json.loads(response.text)
+        self.assertEqual(result[template], {
+            'content': '<span>{{ value }}</span>\n'})
+        request, response = self.app.test_client.post(
+            '/nunja/_batch', data=json.dumps(['nunja.mold/missing']))
+        self.assertEqual(json.loads(response.text), {
+            'nunja.mold/missing': {'error': 'not found'}})
+        request, response = self.app.test_client.post(
+            '/nunja/_batch', data='invalid')
+        self.assertEqual(response.status, 400)
+
+    def test_acquire_metrics(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', metrics=True)
+        provider(self.app)
+        self.app.test_client.get('/nunja/config.js')
+        self.app.test_client.get('/nunja/nunja.mold/missing')
+        request, response = self.app.test_client.get('/nunja/_metrics')
+        self.assertIn(
+            'nunja_requests_total{status="200"} 1\n', response.text)
+        self.assertIn(
+            'nunja_requests_total{status="404"} 1\n', response.text)
+
+    def test_acquire_events(self):
+        class FakeWatcher(object):
+            queue = Queue()
+
+            def subscribe(self):
+                return self.queue
+
+            def unsubscribe(self, queue):
+                pass
+
+        class NoExecutor(object):
+            def submit(self, fn, *a, **kw):
+                raise AssertionError('event streams must not use executor')
+
+        FakeWatcher.queue.put({'identifiers': ['a'], 'modules': []})
+        FakeWatcher.queue.put(None)
+        provider = RJSProvider('/nunja/', executor=NoExecutor())
+        provider.watcher = FakeWatcher()
+        provider(self.app)
+        request, response = self.app.test_client.get('/nunja/_events')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.text, (
+            'retry: 1000\n\n'
+            'data: {"identifiers": ["a"], "modules": []}\n\n'
+        ))
+
+    def test_acquire_render(self):
+        setup_generated_mold_registry(self, core=True)
+        provider = RJSProvider('/nunja/', renderer=True)
+        provider(self.app)
+        request, response = self.app.test_client.post(
+            '/nunja/_render/nunja_generated0.mold/m0',
+            data=json.dumps({'value': 'hello'}))
+        self.assertEqual(
+            response.headers['Content-Type'], 'text/html; charset=utf-8')
+        self.assertIn('<div class="">hello</div>', response.text)
+        request, response = self.app.test_client.get(
+            '/nunja/_render/nunja_generated0.mold/none')
+        self.assertEqual(response.status, 404)
+
+    def test_acquire_stream(self):
+        setup_generated_mold_registry(self, core=True)
+        provider = RJSProvider('/nunja/', renderer=True)
+        provider(self.app)
+        request, response = self.app.test_client.post(
+            '/nunja/_stream/nunja_generated0.mold/m0',
+            data=json.dumps({'value': 'hello'}))
+        self.assertIn('<div class="">hello</div>', response.text)
+        request, response = self.app.test_client.get(
+            '/nunja/_stream/nunja_generated0.mold/none')
+        self.assertEqual(response.status, 404)
+
+    def test_acquire_offloaded(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', offload=Offload(X_SENDFILE))
+        provider(self.app)
+        identifier = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        request, response = self.app.test_client.get('/nunja/' + identifier)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.headers['X-Sendfile'], provider.fetch_path(identifier))
+        self.assertEqual(response.body, b'')
+        request, response = self.app.test_client.get('/nunja/config.js')
+        self.assertNotIn('X-Sendfile', response.headers)
+
+    def test_acquire_streamed(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', stream_threshold=1)
+        provider(self.app)
+        url = '/nunja/nunja.mold/nunja.testing.mold/basic/template.nja'
+        request, response = self.app.test_client.get(url)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.text, '<span>{{ value }}</span>\n')
+        etag = response.headers['ETag']
+        # as the file is not read for it.
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIn('Last-Modified', response.headers)
+        # not read into the cache.
+        self.assertEqual(len(provider.cache), 0)
+        request, response = self.app.test_client.get(url, headers={
+            'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+
+        # the contents already in the cache provide the validators.
+        content = provider.fetch_content(
+            'nunja.mold/nunja.testing.mold/basic/template.nja')
+        request, response = self.app.test_client.get(url)
+        self.assertEqual(response.text, '<span>{{ value }}</span>\n')
+        self.assertEqual(response.headers['ETag'], content.etag)
+        self.assertEqual(
+            response.headers['Last-Modified'], content.last_modified)
+        # the core contents are never streamed.
+        request, response = self.app.test_client.get('/nunja/config.js')
+        self.assertTrue(response.text.startswith('(function() {'))
+
+    def test_acquire_not_streamed(self):
+        setup_test_mold_registry(self)
+        provider = RJSProvider('/nunja/', stream_threshold=None)
+        provider(self.app)
+        request, response = self.app.test_client.get(
+            '/nunja/nunja.mold/nunja.testing.mold/basic/template.nja')
+        self.assertEqual(response.text, '<span>{{ value }}</span>\n')
+        self.assertEqual(len(provider.cache), 1)
+
+    def test_acquire_executor_concurrency(self):
+        setup_test_mold_registry(self)
+        submitted = []
+
+        class Executor(ThreadPoolExecutor):
+            def submit(self, fn, *args, **kwargs):
+                submitted.append(fn)
+                return super(Executor, self).submit(fn, *args, **kwargs)
+
+        executor = Executor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        provider = RJSProvider(
+            '/nunja/', executor=executor, concurrency=2)
+        provider(self.app)
+        request, response = self.app.test_client.get(
+            '/nunja/nunja.mold/nunja.testing.mold/basic/template.nja')
+        self.assertEqual(response.text, '<span>{{ value }}</span>\n')
+        self.assertTrue(isinstance(provider.limit, asyncio.Semaphore))
+        self.assertTrue(submitted)
+
     def test_acquire_missing(self):
         provider = RJSProvider('/nunja/')
         provider(self.app)
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+import sys
+
+# the asyncio based server requires the async syntax of Python 3.5+
+AIO = sys.version_info >= (3, 5)
+
+if AIO:  # pragma: no cover
+    from nunja.serve.tests._test_aio import SupportTestCase  # noqa: F401
+    from nunja.serve.tests._test_aio import AsyncHTTPServerTestCase  # noqa
+    from nunja.serve.tests._test_aio import ServeTestCase  # noqa: F401
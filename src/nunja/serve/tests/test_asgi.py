@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+import sys
+
+# the ASGI application requires the async syntax of Python 3.5+
+ASGI = sys.version_info >= (3, 5)
+
+if ASGI:  # pragma: no cover
+    from nunja.serve.tests._test_asgi import SupportTestCase  # noqa: F401
+    from nunja.serve.tests._test_asgi import ApplicationTestCase  # noqa
+    from nunja.serve.tests._test_asgi import RJSProviderTestCase  # noqa
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
 import unittest
+import os
 from os.path import join
 
 from nunja.serve.base import BaseProvider
 from nunja.serve.base import fetch
+from nunja.serve.base import is_not_modified
+from nunja.serve.base import normalize
+from nunja.serve.base import open_body_file
+from nunja.serve.base import parse_batch
+from nunja.serve.base import Response
+from nunja.serve.cache import Content
+from nunja.serve.cache import ContentCache
+from nunja.serve.cache import stat_key
+from nunja.serve.metrics import Metrics
+from nunja.serve.render import Renderer
 
 from calmjs.testing.utils import mkdtemp
 from nunja.serve.testing import DummyProvider
+from nunja.serve.testing import setup_generated_mold_registry
 
 
 class BaseProviderTestCase(unittest.TestCase):
@@ -33,6 +45,328 @@ class BaseProviderTestCase(unittest.TestCase):
             provider.fetch_object('/some/path')
 
 
+def not_modified(content, headers):
+    return is_not_modified(headers, content.etag, content.mtime)
+
+
+class SupportTestCase(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize(''), '')
+        self.assertEqual(normalize('//some//where/'), 'some/where')
+
+    def test_is_not_modified_etag(self):
+        content = Content(b'hello')
+        self.assertFalse(not_modified(content, {}))
+        self.assertTrue(not_modified(content, {
+            'If-None-Match': content.etag}))
+        self.assertTrue(not_modified(content, {
+            'If-None-Match': '"other", W/' + content.etag}))
+        self.assertTrue(not_modified(content, {'If-None-Match': '*'}))
+        self.assertFalse(not_modified(content, {
+            'If-None-Match': '"other"'}))
+        # If-None-Match takes precedence
+        self.assertFalse(not_modified(content, {
+            'If-None-Match': '"other"',
+            'If-Modified-Since': content.last_modified,
+        }))
+
+    def test_is_not_modified_weak(self):
+        self.assertTrue(is_not_modified(
+            {'If-None-Match': 'W/"1-2"'}, 'W/"1-2"', 0))
+        self.assertTrue(is_not_modified(
+            {'If-None-Match': '"1-2"'}, 'W/"1-2"', 0))
+        self.assertFalse(is_not_modified(
+            {'If-None-Match': 'W/"1-3"'}, 'W/"1-2"', 0))
+
+    def test_is_not_modified_since(self):
+        content = Content(b'hello', key=(1000000000.5, 5, 1))
+        self.assertTrue(not_modified(content, {
+            'If-Modified-Since': content.last_modified}))
+        self.assertTrue(not_modified(content, {
+            'If-Modified-Since': 'Sun, 09 Sep 2001 01:46:41 GMT'}))
+        self.assertFalse(not_modified(content, {
+            'If-Modified-Since': 'Sun, 09 Sep 2001 01:46:39 GMT'}))
+        self.assertFalse(not_modified(content, {
+            'If-Modified-Since': 'garbage'}))
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def test_parse_batch(self):
+        self.assertEqual(parse_batch(''), [])
+        self.assertEqual(parse_batch('id=a&id=b/c&other=d'), ['a', 'b/c'])
+        self.assertEqual(parse_batch('id=a', b'["b", "c"]'), ['a', 'b', 'c'])
+        self.assertEqual(parse_batch('', '["b"]'), ['b'])
+
+    def test_parse_batch_errors(self):
+        with self.assertRaises(ValueError):
+            parse_batch('', b'not json')
+        with self.assertRaises(ValueError):
+            parse_batch('', b'{"id": "a"}')
+        with self.assertRaises(ValueError):
+            parse_batch('id=a&id=b', limit=1)
+
+    def test_fetch_batch(self):
+        provider = DummyProvider('/base/', core_subpaths=('config.js',))
+        result = provider.fetch_batch(['config.js', 'obj', '/notfound'])
+        self.assertEqual(result, {
+            'config.js': {'content': 'config:config.js'},
+            'obj': {'content': 'object:obj'},
+            '/notfound': {'error': 'not found'},
+        })
+
+    def test_fetch_batch_serial(self):
+        provider = DummyProvider('/base/', core_subpaths=('config.js',))
+        provider.batch_workers = 1
+        self.assertIs(provider.batch_map(), map)
+        self.assertEqual(provider.fetch_batch(['obj']), {
+            'obj': {'content': 'object:obj'}})
+
+    def test_fetch_batch_not_text(self):
+        provider = DummyProvider('/base/', core_subpaths=('config.js',))
+        provider.fetch_content = lambda identifier: Content(b'\xff')
+        self.assertEqual(provider.fetch_batch(['obj']), {
+            'obj': {'error': 'not text'}})
+
+    def test_respond_batch(self):
+        provider = DummyProvider('/base/', core_subpaths=('config.js',))
+        response = provider.respond_batch(['obj'])
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.headers['Content-Type'], 'application/json')
+        self.assertEqual(
+            response.body, b'{"obj": {"content": "object:obj"}}')
+        response = provider.respond_batch(['obj'], {
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status, 304)
+
+
+class PathProvider(BaseProvider):
+
+    def fetch_path(self, identifier):
+        return join(self.root, identifier)
+
+
+class BaseProviderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp(self)
+        with open(join(self.root, 'file'), 'w') as fd:
+            fd.write('hello')
+
+    def test_default_cache(self):
+        provider = PathProvider('/base/')
+        provider.root = self.root
+        self.assertTrue(isinstance(provider.cache, ContentCache))
+        self.assertEqual(provider.fetch('/base/file'), 'hello')
+        self.assertEqual(provider.fetch('/base/file'), 'hello')
+        self.assertEqual(provider.cache.hits, 1)
+        self.assertEqual(provider.cache.misses, 1)
+
+    def test_custom_cache(self):
+        cache = ContentCache(max_bytes=1)
+        provider = PathProvider('/base/', cache=cache)
+        provider.root = self.root
+        self.assertIs(provider.cache, cache)
+        self.assertEqual(provider.fetch('/base/file'), 'hello')
+        self.assertEqual(len(cache), 0)
+
+    def test_no_cache(self):
+        provider = PathProvider('/base/', cache=False)
+        provider.root = self.root
+        self.assertIsNone(provider.cache)
+        self.assertEqual(provider.fetch('/base/file'), 'hello')
+
+    def test_respond(self):
+        provider = PathProvider('/base/')
+        provider.root = self.root
+        response = provider.respond('file')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b'hello')
+        self.assertEqual(response.headers['Content-Length'], '5')
+        self.assertEqual(response.headers['Content-Type'], 'text/plain')
+        self.assertEqual(response.path, join(self.root, 'file'))
+        self.assertEqual(response.key, stat_key(response.path))
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+
+        response = provider.respond('/file', {'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertNotIn('Content-Length', response.headers)
+
+        response = provider.respond('missing')
+        self.assertEqual(response.status, 404)
+        self.assertEqual(response.body, b'404 NOT FOUND')
+
+    def test_open_body_file(self):
+        provider = PathProvider('/base/')
+        provider.root = self.root
+        response = provider.respond('file')
+        with open_body_file(response) as source:
+            self.assertEqual(source.name, response.path)
+            self.assertEqual(source.read(), response.body)
+
+        # no longer the file that the response was produced from.
+        with open(response.path, 'w') as fd:
+            fd.write('goodbye')
+        self.assertIsNone(open_body_file(response))
+        response = provider.respond('file')
+        with open_body_file(response) as source:
+            self.assertEqual(source.read(), b'goodbye')
+
+        os.unlink(response.path)
+        self.assertIsNone(open_body_file(response))
+        self.assertIsNone(open_body_file(provider.respond('missing')))
+        self.assertIsNone(open_body_file(Response(200, {}, b'', __file__)))
+
+    def test_respond_encoded(self):
+        with open(join(self.root, 'large'), 'w') as fd:
+            fd.write('hello world' * 100)
+        provider = PathProvider('/base/', encodings=('gzip', 'unknown'))
+        provider.root = self.root
+        self.assertEqual(provider.encodings, ('gzip',))
+
+        response = provider.respond('large')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Encoding', response.headers)
+        etag = response.headers['ETag']
+
+        response = provider.respond('large', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], etag[:-1] + '-gzip"')
+        self.assertIsNone(response.path)
+        self.assertEqual(
+            response.headers['Content-Length'], str(len(response.body)))
+        self.assertEqual(response.body, provider.cache.get(
+            join(self.root, 'large')).variants['gzip'])
+        self.assertEqual(provider.cache.total_bytes, 1100 + len(
+            response.body))
+
+        response = provider.respond('large', {
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': response.headers['ETag'],
+        })
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        # too small to be worth compressing
+        response = provider.respond('file', {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, b'hello')
+
+    def test_respond_not_modified_not_encoded(self):
+        with open(join(self.root, 'large'), 'w') as fd:
+            fd.write('hello world' * 100)
+        provider = PathProvider('/base/', encodings=('gzip',), cache=False)
+        provider.root = self.root
+        encoded = []
+        encode = provider.encode
+
+        def counting_encode(content, coding):
+            encoded.append(coding)
+            return encode(content, coding)
+
+        provider.encode = counting_encode
+        headers = {'Accept-Encoding': 'gzip'}
+        response = provider.respond('large', headers)
+        self.assertEqual(encoded, ['gzip'])
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        for conditional in (
+                {'If-None-Match': etag}, {'If-None-Match': etag},
+                {'If-Modified-Since': last_modified}):
+            conditional.update(headers)
+            response = provider.respond('large', conditional)
+            self.assertEqual(response.status, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(encoded, ['gzip'])
+
+    def test_respond_unencoded(self):
+        with open(join(self.root, 'large'), 'w') as fd:
+            fd.write('hello world' * 100)
+        provider = PathProvider('/base/', encodings=())
+        provider.root = self.root
+        response = provider.respond('large', {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Vary', response.headers)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_respond_precompressed(self):
+        with open(join(self.root, 'large'), 'w') as fd:
+            fd.write('hello world' * 100)
+        with open(join(self.root, 'large.gz'), 'wb') as fd:
+            fd.write(b'precompressed')
+        provider = PathProvider('/base/', precompressed=True)
+        provider.root = self.root
+        response = provider.respond('large', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.body, b'precompressed')
+
+    def test_respond_cache_control(self):
+        provider = PathProvider('/base/')
+        provider.root = self.root
+        self.assertNotIn('Cache-Control', provider.respond('file').headers)
+        provider.cache_control = lambda identifier: 'no-cache'
+        self.assertEqual(
+            provider.respond('file').headers['Cache-Control'], 'no-cache')
+        self.assertNotIn('Cache-Control', provider.respond('none').headers)
+
+    def test_respond_not_modified_unread(self):
+        provider = PathProvider('/base/')
+        provider.root = self.root
+        etag = provider.respond('file').headers['ETag']
+        provider.cache.loader = None
+        response = provider.respond('file', {'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+
+    def test_respond_metrics(self):
+        provider = PathProvider('/base/', metrics=True)
+        provider.root = self.root
+        self.assertTrue(isinstance(provider.metrics, Metrics))
+        provider.respond('file')
+        provider.respond('file')
+        provider.respond('missing')
+        response = provider.respond_metrics()
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith(
+            'text/plain; version=0.0.4'))
+        text = response.body.decode('utf8')
+        self.assertIn('nunja_requests_total{status="200"} 2\n', text)
+        self.assertIn('nunja_requests_total{status="404"} 1\n', text)
+        self.assertIn('nunja_response_bytes_total 23\n', text)
+        self.assertIn('nunja_request_seconds_count 3\n', text)
+        self.assertIn(
+            'nunja_phase_seconds_count{phase="normalize"} 3\n', text)
+        self.assertIn('nunja_phase_seconds_count{phase="resolve"} 3\n', text)
+        # the missing file failed to be read.
+        self.assertIn('nunja_phase_seconds_count{phase="read"} 3\n', text)
+        self.assertIn('nunja_cache_hits_total 1\n', text)
+        self.assertIn('nunja_cache_misses_total 1\n', text)
+
+    def test_respond_metrics_encode(self):
+        with open(join(self.root, 'large'), 'w') as fd:
+            fd.write('hello world' * 100)
+        provider = PathProvider('/base/', metrics=True)
+        provider.root = self.root
+        provider.respond('large', {'Accept-Encoding': 'gzip'})
+        text = provider.respond_metrics().body.decode('utf8')
+        self.assertIn('nunja_phase_seconds_count{phase="encode"} 1\n', text)
+
+    def test_respond_metrics_disabled(self):
+        provider = PathProvider('/base/', metrics=False)
+        self.assertIsNone(provider.metrics)
+        self.assertEqual(provider.respond_metrics().status, 404)
+
+    def test_missing_file(self):
+        provider = PathProvider('/base/')
+        provider.root = self.root
+        with self.assertRaises(KeyError):
+            provider.fetch('/base/missing')
+
+
 class DummyProviderTestCase(unittest.TestCase):
     """
     For testing/formalising calling conventions for serving
@@ -49,9 +383,168 @@ class DummyProviderTestCase(unittest.TestCase):
         with self.assertRaises(KeyError):
             provider.fetch('/base/notfound')
 
+    def test_base_provider_respond(self):
+        # only fetch_core and fetch_object are implemented.
+        provider = DummyProvider('/base/', core_subpaths=('config.js',))
+        response = provider.respond('an_object')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b'object:an_object')
+        self.assertEqual(provider.respond('notfound').status, 404)
+
+    def test_base_provider_core_content(self):
+        provider = DummyProvider('/base/', core_subpaths=('config.js',))
+        content = provider.fetch_content('config.js')
+        self.assertIs(provider.fetch_content('config.js'), content)
+        last_modified = provider.respond('config.js').headers['Last-Modified']
+        self.assertEqual(provider.respond('config.js').headers[
+            'Last-Modified'], last_modified)
+
+        # a new version once the contents produced differ.
+        provider.fetch_core = lambda identifier: 'changed'
+        changed = provider.fetch_content('config.js')
+        self.assertIsNot(changed, content)
+        self.assertEqual(changed.data, b'changed')
+
     def test_get_path_fetch_good(self):
         p = join(mkdtemp(self), 'file')
         with open(p, 'w') as fd:
             fd.write('hello')
         result = fetch(p)
         self.assertEqual(result, 'hello')
+
+
+class BaseProviderRenderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_generated_mold_registry(self, core=True)
+        self.provider = DummyProvider('/base/', renderer=True)
+
+    def test_renderer(self):
+        self.assertTrue(isinstance(self.provider.renderer, Renderer))
+        self.assertIsNone(DummyProvider('/base/').renderer)
+        self.assertIsNone(DummyProvider('/base/', renderer=False).renderer)
+
+    def test_respond_render(self):
+        response = self.provider.respond_render(
+            'nunja_generated0.mold/m0', b'{"value": "hi"}')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.headers['Content-Type'], 'text/html; charset=utf-8')
+        self.assertIn(b'data-nunja="nunja_generated0.mold/m0"', response.body)
+        self.assertIn(b'<div class="">hi</div>', response.body)
+
+        response = self.provider.respond_render(
+            '/nunja_generated0.mold/m0/', None, {
+                'If-None-Match': response.headers['ETag']})
+        self.assertNotEqual(response.status, 304)
+        etag = self.provider.respond_render(
+            'nunja_generated0.mold/m0').headers['ETag']
+        self.assertEqual(self.provider.respond_render(
+            'nunja_generated0.mold/m0', None, {
+                'If-None-Match': etag}).status, 304)
+
+    def test_respond_render_errors(self):
+        self.assertEqual(self.provider.respond_render(
+            'nunja_generated0.mold/m0', b'[]').status, 400)
+        self.assertEqual(self.provider.respond_render(
+            'nunja_generated0.mold/none').status, 404)
+        self.assertEqual(DummyProvider('/base/').respond_render(
+            'nunja_generated0.mold/m0').status, 404)
+
+    def test_respond_render_failure(self):
+        class Broken(Renderer):
+            def execute(self, mold_id, data):
+                raise TypeError('broken')
+
+        provider = DummyProvider('/base/', renderer=Broken())
+        response = provider.respond_render('nunja_generated0.mold/m0')
+        self.assertEqual(response.status, 500)
+
+    def test_respond_render_cache(self):
+        executed = []
+
+        class Counting(Renderer):
+            def execute(self, mold_id, data, wrapper_tag='div'):
+                executed.append(mold_id)
+                return super(Counting, self).execute(
+                    mold_id, data, wrapper_tag)
+
+        provider = DummyProvider(
+            '/base/', renderer=Counting(), render_cache=True, metrics=True)
+        first = provider.respond_render(
+            'nunja_generated0.mold/m0', b'{"value": 1, "cls": "a"}')
+        second = provider.respond_render(
+            'nunja_generated0.mold/m0', b'{"cls": "a", "value": 1}')
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(executed, ['nunja_generated0.mold/m0'])
+        provider.respond_render(
+            'nunja_generated0.mold/m0', b'{"cls": "a", "value": 2}')
+        self.assertEqual(len(executed), 2)
+        self.assertEqual(provider.respond_render(
+            'nunja_generated0.mold/none').status, 404)
+
+        # the compressed variant is accounted for.
+        provider.respond_render(
+            'nunja_generated0.mold/m0', b'{"value": 1, "cls": "a"}', {
+                'Accept-Encoding': 'gzip'})
+        text = provider.respond_metrics().body.decode('utf8')
+        self.assertIn('nunja_render_cache_hits_total 2\n', text)
+        self.assertIn('nunja_render_cache_misses_total 2\n', text)
+        self.assertIn('nunja_render_cache_entries 2\n', text)
+
+    def test_respond_render_cache_changed(self):
+        provider = DummyProvider('/base/', renderer=True, render_cache=True)
+        body = provider.respond_render('nunja_generated0.mold/m0').body
+        path = provider.renderer.engine.lookup_path(
+            'nunja_generated0.mold/m0/template.nja')
+        with open(path, 'w') as fd:
+            fd.write('<p>changed</p>\n')
+        os.utime(path, (1000, 1000))
+        self.assertNotEqual(
+            provider.respond_render('nunja_generated0.mold/m0').body, body)
+
+    def test_respond_render_stream(self):
+        response = self.provider.respond_render_stream(
+            'nunja_generated0.mold/m0', b'{"value": "hi"}')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers, {
+            'Content-Type': 'text/html; charset=utf-8'})
+        self.assertEqual(response.body, b'')
+        self.assertEqual(
+            b''.join(response.chunks),
+            self.provider.respond_render(
+                'nunja_generated0.mold/m0', b'{"value": "hi"}').body)
+
+    def test_respond_render_stream_errors(self):
+        self.assertEqual(self.provider.respond_render_stream(
+            'nunja_generated0.mold/m0', b'[]').status, 400)
+        self.assertEqual(self.provider.respond_render_stream(
+            'nunja_generated0.mold/none').status, 404)
+        self.assertEqual(DummyProvider('/base/').respond_render_stream(
+            'nunja_generated0.mold/m0').status, 404)
+
+        class Broken(Renderer):
+            def stream(self, mold_id, data):
+                raise TypeError('broken')
+
+        self.assertEqual(DummyProvider(
+            '/base/', renderer=Broken()).respond_render_stream(
+                'nunja_generated0.mold/m0').status, 500)
+
+        class Failing(Renderer):
+            def stream(self, mold_id, data):
+                yield b'partial'
+                raise TypeError('broken')
+
+        response = DummyProvider(
+            '/base/', renderer=Failing()).respond_render_stream(
+                'nunja_generated0.mold/m0')
+        # the stream ends where the failure happened.
+        self.assertEqual(list(response.chunks), [b'partial'])
+
+    def test_respond_render_metrics(self):
+        provider = DummyProvider('/base/', renderer=True, metrics=True)
+        provider.respond_render('nunja_generated0.mold/m0')
+        self.assertIn(
+            'nunja_phase_seconds_count{phase="render"} 1',
+            provider.respond_metrics().body.decode('utf8'))
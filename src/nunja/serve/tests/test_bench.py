@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+import socket
+from os.path import join
+
+from calmjs.registry import _inst as default_registry
+from calmjs.testing.utils import mkdtemp
+
+from nunja.serve.bench import PACKAGES
+from nunja.serve.bench import REGISTRY_NAME
+from nunja.serve.bench import main
+from nunja.serve.bench import make_categories
+from nunja.serve.bench import make_registry
+from nunja.serve.bench import register
+from nunja.serve.bench import run
+from nunja.serve.bench.client import percentile
+from nunja.serve.bench.servers import adapters
+from nunja.serve.bench.client import summarize
+from nunja.serve.bench import scale
+from nunja.serve.compat import HTTPConnection
+from nunja.serve.rjs import Provider
+from nunja.serve.testing import setup_generated_mold_registry
+from nunja.serve.testing import remove_generated_packages
+
+
+class ClientTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1), 100)
+        self.assertEqual(percentile(values, 0), 1)
+
+    def test_summarize(self):
+        result = summarize([0.002, 0.001, 0.003, 0.004], [1, 2, 3, 4], 1, 2.0)
+        self.assertEqual(result['requests'], 4)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(result['rps'], 2.0)
+        self.assertEqual(result['p50'], 2.0)
+        self.assertEqual(result['p99'], 4.0)
+        self.assertEqual(result['bytes'], 10)
+        self.assertIsNone(summarize([], [], 0, 0)['p50'])
+
+
+class BenchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp(self)
+
+        def cleanup():
+            default_registry.records.pop(REGISTRY_NAME, None)
+            remove_generated_packages(self.root, PACKAGES)
+
+        self.addCleanup(cleanup)
+
+    def test_make_registry(self):
+        mold_ids = make_registry(self.root, molds=2, script_size=1000)
+        register(self.root)
+        provider = Provider('/nunja/', registry_names=(REGISTRY_NAME,))
+        self.assertEqual(
+            mold_ids, ['nunja_bench0.mold/m0', 'nunja_bench0.mold/m1'])
+        identifier = REGISTRY_NAME + '/nunja_bench0.mold/m1/index.js'
+        self.assertIn(identifier, provider.index)
+        self.assertTrue(len(provider.fetch_content(identifier).data) > 900)
+
+    def test_run_simple(self):
+        mold_ids = make_registry(self.root, molds=2, script_size=1000)
+        register(self.root)
+        results = run(
+            ['simple'], make_categories(mold_ids), requests=10, concurrency=2)
+        self.assertEqual(
+            sorted(results['simple']),
+            ['core', 'not_found', 'script', 'template'])
+        for category in results['simple'].values():
+            self.assertEqual(category['requests'], 10)
+            self.assertEqual(category['errors'], 0)
+        self.assertTrue(results['simple']['script']['bytes'] > 10000)
+
+    def test_start_adapters(self):
+        make_registry(self.root, molds=1, script_size=1000)
+        register(self.root)
+        for name, start in sorted(adapters.items()):
+            try:
+                server = start((REGISTRY_NAME,), workers=2)
+            except ImportError:
+                continue
+            try:
+                conn = HTTPConnection(server.host, server.port, timeout=5)
+                conn.request('GET', '/nunja/config.js')
+                self.assertEqual(conn.getresponse().status, 200, name)
+                conn.close()
+            finally:
+                server.stop()
+            # served apart from the process of the clients.
+            self.assertRaises(
+                (IOError, OSError), socket.create_connection,
+                (server.host, server.port), 1)
+
+    def test_main(self):
+        output = join(self.root, 'report.json')
+        main(args=[
+            '--adapter', 'simple', '-n', '4', '-c', '1', '--molds', '1',
+            '-o', output, '--gzip',
+        ])
+        with open(output) as fd:
+            report = json.load(fd)
+        self.assertTrue(report['gzip'])
+        self.assertEqual(
+            report['results']['simple']['core']['requests'], 4)
+        self.assertNotIn(REGISTRY_NAME, default_registry.records)
+
+
+class ScaleTestCase(unittest.TestCase):
+
+    def test_setup_generated_mold_registry(self):
+        mold_ids = setup_generated_mold_registry(
+            self, packages=3, molds=2, name='nunja.generated.mold')
+        self.assertEqual(len(mold_ids), 6)
+        self.assertEqual(mold_ids[-1], 'nunja_generated2.mold/m1')
+        provider = Provider(
+            '/nunja/', registry_names=('nunja.generated.mold',))
+        self.assertEqual(len(provider.index), 12)
+        self.assertIn(
+            'nunja.generated.mold/nunja_generated1.mold/m0/template.nja',
+            provider.index)
+
+    def test_time_lookups_reset(self):
+        cached = {}
+        calls = []
+
+        def lookup(identifier):
+            if identifier not in cached:
+                calls.append(identifier)
+                cached[identifier] = identifier
+
+        scale.time_lookups(lookup, ['a', 'b'], rounds=3)
+        self.assertEqual(calls, ['a', 'b'])
+        del calls[:]
+        scale.time_lookups(lookup, ['a', 'b'], rounds=3, reset=cached.clear)
+        self.assertEqual(calls, ['a', 'b'] * 3)
+
+    def test_measure(self):
+        result = scale.measure(20, per_package=5, samples=4)
+        self.assertEqual(result['molds'], 20)
+        self.assertEqual(result['packages'], 4)
+        self.assertEqual(result['index_entries'], 40)
+        self.assertTrue(result['config_bytes'] > 0)
+        self.assertTrue(result['lookup_us'] < result['fallback_lookup_us'])
+        self.assertNotIn(scale.REGISTRY_NAME, default_registry.records)
+
+    def test_main(self):
+        output = join(mkdtemp(self), 'report.json')
+        scale.main(args=['3', '--per-package', '2', '-o', output])
+        with open(output) as fd:
+            report = json.load(fd)
+        self.assertEqual(report['per_package'], 2)
+        self.assertEqual(report['results'][0]['molds'], 2)
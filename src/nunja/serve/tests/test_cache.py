@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import threading
+from os.path import join
+
+from calmjs.testing.utils import mkdtemp
+
+from nunja.serve.cache import Content
+from nunja.serve.cache import ContentCache
+from nunja.serve.cache import RenderCache
+from nunja.serve.cache import load
+from nunja.serve.cache import stat_key
+from nunja.serve.testing import write_file
+
+
+class ContentTestCase(unittest.TestCase):
+
+    def test_content_basic(self):
+        content = Content(u'\u2603'.encode('utf8'))
+        self.assertEqual(content.text, u'\u2603')
+        self.assertEqual(content.size, 3)
+        self.assertIsNone(content.key)
+        self.assertTrue(content.etag.startswith('"'))
+        self.assertTrue(content.last_modified.endswith('GMT'))
+
+    def test_content_validators(self):
+        self.assertEqual(
+            Content(b'hello').etag,
+            '"aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d"')
+        self.assertNotEqual(Content(b'hello').etag, Content(b'world').etag)
+        self.assertEqual(
+            Content(b'', key=(0, 0, 0)).last_modified,
+            'Thu, 01 Jan 1970 00:00:00 GMT')
+
+    def test_content_variant(self):
+        data = b'hello world' * 100
+        content = Content(data)
+        result = content.variant('gzip')
+        self.assertTrue(len(result) < len(data))
+        self.assertIs(content.variant('gzip'), result)
+        self.assertEqual(content.footprint, len(data) + len(result))
+        self.assertIsNone(Content(b'hello').variant('gzip'))
+
+    def test_content_variant_precompressed(self):
+        p = join(mkdtemp(self), 'file')
+        write_file(p, 'hello world' * 100, mtime=1000)
+        write_file(p + '.gz', 'precompressed', mtime=1000)
+        self.assertNotEqual(load(p).variant('gzip'), b'precompressed')
+        self.assertEqual(load(p).variant('gzip', True), b'precompressed')
+        os.utime(p + '.gz', (0, 0))
+        self.assertNotEqual(load(p).variant('gzip', True), b'precompressed')
+
+    def test_load(self):
+        p = join(mkdtemp(self), 'file')
+        write_file(p, 'hello', mtime=1000)
+        content = load(p)
+        self.assertEqual(content.data, b'hello')
+        self.assertEqual(content.path, p)
+        self.assertEqual(content.key, stat_key(p))
+        self.assertEqual(content.mtime, 1000)
+
+
+class ContentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(self)
+        self.loaded = []
+
+    def loader(self, path):
+        self.loaded.append(path)
+        return load(path)
+
+    def test_stat_key(self):
+        p = join(self.tmpdir, 'file')
+        write_file(p, 'hello', mtime=1000)
+        key = stat_key(p)
+        self.assertEqual(key[:2], (1000, 5))
+        write_file(p, 'hello', mtime=2000)
+        self.assertNotEqual(key, stat_key(p))
+
+    def test_get_hit_miss(self):
+        p = join(self.tmpdir, 'file')
+        write_file(p, 'hello')
+        cache = ContentCache(self.loader)
+        self.assertEqual(cache.get(p).text, 'hello')
+        self.assertEqual(cache.get(p).text, 'hello')
+        self.assertEqual(self.loaded, [p])
+        self.assertIn(p, cache)
+        self.assertEqual(cache.stats(), {
+            'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1,
+            'bytes': 5,
+        })
+
+    def test_peek(self):
+        p = join(self.tmpdir, 'file')
+        write_file(p, 'hello', mtime=1000)
+        cache = ContentCache(self.loader)
+        self.assertIsNone(cache.peek(p, stat_key(p)))
+        content = cache.get(p)
+        self.assertIs(cache.peek(p, stat_key(p)), content)
+        write_file(p, 'goodbye', mtime=2000)
+        self.assertIsNone(cache.peek(p, stat_key(p)))
+        # never read by the peek.
+        self.assertEqual(self.loaded, [p])
+
+    def test_get_stale(self):
+        p = join(self.tmpdir, 'file')
+        write_file(p, 'hello', mtime=1000)
+        cache = ContentCache(self.loader)
+        self.assertEqual(cache.get(p).text, 'hello')
+        write_file(p, 'goodbye', mtime=2000)
+        self.assertEqual(cache.get(p).text, 'goodbye')
+        self.assertEqual(self.loaded, [p, p])
+        self.assertEqual(cache.total_bytes, 7)
+        self.assertEqual(len(cache), 1)
+
+    def test_get_missing(self):
+        cache = ContentCache(self.loader)
+        with self.assertRaises(OSError):
+            cache.get(join(self.tmpdir, 'missing'))
+
+    def test_eviction(self):
+        paths = [join(self.tmpdir, str(i)) for i in range(3)]
+        for p in paths:
+            write_file(p, '1234')
+        cache = ContentCache(self.loader, max_bytes=8)
+        cache.get(paths[0])
+        cache.get(paths[1])
+        # refresh the first one so the second is the least recent
+        cache.get(paths[0])
+        cache.get(paths[2])
+        self.assertIn(paths[0], cache)
+        self.assertNotIn(paths[1], cache)
+        self.assertIn(paths[2], cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.total_bytes, 8)
+
+    def test_oversized_not_stored(self):
+        p = join(self.tmpdir, 'file')
+        write_file(p, 'hello')
+        cache = ContentCache(self.loader, max_bytes=4)
+        self.assertEqual(cache.get(p).text, 'hello')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_update(self):
+        paths = [join(self.tmpdir, str(i)) for i in range(2)]
+        for p in paths:
+            write_file(p, 'x' * 1000)
+        cache = ContentCache(self.loader, max_bytes=2010)
+        first = cache.get(paths[0])
+        cache.get(paths[1])
+        self.assertEqual(cache.total_bytes, 2000)
+        first.variant('gzip')
+        cache.update(first)
+        self.assertEqual(cache.total_bytes, first.footprint)
+        self.assertNotIn(paths[1], cache)
+        self.assertEqual(cache.evictions, 1)
+        # not updated for contents not in the cache.
+        cache.update(load(paths[1]))
+        self.assertNotIn(paths[1], cache)
+
+    def test_invalidate_clear(self):
+        p = join(self.tmpdir, 'file')
+        write_file(p, 'hello')
+        cache = ContentCache(self.loader)
+        cache.get(p)
+        self.assertTrue(cache.invalidate(p))
+        self.assertFalse(cache.invalidate(p))
+        self.assertEqual(cache.total_bytes, 0)
+        cache.get(p)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.total_bytes, 0)
+
+
+class RenderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.produced = []
+
+    def timer(self):
+        return self.now
+
+    def producer(self, data):
+        def produce():
+            self.produced.append(data)
+            return Content(data)
+        return produce
+
+    def test_get(self):
+        cache = RenderCache(timer=self.timer)
+        key = ('mold/a', (1,), 'digest')
+        content = cache.get(key, self.producer(b'hello'))
+        self.assertIs(cache.get(key, self.producer(b'other')), content)
+        self.assertEqual(self.produced, [b'hello'])
+        self.assertIn(key, cache)
+        self.assertEqual(cache.stats(), {
+            'hits': 1, 'misses': 1, 'evictions': 0, 'coalesced': 0,
+            'entries': 1, 'bytes': 5,
+        })
+
+    def test_ttl(self):
+        cache = RenderCache(ttl=10, timer=self.timer)
+        key = ('mold/a', (1,), 'digest')
+        cache.get(key, self.producer(b'first'))
+        self.now += 9
+        self.assertEqual(cache.get(key, self.producer(b'next')).data, b'first')
+        self.now += 1
+        self.assertEqual(cache.get(key, self.producer(b'next')).data, b'next')
+        self.assertEqual(cache.total_bytes, 4)
+
+    def test_max_bytes(self):
+        cache = RenderCache(max_bytes=10, timer=self.timer)
+        cache.get(('a', (), '1'), self.producer(b'x' * 6))
+        cache.get(('a', (), '2'), self.producer(b'x' * 6))
+        self.assertNotIn(('a', (), '1'), cache)
+        self.assertEqual(cache.evictions, 1)
+        cache.get(('a', (), '3'), self.producer(b'x' * 11))
+        self.assertNotIn(('a', (), '3'), cache)
+        self.assertEqual(cache.total_bytes, 6)
+
+    def test_update(self):
+        cache = RenderCache(timer=self.timer)
+        content = cache.get(('a', (), '1'), self.producer(b'x' * 1000))
+        content.variant('gzip')
+        cache.update(content)
+        self.assertEqual(cache.total_bytes, content.footprint)
+        # not updated for contents not in the cache.
+        cache.update(Content(b'other'))
+        self.assertEqual(cache.total_bytes, content.footprint)
+
+    def test_invalidate_clear(self):
+        cache = RenderCache(timer=self.timer)
+        cache.get(('mold/a', (1,), '1'), self.producer(b'a1'))
+        cache.get(('mold/a', (2,), '1'), self.producer(b'a2'))
+        cache.get(('mold/b', (1,), '1'), self.producer(b'b1'))
+        self.assertEqual(cache.invalidate('mold/a'), 2)
+        self.assertEqual(cache.invalidate('mold/a'), 0)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.total_bytes, 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_single_flight(self):
+        cache = RenderCache(timer=self.timer)
+        key = ('mold/a', (1,), 'digest')
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def produce():
+            started.set()
+            release.wait()
+            self.produced.append(key)
+            return Content(b'slow')
+
+        def get():
+            results.append(cache.get(key, produce))
+
+        threads = [threading.Thread(target=get) for i in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        # wait until the others are waiting on the first.
+        while cache.coalesced < 3:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.produced, [key])
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_single_flight_error(self):
+        cache = RenderCache(timer=self.timer)
+        key = ('mold/a', (1,), 'digest')
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def produce():
+            started.set()
+            release.wait()
+            raise ValueError('failed')
+
+        def get():
+            try:
+                cache.get(key, produce)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=get) for i in range(2)]
+        threads[0].start()
+        started.wait()
+        threads[1].start()
+        while cache.coalesced < 1:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 2)
+        self.assertNotIn(key, cache)
+        # not cached, so produced again.
+        self.assertEqual(cache.get(key, self.producer(b'ok')).data, b'ok')
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import zlib
+from os.path import join
+
+from calmjs.testing.utils import mkdtemp
+
+from nunja.serve.compress import compress
+from nunja.serve.compress import gzip_compress
+from nunja.serve.compress import negotiate
+from nunja.serve.compress import parse_accept_encoding
+from nunja.serve.compress import read_sibling
+
+
+class CompressTestCase(unittest.TestCase):
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(parse_accept_encoding(''), {})
+        self.assertEqual(parse_accept_encoding(
+            'gzip, deflate;q=0.5, br;q=bad, *;q=0'), {
+            'gzip': 1.0, 'deflate': 0.5, 'br': 0.0, '*': 0.0})
+
+    def test_negotiate(self):
+        encodings = ('br', 'gzip')
+        self.assertIsNone(negotiate(None, encodings))
+        self.assertIsNone(negotiate('', encodings))
+        self.assertIsNone(negotiate('identity', encodings))
+        self.assertEqual(negotiate('gzip', encodings), 'gzip')
+        self.assertEqual(negotiate('gzip, br', encodings), 'br')
+        self.assertEqual(negotiate('gzip, br;q=0.5', encodings), 'gzip')
+        self.assertEqual(negotiate('*', encodings), 'br')
+        self.assertIsNone(negotiate('gzip;q=0', encodings))
+        self.assertIsNone(negotiate('gzip', ()))
+
+    def test_gzip_compress(self):
+        data = b'hello world' * 100
+        result = gzip_compress(data)
+        self.assertEqual(result, gzip_compress(data))
+        self.assertEqual(zlib.decompress(result, 16 + zlib.MAX_WBITS), data)
+
+    def test_compress(self):
+        self.assertIsNone(compress(b'hello', 'gzip'))
+        data = b'hello world' * 100
+        self.assertEqual(compress(data, 'gzip'), gzip_compress(data))
+
+    def test_read_sibling(self):
+        path = join(mkdtemp(self), 'index.js')
+        self.assertIsNone(read_sibling(path, 'gzip', 0))
+        with open(path + '.gz', 'wb') as fd:
+            fd.write(b'compressed')
+        os.utime(path + '.gz', (1000, 1000))
+        self.assertEqual(read_sibling(path, 'gzip', 1000), b'compressed')
+        self.assertIsNone(read_sibling(path, 'gzip', 2000))
+        self.assertIsNone(read_sibling(path, 'br', 0))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+import sys
+from os.path import exists
+from os.path import join
+
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_stdouts
+
+from nunja.serve.freeze import MANIFEST_NAME
+from nunja.serve.freeze import freeze
+from nunja.serve.freeze import main
+from nunja.serve.freeze import to_target
+from nunja.serve.rjs import Provider
+
+from nunja.serve.testing import setup_test_mold_registry
+
+template = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+
+
+class FreezeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_test_mold_registry(self)
+        self.output = mkdtemp(self)
+
+    def read(self, target):
+        with open(join(self.output, *target.split('/')), 'rb') as fd:
+            return fd.read()
+
+    def test_to_target(self):
+        provider = Provider('/nunja/', fingerprint=True)
+        fingerprint = provider.fingerprints[
+            'nunja.mold/nunja.testing.mold/basic']
+        self.assertEqual(to_target(provider, template), (
+            'nunja.mold/nunja.testing.mold/basic.%s/template.nja' %
+            fingerprint))
+        self.assertEqual(to_target(provider, 'config.js'), 'config.js')
+        self.assertEqual(
+            to_target(Provider('/nunja/'), template), template)
+
+    def test_freeze(self):
+        provider = Provider('/nunja/')
+        manifest = freeze(provider, self.output)
+        self.assertEqual(
+            self.read('config.js'), provider.fetch_core('config.js').encode())
+        self.assertEqual(
+            self.read('init.js'), provider.fetch_core('init.js').encode())
+        for identifier in provider.index:
+            self.assertEqual(
+                self.read(identifier),
+                provider.fetch_content(identifier).data)
+        self.assertEqual(manifest[template]['path'], template)
+        self.assertEqual(manifest[template]['files'], [template])
+        self.assertEqual(
+            manifest[template]['etag'], provider.fetch_content(template).etag)
+        self.assertEqual(
+            len(manifest), len(provider.index) + len(provider.core_names))
+        with open(join(self.output, MANIFEST_NAME)) as fd:
+            self.assertEqual(json.load(fd), manifest)
+
+    def test_freeze_fingerprint_bundles_compressed(self):
+        provider = Provider('/nunja/', fingerprint=True, bundles=True)
+        manifest = freeze(provider, self.output, encodings=('gzip',))
+        target = to_target(provider, template)
+        self.assertNotEqual(target, template)
+        self.assertEqual(
+            self.read(target), provider.fetch_content(template).data)
+        self.assertFalse(exists(join(self.output, template)))
+        bundle = '_bundle/nunja.testing.mold/basic.js'
+        self.assertEqual(manifest[bundle]['path'], bundle)
+        self.assertEqual(
+            self.read(bundle), provider.fetch_content(bundle).data)
+        # the config is large enough to be worth compressing.
+        self.assertEqual(
+            manifest['config.js']['files'], ['config.js', 'config.js.gz'])
+        self.assertEqual(
+            self.read('config.js.gz'),
+            provider.fetch_content('config.js').variant('gzip'))
+
+    def test_main(self):
+        stub_stdouts(self)
+        main(args=[self.output, '--base-url', '/static/', '--compress'])
+        self.assertIn('"/static/"', self.read('config.js').decode('utf8'))
+        self.assertTrue(exists(join(self.output, template)))
+        self.assertTrue(exists(join(self.output, MANIFEST_NAME)))
+        self.assertIn(self.output, sys.stdout.getvalue())
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from nunja.serve.metrics import Histogram
+from nunja.serve.metrics import Metrics
+from nunja.serve.metrics import format_labels
+from nunja.serve.metrics import null_timer
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_format_labels(self):
+        self.assertEqual(format_labels(()), '')
+        self.assertEqual(
+            format_labels((('a', 1), ('b', 'x"y\\z'))),
+            '{a="1",b="x\\"y\\\\z"}')
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2)
+        self.assertEqual(list(histogram.samples('t', (('p', 'x'),))), [
+            't_bucket{p="x",le="0.1"} 2',
+            't_bucket{p="x",le="1.0"} 3',
+            't_bucket{p="x",le="+Inf"} 4',
+            't_sum{p="x"} 2.65',
+            't_count{p="x"} 4',
+        ])
+
+    def test_render(self):
+        metrics = Metrics(buckets=(1.0,))
+        metrics.increment('nunja_requests_total', labels=(('status', 404),))
+        metrics.increment('nunja_requests_total', labels=(('status', 200),))
+        metrics.increment('nunja_requests_total', labels=(('status', 200),))
+        metrics.increment('nunja_response_bytes_total', 10)
+        metrics.observe('nunja_phase_seconds', 0.5, (('phase', 'read'),))
+        self.assertEqual(metrics.render([
+            ('extra', 'gauge', 'An extra value.', 1.5),
+        ]), '\n'.join([
+            '# HELP nunja_phase_seconds '
+            'Time spent in each phase of producing responses.',
+            '# TYPE nunja_phase_seconds histogram',
+            'nunja_phase_seconds_bucket{phase="read",le="1.0"} 1',
+            'nunja_phase_seconds_bucket{phase="read",le="+Inf"} 1',
+            'nunja_phase_seconds_sum{phase="read"} 0.5',
+            'nunja_phase_seconds_count{phase="read"} 1',
+            '# HELP nunja_requests_total '
+            'Requests handled by the provider, by status.',
+            '# TYPE nunja_requests_total counter',
+            'nunja_requests_total{status="200"} 2',
+            'nunja_requests_total{status="404"} 1',
+            '# HELP nunja_response_bytes_total '
+            'Bytes in the bodies of the responses.',
+            '# TYPE nunja_response_bytes_total counter',
+            'nunja_response_bytes_total 10',
+            '# HELP extra An extra value.',
+            '# TYPE extra gauge',
+            'extra 1.5',
+        ]) + '\n')
+
+    def test_timer(self):
+        metrics = Metrics()
+        with metrics.timer('resolve'):
+            pass
+        histogram = metrics.histograms[
+            ('nunja_phase_seconds', (('phase', 'resolve'),))]
+        self.assertEqual(histogram.count, 1)
+        with null_timer:
+            pass
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import sys
+import threading
+from os.path import dirname
+from os.path import join
+
+from calmjs.testing.utils import stub_item_attr_value
+from calmjs.testing.utils import stub_stdouts
+
+from nunja.serve import simple
+from nunja.serve.compat import HTTPConnection
+from nunja.serve.compat import HTTPServer
+from nunja.serve.metrics import Metrics
+from nunja.serve.offload import Offload
+from nunja.serve.offload import X_ACCEL_REDIRECT
+from nunja.serve.offload import X_SENDFILE
+from nunja.serve.offload import parse_mapping
+from nunja.serve.rjs import Provider
+from nunja.serve.simple import NunjaHTTPRequestHandlerFactory
+from nunja.serve.simple import main
+from nunja.serve.testing import DummyProvider
+from nunja.serve.testing import setup_generated_mold_registry
+from nunja.serve.tests.test_simple import PathProvider
+from nunja.serve.tests.test_simple import SendfileHandler
+from nunja.serve.tests.test_simple import base_setup
+
+script = 'nunja.mold/nunja_generated0.mold/m0/index.js'
+
+
+class OffloadTestCase(unittest.TestCase):
+
+    def test_parse_mapping(self):
+        self.assertEqual(
+            parse_mapping('/srv/molds=/internal'), ('/srv/molds', '/internal'))
+        self.assertEqual(parse_mapping('/srv=/a=b'), ('/srv', '/a=b'))
+        self.assertEqual(parse_mapping('/srv='), ('/srv', ''))
+        with self.assertRaises(ValueError):
+            parse_mapping('/srv/molds')
+        with self.assertRaises(ValueError):
+            parse_mapping('=/internal')
+
+    def test_header(self):
+        self.assertEqual(Offload().header, X_ACCEL_REDIRECT)
+        self.assertEqual(Offload('x-sendfile').header, X_SENDFILE)
+        self.assertEqual(Offload('X-Custom').header, 'X-Custom')
+
+    def test_target_accel_redirect(self):
+        offload = Offload(X_ACCEL_REDIRECT, [
+            ('/srv', '/internal/'),
+            ('/srv/molds/', '/molds'),
+        ])
+        self.assertEqual(
+            offload.target('/srv/molds/a/b c.js'), '/molds/a/b%20c.js')
+        self.assertEqual(offload.target('/srv/other.js'), '/internal/other.js')
+        self.assertIsNone(offload.target('/srv2/other.js'))
+        self.assertIsNone(offload.target('/elsewhere/a.js'))
+
+    def test_target_sendfile(self):
+        self.assertEqual(
+            Offload(X_SENDFILE).target('/srv/a b.js'), '/srv/a b.js')
+        offload = Offload(X_SENDFILE, {'/srv': '/mnt/srv'})
+        self.assertEqual(offload.target('/srv/a b.js'), '/mnt/srv/a b.js')
+        self.assertIsNone(offload.target('/elsewhere/a.js'))
+
+
+class ProviderOffloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_generated_mold_registry(self)
+
+    def test_respond(self):
+        provider = Provider('/nunja/')
+        path = provider.index[script]
+        provider.offload = Offload(
+            X_ACCEL_REDIRECT, [(dirname(dirname(path)), '/internal')])
+        response = provider.respond(script)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b'')
+        self.assertIsNone(response.path)
+        self.assertEqual(response.headers['Content-Length'], '0')
+        self.assertEqual(
+            response.headers['X-Accel-Redirect'], '/internal/m0/index.js')
+        self.assertIn('javascript', response.headers['Content-Type'])
+        # left to the proxy.
+        self.assertNotIn('ETag', response.headers)
+        # the file is not read.
+        self.assertEqual(len(provider.cache), 0)
+
+    def test_respond_not_offloaded(self):
+        provider = Provider('/nunja/', bundles=True, offload=Offload(
+            X_ACCEL_REDIRECT, [('/nowhere', '/internal')]))
+        response = provider.respond(script)
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+        self.assertIn(b'define(', response.body)
+
+        provider.offload = Offload(X_SENDFILE)
+        response = provider.respond(script)
+        self.assertEqual(response.headers['X-Sendfile'], provider.index[
+            script])
+        for identifier in ('config.js', 'init.js',
+                           '_bundle/nunja_generated0.mold/m0.js'):
+            response = provider.respond(identifier)
+            self.assertEqual(response.status, 200)
+            self.assertNotIn('X-Sendfile', response.headers)
+        response = provider.respond('nunja.mold/missing/index.js')
+        self.assertEqual(response.status, 404)
+
+    def test_respond_fingerprinted(self):
+        provider = Provider(
+            '/nunja/', fingerprint=True, offload=Offload(X_SENDFILE))
+        mold = 'nunja.mold/nunja_generated0.mold/m0'
+        identifier = '%s.%s/index.js' % (mold, provider.fingerprints[mold])
+        response = provider.respond(identifier)
+        self.assertEqual(
+            response.headers['X-Sendfile'], provider.index[script])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+    def test_respond_metrics(self):
+        provider = Provider(
+            '/nunja/', metrics=Metrics(), offload=Offload(X_SENDFILE))
+        provider.respond(script)
+        text = provider.metrics.render()
+        self.assertIn('nunja_requests_total{status="200"} 1', text)
+        self.assertIn('phase="resolve"', text)
+        self.assertNotIn('phase="read"', text)
+
+
+class OffloadRequestHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        base_setup(self)
+        SendfileHandler.sent = []
+        self.provider = PathProvider(
+            '/base', core_subpaths=('config.js',),
+            offload=Offload(X_ACCEL_REDIRECT, {os.getcwd(): '/internal'}))
+        handler = NunjaHTTPRequestHandlerFactory(
+            self.provider, nunja_prefix='/base', handler_cls=SendfileHandler,
+            protocol_version='HTTP/1.1')
+        self.server = HTTPServer(('localhost', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.host, self.port = self.server.socket.getsockname()
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.server_close()
+        self.server.shutdown()
+
+    def test_offloaded(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', '/base/file.txt')
+        response = conn.getresponse()
+        self.assertEqual(
+            response.getheader('X-Accel-Redirect'), '/internal/file.txt')
+        self.assertEqual(response.read(), b'')
+        self.assertEqual(SendfileHandler.sent, [])
+        # the connection is kept for the next request.
+        conn.request('GET', '/base/config.js')
+        response = conn.getresponse()
+        self.assertIsNone(response.getheader('X-Accel-Redirect'))
+        self.assertEqual(response.read(), b'config:config.js')
+        conn.close()
+
+
+class MainOffloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.values = {}
+
+        def fake_serve_nunja(**kw):
+            self.values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+
+    def test_main_default(self):
+        stub_item_attr_value(self, sys, 'argv', ['script'])
+        main(DummyProvider)
+        self.assertIsNone(self.values['offload'])
+
+    def test_main_offload(self):
+        stub_item_attr_value(self, sys, 'argv', [
+            'script', '--offload', 'X-Accel-Redirect',
+            '--offload-map', join(os.sep, 'srv') + '=/internal',
+            '--offload-map', join(os.sep, 'opt') + '=/opt'])
+        main(DummyProvider)
+        offload = self.values['offload']
+        self.assertEqual(offload.header, X_ACCEL_REDIRECT)
+        self.assertEqual(
+            offload.target(join(os.sep, 'srv', 'a.js')), '/internal/a.js')
+        self.assertEqual(
+            offload.target(join(os.sep, 'opt', 'a.js')), '/opt/a.js')
+
+    def test_main_offload_sendfile(self):
+        stub_item_attr_value(
+            self, sys, 'argv', ['script', '--offload', 'x-sendfile'])
+        main(DummyProvider)
+        self.assertEqual(self.values['offload'].header, X_SENDFILE)
+
+    def test_main_offload_invalid(self):
+        stub_stdouts(self)
+        for argv in (
+                ['--offload', 'x-accel-redirect'],
+                ['--offload-map', '/srv=/internal'],
+                ['--offload', 'x-sendfile', '--offload-map', '/srv'],
+                ['--offload', 'x-other']):
+            stub_item_attr_value(self, sys, 'argv', ['script'] + argv)
+            with self.assertRaises(SystemExit):
+                main(DummyProvider)
+            self.assertIn('--offload', sys.stderr.getvalue())
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import signal
+import sys
+import threading
+import time
+from functools import partial
+
+from calmjs.testing.utils import stub_item_attr_value
+from calmjs.testing.utils import stub_stdouts
+
+from nunja.serve import simple
+from nunja.serve.compat import HTTPConnection
+from nunja.serve.compat import HTTPServer
+from nunja.serve.simple import NunjaHTTPRequestHandler
+from nunja.serve.simple import NunjaHTTPRequestHandlerFactory
+from nunja.serve.simple import ThreadPoolHTTPServer
+from nunja.serve.simple import main
+from nunja.serve.simple import serve_nunja
+from nunja.serve.simple.prefork import PreforkServer
+from nunja.serve.testing import DummyProvider
+
+
+class PidHandler(NunjaHTTPRequestHandler):
+
+    def end_headers(self):
+        self.send_header('X-Pid', str(os.getpid()))
+        NunjaHTTPRequestHandler.end_headers(self)
+
+
+@unittest.skipIf(not hasattr(os, 'fork'), 'fork not available')
+class PreforkServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        stub_stdouts(self)
+        self.provider = DummyProvider('/base')
+        handler = NunjaHTTPRequestHandlerFactory(
+            self.provider, nunja_prefix='/base', handler_cls=PidHandler,
+            protocol_version='HTTP/1.0')
+        self.listener = HTTPServer(('localhost', 0), handler)
+        self.host, self.port = self.listener.socket.getsockname()
+        self.factory = partial(
+            ThreadPoolHTTPServer, ('localhost', 0), handler, workers=2,
+            bind_and_activate=False)
+
+    def get(self, path):
+        conn = HTTPConnection(self.host, self.port, timeout=5)
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            return response.getheader('X-Pid'), response.read()
+        finally:
+            conn.close()
+
+    def test_serve_restart_terminate(self):
+        server = PreforkServer(
+            self.listener, self.factory, 2, restart_delay=0)
+        self.addCleanup(server.server_close)
+        results = {}
+
+        def client():
+            try:
+                pid, body = self.get('/base/some/object.js')
+                results['body'] = body
+                results['first'] = set(server.children)
+                os.kill(int(pid), signal.SIGKILL)
+                deadline = time.time() + 5
+                while time.time() < deadline and (
+                        set(server.children) == results['first'] or
+                        len(server.children) < 2):
+                    time.sleep(0.05)
+                results['second'] = set(server.children)
+                results['after'] = self.get('/base/other.js')[1]
+            finally:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        server.serve_forever()
+        thread.join()
+
+        self.assertEqual(results['body'], b'object:some/object.js')
+        self.assertEqual(len(results['first']), 2)
+        self.assertEqual(len(results['second']), 2)
+        self.assertEqual(len(results['first'] & results['second']), 1)
+        self.assertEqual(results['after'], b'object:other.js')
+        self.assertEqual(server.children, {})
+        self.assertTrue(server.stopping)
+
+    def test_serve_terminate_kills(self):
+        class HangingServer(ThreadPoolHTTPServer):
+            def server_close(self):
+                # a worker that does not exit once stopped.
+                time.sleep(30)
+
+        factory = partial(
+            HangingServer, ('localhost', 0), self.listener.RequestHandlerClass,
+            workers=2, bind_and_activate=False)
+        server = PreforkServer(self.listener, factory, 1, stop_timeout=0.5)
+        self.addCleanup(server.server_close)
+        results = {}
+
+        def client():
+            try:
+                results['body'] = self.get('/base/a.js')[1]
+            finally:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        start = time.time()
+        server.serve_forever()
+        thread.join()
+
+        self.assertEqual(results['body'], b'object:a.js')
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(server.children, {})
+
+    def test_server_close(self):
+        server = PreforkServer(self.listener, self.factory, 2)
+        server.spawn()
+        server.spawn()
+        self.assertEqual(self.get('/base/a.js')[1], b'object:a.js')
+        server.server_close()
+        self.assertEqual(server.children, {})
+        self.assertRaises(Exception, self.get, '/base/a.js')
+
+    def test_reap_kills(self):
+        server = PreforkServer(self.listener, self.factory, 1, stop_timeout=0)
+        pid = os.fork()
+        if not pid:  # pragma: no cover
+            # a worker that ignores being told to stop.
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            time.sleep(30)
+            os._exit(0)
+        server.children[pid] = time.time()
+        server.stop()
+        server.reap()
+        self.assertEqual(server.children, {})
+        self.listener.server_close()
+
+
+class ServeNunjaPreforkTestCase(unittest.TestCase):
+
+    def test_server_flow(self):
+        stub_stdouts(self)
+        served = []
+
+        def serve_forever(self):
+            served.append(self)
+            raise KeyboardInterrupt
+
+        stub_item_attr_value(
+            self, PreforkServer, 'serve_forever', serve_forever)
+        with self.assertRaises(SystemExit):
+            serve_nunja(DummyProvider, port=0, processes=2, threads=2)
+        server, = served
+        self.assertEqual(server.processes, 2)
+        self.assertEqual(server.server_factory.keywords, {
+            'workers': 2, 'bind_and_activate': False})
+        stdout = sys.stdout.getvalue()
+        self.assertIn('Serving HTTP on', stdout)
+        self.assertIn('Keyboard interrupt received, shutting down...', stdout)
+
+    def test_main_processes(self):
+        stub_item_attr_value(
+            self, sys, 'argv', ['script', '--processes', '4'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertEqual(values['processes'], 4)
+
+    def test_main_processes_incompatible(self):
+        stub_stdouts(self)
+        for flag in ('--watch', '--asyncio', '--render-processes=2'):
+            stub_item_attr_value(
+                self, sys, 'argv', ['script', '--processes', '4', flag])
+            with self.assertRaises(SystemExit):
+                main(DummyProvider)
+            self.assertIn('--processes', sys.stderr.getvalue())
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+
+from nunja.serve.render import BaseRenderer
+from nunja.serve.render import ProcessPoolRenderer
+from nunja.serve.render import Renderer
+from nunja.serve.render import data_digest
+from nunja.serve.render import iter_chunks
+from nunja.serve.render import parse_data
+from nunja.serve.testing import setup_generated_mold_registry
+
+mold_id = 'nunja_generated0.mold/m0'
+
+
+class ParseDataTestCase(unittest.TestCase):
+
+    def test_parse_data(self):
+        self.assertEqual(parse_data(), {})
+        self.assertEqual(parse_data(b''), {})
+        self.assertEqual(parse_data(b'{"value": 1}'), {'value': 1})
+        self.assertEqual(parse_data(u'{"value": 1}'), {'value': 1})
+
+    def test_parse_data_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_data(b'{')
+        with self.assertRaises(ValueError):
+            parse_data(b'[1]')
+
+
+class DataDigestTestCase(unittest.TestCase):
+
+    def test_data_digest(self):
+        self.assertEqual(
+            data_digest({'a': 1, 'b': [1, 2]}),
+            data_digest({'b': [1, 2], 'a': 1}),
+        )
+        self.assertNotEqual(data_digest({'a': 1}), data_digest({'a': 2}))
+
+
+class IterChunksTestCase(unittest.TestCase):
+
+    def test_iter_chunks(self):
+        self.assertEqual(list(iter_chunks([], 4)), [])
+        self.assertEqual(
+            list(iter_chunks([u'ab', u'cd', u'e', u'\u2603'], 4)),
+            [b'abcd', u'e\u2603'.encode('utf8')])
+
+
+class RendererTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_generated_mold_registry(self, molds=2, core=True)
+        self.renderer = Renderer()
+        self.path = self.renderer.engine.lookup_path(
+            mold_id + '/template.nja')
+
+    def test_execute(self):
+        self.assertEqual(self.renderer.execute(mold_id, {
+            'cls': 'a', 'value': '<b>',
+        }).split(), [
+            '<div', 'data-nunja="nunja_generated0.mold/m0">',
+            '<div', 'class="a">&lt;b&gt;</div>', '</div>',
+        ])
+        self.assertEqual(self.renderer.execute(
+            mold_id, {'value': 1}, wrapper_tag='span').split()[-1], '</span>')
+
+    def test_stream(self):
+        data = {'cls': 'a', 'value': 'b' * 100}
+        chunks = list(self.renderer.stream(mold_id, data))
+        self.assertEqual(
+            b''.join(chunks).decode('utf8'),
+            self.renderer.execute(mold_id, data))
+        with self.assertRaises(KeyError):
+            self.renderer.stream('nunja_generated0.mold/none', {})
+
+    def test_stream_chunked(self):
+        template = u''.join(
+            u'<p>{{ value }} %d</p>\n' % i for i in range(2000))
+        with open(self.path, 'w') as fd:
+            fd.write(template)
+        chunks = list(self.renderer.stream(mold_id, {'value': 'row'}))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) >= 16384 for chunk in chunks[:-1]))
+
+    def test_render(self):
+        self.assertEqual(self.renderer.render(mold_id, {
+            'cls': 'a', 'value': 'b',
+        }), '<div class="a">b</div>')
+
+    def test_compiled_once(self):
+        template = self.renderer.load_mold(mold_id)
+        self.assertIs(self.renderer.load_mold(mold_id), template)
+        self.assertIn(mold_id + '/template.nja', self.renderer.templates)
+
+    def test_compiled_again_when_changed(self):
+        template = self.renderer.load_mold(mold_id)
+        with open(self.path, 'w') as fd:
+            fd.write('<p>{{ value }}</p>\n')
+        os.utime(self.path, (1000, 1000))
+        self.assertIsNot(self.renderer.load_mold(mold_id), template)
+        self.assertEqual(
+            self.renderer.render(mold_id, {'value': 'x'}), '<p>x</p>')
+
+    def test_not_found(self):
+        with self.assertRaises(KeyError):
+            self.renderer.execute('nunja_generated0.mold/none', {})
+        with self.assertRaises(KeyError):
+            self.renderer.render('no_such.mold/m0', {})
+
+    def test_preload(self):
+        self.assertEqual(sorted(self.renderer.preload()), [
+            '_core_/_default_wrapper_',
+            'nunja_generated0.mold/m0',
+            'nunja_generated0.mold/m1',
+        ])
+        self.assertIn(mold_id + '/template.nja', self.renderer.templates)
+        self.assertEqual(Renderer(
+            'no.such.registry', engine=object()).preload(), [])
+
+    def test_version(self):
+        version = self.renderer.version(mold_id)
+        self.assertEqual(self.renderer.version(mold_id), version)
+        index = os.path.join(os.path.dirname(self.path), 'index.js')
+        os.utime(index, (1000, 1000))
+        self.assertNotEqual(self.renderer.version(mold_id), version)
+        with self.assertRaises(KeyError):
+            self.renderer.version('nunja_generated0.mold/none')
+        os.remove(index)
+        with self.assertRaises(KeyError):
+            self.renderer.version(mold_id)
+
+
+class BaseRendererTestCase(unittest.TestCase):
+
+    def test_not_implemented(self):
+        renderer = BaseRenderer()
+        with self.assertRaises(NotImplementedError):
+            renderer.execute(mold_id, {})
+        renderer.close()
+
+    def test_stream(self):
+        class Fixed(BaseRenderer):
+            def execute(self, mold_id, data, wrapper_tag='div'):
+                return u'\u2603'
+
+        self.assertEqual(
+            list(Fixed().stream(mold_id, {})), [u'\u2603'.encode('utf8')])
+
+
+class ProcessPoolRendererTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_generated_mold_registry(self, core=True)
+        self.renderer = ProcessPoolRenderer(processes=2)
+        self.addCleanup(self.renderer.close)
+
+    def test_execute(self):
+        self.assertEqual(
+            self.renderer.execute(mold_id, {'cls': 'a', 'value': 'b'}),
+            Renderer().execute(mold_id, {'cls': 'a', 'value': 'b'}),
+        )
+        self.assertEqual(self.renderer.execute(
+            mold_id, {}, wrapper_tag='span').split()[-1], '</span>')
+
+    def test_not_found(self):
+        with self.assertRaises(KeyError):
+            self.renderer.execute('nunja_generated0.mold/none', {})
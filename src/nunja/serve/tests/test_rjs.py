@@ -1,18 +1,33 @@
 # -*- coding: utf-8 -*-
 import unittest
 import json
+import os
+from os.path import join
 
 from calmjs.registry import _inst as default_registry
 from calmjs.rjs.ecma import parse
 
+from nunja.serve import rjs
 from nunja.serve.rjs import Provider
+from nunja.serve.rjs import iter_mold_records
+from nunja.serve.rjs import make_bundle
+from nunja.serve.rjs import make_bundle_index
 from nunja.serve.rjs import get_path
+from nunja.serve.rjs import CACHE_IMMUTABLE
+from nunja.serve.rjs import CACHE_REVALIDATE
 from nunja.serve.rjs import make_config
+from nunja.serve.rjs import make_fingerprints
+from nunja.serve.rjs import make_index
+from nunja.serve.rjs import to_mold_id_path
 
 from calmjs.testing import mocks
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_item_attr_value
 from calmjs.utils import pretty_logging
 
+from nunja.serve.testing import setup_generated_mold_registry
 from nunja.serve.testing import setup_test_mold_registry
+from nunja.serve.testing import write_file
 
 
 class RJSConfigTestCase(unittest.TestCase):
@@ -90,6 +105,199 @@ class RJSConfigTestCase(unittest.TestCase):
             get_path('nunja.mold', 'nunja.testing.mold/basic/not_found')
 
 
+class RJSIndexTestCase(unittest.TestCase):
+
+    def test_to_mold_id_path(self):
+        self.assertEqual(to_mold_id_path(
+            'text!nunja.testing.mold/basic/template.nja',
+            '/src/nunja/testing/mold/basic/template.nja',
+        ), 'nunja.testing.mold/basic/template.nja')
+        self.assertEqual(to_mold_id_path(
+            'nunja.testing.mold/basic/index',
+            '/src/nunja/testing/mold/basic/index.js',
+        ), 'nunja.testing.mold/basic/index.js')
+        self.assertEqual(to_mold_id_path(
+            'nunja.testing.mold/basic/index.js',
+            '/src/nunja/testing/mold/basic/index.js',
+        ), 'nunja.testing.mold/basic/index.js')
+
+    def test_make_index(self):
+        setup_test_mold_registry(self)
+        index = make_index()
+        identifier = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        self.assertEqual(index[identifier], get_path(
+            'nunja.mold', 'nunja.testing.mold/basic/template.nja'))
+        self.assertEqual(index[
+            'nunja.mold/nunja.testing.mold/itemlist/index.js'], get_path(
+            'nunja.mold', 'nunja.testing.mold/itemlist/index.js'))
+        # only files from molds are indexed.
+        self.assertTrue(all(
+            k.startswith('nunja.mold/nunja.testing.mold/') for k in index))
+
+    def test_make_index_no_registry(self):
+        setup_test_mold_registry(self)
+        self.assertEqual(make_index(registry_names=()), {})
+        self.assertEqual(make_index(registry_names=('no_such_registry',)), {})
+
+
+class RJSBundleTestCase(unittest.TestCase):
+
+    def test_iter_mold_records(self):
+        setup_test_mold_registry(self)
+        results = list(iter_mold_records())
+        self.assertEqual(sorted(mold_id for _, mold_id, _ in results), [
+            'nunja.testing.mold/basic',
+            'nunja.testing.mold/include_by_name',
+            'nunja.testing.mold/include_by_value',
+            'nunja.testing.mold/itemlist',
+            'nunja.testing.mold/noinit',
+            'nunja.testing.mold/problem',
+        ])
+        self.assertEqual(set(name for name, _, _ in results), {'nunja.mold'})
+        self.assertEqual(list(iter_mold_records(('no_such_registry',))), [])
+
+    def test_make_bundle_template(self):
+        self.assertEqual(make_bundle([
+            ('text!mold/id/template.nja', '<p>"quoted"</p>\n'),
+        ]), (
+            'define("text!mold/id/template.nja", [], function() {\n'
+            '    return "<p>\\"quoted\\"</p>\\n";\n'
+            '});\n'
+        ))
+
+    def test_make_bundle_script(self):
+        result = make_bundle([('mold/id/index', 'define([], function() {});')])
+        self.assertTrue(result.startswith(
+            '(function(define) {\ndefine([], function() {});\n}('))
+        self.assertTrue(result.endswith('}("mold/id/index"))));\n'))
+
+    def test_make_config_bundles(self):
+        setup_test_mold_registry(self)
+        result = make_config('base', bundles=True)
+        self.assertEqual(
+            result['bundles']['_bundle/nunja.testing.mold/basic'], [
+                'text!nunja.testing.mold/basic/template.nja',
+            ])
+        self.assertEqual(
+            result['bundles']['_bundle/nunja.testing.mold/itemlist'], [
+                'nunja.testing.mold/itemlist/index',
+                'text!nunja.testing.mold/itemlist/template.nja',
+            ])
+        self.assertNotIn('bundles', make_config('base'))
+
+    def test_make_bundle_index(self):
+        setup_test_mold_registry(self)
+        index = make_bundle_index()
+        self.assertEqual(
+            sorted(index['nunja.testing.mold/itemlist'].keys()), [
+                'nunja.testing.mold/itemlist/index',
+                'text!nunja.testing.mold/itemlist/template.nja',
+            ])
+
+
+class RJSFingerprintTestCase(unittest.TestCase):
+
+    def test_make_fingerprints(self):
+        setup_test_mold_registry(self)
+        fingerprints = make_fingerprints()
+        self.assertEqual(sorted(fingerprints), [
+            'nunja.mold/nunja.testing.mold/basic',
+            'nunja.mold/nunja.testing.mold/include_by_name',
+            'nunja.mold/nunja.testing.mold/include_by_value',
+            'nunja.mold/nunja.testing.mold/itemlist',
+            'nunja.mold/nunja.testing.mold/noinit',
+            'nunja.mold/nunja.testing.mold/problem',
+        ])
+        self.assertEqual(len(set(fingerprints.values())), 6)
+        self.assertTrue(all(len(v) == 12 for v in fingerprints.values()))
+        self.assertEqual(fingerprints, make_fingerprints())
+
+    def test_make_config_fingerprints(self):
+        setup_test_mold_registry(self)
+        result = make_config('base', fingerprints={
+            'nunja.mold/nunja.testing.mold/basic': 'abcdef'})
+        self.assertEqual(
+            result['paths']['nunja.testing.mold/basic'],
+            'nunja.mold/nunja.testing.mold/basic.abcdef')
+        self.assertEqual(
+            result['paths']['nunja.testing.mold/itemlist'],
+            'nunja.mold/nunja.testing.mold/itemlist')
+
+    def test_provider_fingerprint(self):
+        setup_test_mold_registry(self)
+        server = Provider('base', fingerprint=True)
+        fingerprint = server.fingerprints[
+            'nunja.mold/nunja.testing.mold/basic']
+        self.assertEqual(
+            server.requirejs_config['paths']['nunja.testing.mold/basic'],
+            'nunja.mold/nunja.testing.mold/basic.' + fingerprint)
+        self.assertIn(fingerprint, server.fetch_core('config.js'))
+
+        identifier = (
+            'nunja.mold/nunja.testing.mold/basic.%s/template.nja' %
+            fingerprint)
+        self.assertEqual(
+            server.fetch_object(identifier), '<span>{{ value }}</span>\n')
+        response = server.respond(identifier)
+        self.assertEqual(response.headers['Cache-Control'], CACHE_IMMUTABLE)
+
+        # stale fingerprints are still served, but not as immutable.
+        response = server.respond(
+            'nunja.mold/nunja.testing.mold/basic.000000/template.nja')
+        self.assertEqual(response.status, 200)
+        self.assertNotIn('Cache-Control', response.headers)
+
+        response = server.respond('config.js')
+        self.assertEqual(response.headers['Cache-Control'], CACHE_REVALIDATE)
+        response = server.respond(
+            'nunja.mold/nunja.testing.mold/basic/template.nja')
+        self.assertNotIn('Cache-Control', response.headers)
+
+    def test_provider_fingerprint_modified(self):
+        setup_generated_mold_registry(self)
+        server = Provider('base', fingerprint=True)
+        mold = 'nunja.mold/nunja_generated0.mold/m0'
+        identifier = '%s.%s/index.js' % (mold, server.fingerprints[mold])
+        response = server.respond(identifier)
+        self.assertEqual(response.headers['Cache-Control'], CACHE_IMMUTABLE)
+
+        path = server.index['nunja.mold/nunja_generated0.mold/m0/index.js']
+        write_file(path, 'define([], function() { return 1; });', 0)
+        # not served as immutable under the fingerprint it no longer has.
+        response = server.respond(identifier)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Cache-Control'], CACHE_REVALIDATE)
+
+        server.refresh()
+        self.assertNotIn(identifier, server.requirejs_config['paths'].values())
+        identifier = '%s.%s/index.js' % (mold, server.fingerprints[mold])
+        response = server.respond(identifier)
+        self.assertEqual(response.headers['Cache-Control'], CACHE_IMMUTABLE)
+
+    def test_provider_no_fingerprint(self):
+        setup_test_mold_registry(self)
+        server = Provider('base')
+        self.assertEqual(server.fingerprints, {})
+        self.assertNotIn('Cache-Control', server.respond('config.js').headers)
+        with self.assertRaises(KeyError):
+            server.fetch_object(
+                'nunja.mold/nunja.testing.mold/basic.000000/template.nja')
+
+    def test_split_fingerprint(self):
+        setup_test_mold_registry(self)
+        server = Provider('base', fingerprint=True)
+        self.assertEqual(server.split_fingerprint(
+            'nunja.mold/nunja.testing.mold/basic.abc/sub/template.nja'), (
+            'nunja.mold/nunja.testing.mold/basic/sub/template.nja',
+            'nunja.mold/nunja.testing.mold/basic', 'abc'))
+        self.assertEqual(server.split_fingerprint(
+            'nunja.mold/nunja.testing.mold/nothing.abc/template.nja'), (
+            'nunja.mold/nunja.testing.mold/nothing.abc/template.nja',
+            None, None))
+        self.assertEqual(server.split_fingerprint('config.js'), (
+            'config.js', None, None))
+
+
 class ProviderTestCase(unittest.TestCase):
 
     def test_fetch_core_init(self):
@@ -139,6 +347,88 @@ class ProviderTestCase(unittest.TestCase):
             server.fetch_object(
                 'nunja.mold/nunja.testing.mold/basic/template.nja')
 
+    def test_fetch_path_indexed(self):
+        setup_test_mold_registry(self)
+        server = Provider('base')
+        identifier = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        self.assertIn(identifier, server.index)
+        server.index[identifier] = 'indexed_path'
+        self.assertEqual(server.fetch_path(identifier), 'indexed_path')
+        server.refresh()
+        self.assertNotEqual(server.fetch_path(identifier), 'indexed_path')
+
+    def test_fetch_path_not_indexed(self):
+        setup_test_mold_registry(self)
+        server = Provider('base')
+        server.index = {}
+        self.assertEqual(server.fetch_path(
+            'nunja.mold/nunja.testing.mold/basic/template.nja'), get_path(
+            'nunja.mold', 'nunja.testing.mold/basic/template.nja'))
+
+    def test_fetch_path_resolved(self):
+        setup_test_mold_registry(self)
+        server = Provider('base')
+        server.index = {}
+        identifier = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        path = server.fetch_path(identifier)
+        self.assertEqual(server.resolved, {identifier: path})
+
+        def fail_get_path(registry_name, mold_id_path):
+            raise AssertionError('registry queried again')
+
+        stub_item_attr_value(self, rjs, 'get_path', fail_get_path)
+        self.assertEqual(server.fetch_path(identifier), path)
+        server.refresh()
+        self.assertEqual(server.resolved, {})
+
+    def test_fetch_object_indexed_missing(self):
+        setup_test_mold_registry(self)
+        server = Provider('base')
+        identifier = 'nunja.mold/nunja.testing.mold/basic/template.nja'
+        server.index[identifier] = 'no_such_path'
+        with self.assertRaises(KeyError):
+            server.fetch_object(identifier)
+
+    def test_fetch_bundle(self):
+        setup_test_mold_registry(self)
+        server = Provider('base', bundles=True)
+        self.assertIn('bundles', server.requirejs_config)
+        result = server.fetch_object('_bundle/nunja.testing.mold/itemlist.js')
+        self.assertIn(
+            'define("text!nunja.testing.mold/itemlist/template.nja"', result)
+        self.assertIn('}("nunja.testing.mold/itemlist/index"))));', result)
+        self.assertIs(
+            server.fetch_content('_bundle/nunja.testing.mold/itemlist.js'),
+            server.fetch_content('_bundle/nunja.testing.mold/itemlist.js'),
+        )
+        with self.assertRaises(KeyError):
+            server.fetch_object('_bundle/nunja.testing.mold/nothing.js')
+        with self.assertRaises(KeyError):
+            server.fetch_object('_bundle/nunja.testing.mold/itemlist')
+
+    def test_fetch_bundle_invalidate(self):
+        setup_test_mold_registry(self)
+        tmpdir = mkdtemp(self)
+        template = join(tmpdir, 'template.nja')
+        with open(template, 'w') as fd:
+            fd.write('first')
+        os.utime(template, (1000, 1000))
+        server = Provider('base')
+        server.bundle_index = {'dummy/mold': {
+            'text!dummy/mold/template.nja': template}}
+        content = server.fetch_content('_bundle/dummy/mold.js')
+        self.assertIn('"first"', content.text)
+        self.assertEqual(content.mtime, 1000)
+        with open(template, 'w') as fd:
+            fd.write('second')
+        os.utime(template, (2000, 2000))
+        content = server.fetch_content('_bundle/dummy/mold.js')
+        self.assertIn('"second"', content.text)
+        self.assertEqual(content.mtime, 2000)
+        os.unlink(template)
+        with self.assertRaises(KeyError):
+            server.fetch_content('_bundle/dummy/mold.js')
+
     def test_fetch_object_good(self):
         setup_test_mold_registry(self)
         server = Provider('base')
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_stdouts
+
+from nunja.serve.simple.scripts import ScriptRunner
+from nunja.serve.simple.scripts import parse_output
+from nunja.serve.testing import write_file
+
+application = """
+calls = []
+
+def application(environ, start_response):
+    calls.append(environ.get('QUERY_STRING'))
+    start_response('201 Created', [('Content-Type', 'text/plain')])
+    return [b'call ', str(len(calls)).encode('ascii')]
+"""
+
+
+class ParseOutputTestCase(unittest.TestCase):
+
+    def test_parse_output(self):
+        response = parse_output('Content-Type: text/plain\n\nhello\n')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers, {
+            'Content-Type': 'text/plain',
+            'Content-Length': '6',
+        })
+        self.assertEqual(response.body, b'hello\n')
+
+    def test_parse_output_no_headers(self):
+        response = parse_output('\nhello\n')
+        self.assertEqual(response.headers, {'Content-Length': '6'})
+        self.assertEqual(response.body, b'hello\n')
+
+    def test_parse_output_status(self):
+        response = parse_output(
+            'Status: 404 Not Found\r\nContent-Type: text/plain\r\n\r\n')
+        self.assertEqual(response.status, 404)
+        self.assertEqual(response.body, b'')
+        self.assertNotIn('Status', response.headers)
+
+
+class ScriptRunnerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        stub_stdouts(self)
+        self.tmpdir = mkdtemp(self)
+        self.runner = ScriptRunner()
+
+    def test_run_cgi(self):
+        path = os.path.join(self.tmpdir, 'env.py')
+        write_file(path, (
+            'import os\n'
+            'print("Content-Type: text/plain")\n'
+            'print("")\n'
+            'print(os.environ["QUERY_STRING"])\n'
+        ), 1000)
+        response = self.runner.run(path, {'QUERY_STRING': 'a=1'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b'a=1\n')
+        self.assertNotIn('QUERY_STRING', os.environ)
+        # the compiled script is kept.
+        script = self.runner.load(path)
+        self.assertIs(self.runner.scripts[path], script)
+        self.assertEqual(
+            self.runner.run(path, {'QUERY_STRING': 'b=2'}).body, b'b=2\n')
+        self.assertIs(self.runner.load(path), script)
+
+    def test_run_reload(self):
+        path = os.path.join(self.tmpdir, 'page.py')
+        write_file(path, 'print("")\nprint("one")\n', 1000)
+        self.assertEqual(self.runner.run(path, {}).body, b'one\n')
+        write_file(path, 'print("")\nprint("two")\n', 2000)
+        self.assertEqual(self.runner.run(path, {}).body, b'two\n')
+
+    def test_run_exit(self):
+        path = os.path.join(self.tmpdir, 'exit.py')
+        write_file(
+            path, 'import sys\nprint("")\nprint("early")\nsys.exit(1)\n',
+            1000)
+        self.assertEqual(self.runner.run(path, {}).body, b'early\n')
+
+    def test_run_application(self):
+        path = os.path.join(self.tmpdir, 'app.py')
+        write_file(path, application, 1000)
+        response = self.runner.run(path, {'QUERY_STRING': 'x'})
+        self.assertEqual(response.status, 201)
+        self.assertEqual(response.headers, {
+            'Content-Type': 'text/plain',
+            'Content-Length': '6',
+        })
+        self.assertEqual(response.body, b'call 1')
+        # the module is executed once, so its state is kept.
+        self.assertEqual(self.runner.run(path, {}).body, b'call 2')
+
+        write_file(path, application, 2000)
+        self.assertEqual(self.runner.run(path, {}).body, b'call 1')
+
+    def test_run_application_main(self):
+        path = os.path.join(self.tmpdir, 'app.py')
+        marker = os.path.join(self.tmpdir, 'served')
+        write_file(path, application + (
+            '\n'
+            'if __name__ == "__main__":\n'
+            '    open(%r, "w").close()\n'
+        ) % marker, 1000)
+        self.assertEqual(self.runner.run(path, {}).body, b'call 1')
+        self.assertEqual(self.runner.scripts[path].application.__module__,
+                         'app')
+        # the block for running the application as the main program is
+        # not executed.
+        self.assertFalse(os.path.exists(marker))
+
+    def test_run_cgi_main(self):
+        path = os.path.join(self.tmpdir, 'page.py')
+        write_file(path, (
+            'application = None\n'
+            'if __name__ == "__main__":\n'
+            '    print("")\n'
+            '    print(__name__)\n'
+        ), 1000)
+        self.assertEqual(self.runner.run(path, {}).body, b'__main__\n')
+        self.assertIsNone(self.runner.scripts[path].application)
+
+    def test_run_error(self):
+        path = os.path.join(self.tmpdir, 'broken.py')
+        write_file(path, 'raise ValueError("broken")\n', 1000)
+        response = self.runner.run(path, {})
+        self.assertEqual(response.status, 500)
+        self.assertEqual(response.body, b'500 INTERNAL SERVER ERROR')
+        self.assertEqual(self.runner.run(
+            os.path.join(self.tmpdir, 'missing.py'), {}).status, 500)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import sys
+import zlib
+from os.path import exists
+from os.path import join
+
+from calmjs.testing.utils import mkdtemp
+from calmjs.testing.utils import stub_item_attr_value
+from calmjs.testing.utils import stub_stdouts
+
+from nunja.serve import simple
+from nunja.serve.base import to_bytes
+from nunja.serve.cache import load
+from nunja.serve.rjs import Provider
+from nunja.serve.shared import SharedContent
+from nunja.serve.shared import SharedContentStore
+from nunja.serve.shared import read_store
+from nunja.serve.shared import write_store
+from nunja.serve.simple import main
+from nunja.serve.simple import serve_nunja
+from nunja.serve.testing import setup_generated_mold_registry
+from nunja.serve.testing import write_file
+from nunja.serve.tests.test_simple import NeuteredServer
+
+script = 'nunja.mold/nunja_generated0.mold/m0/index.js'
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = mkdtemp(self)
+        self.target = join(self.root, 'store')
+        self.large = join(self.root, 'large.js')
+        self.small = join(self.root, 'small.js')
+        write_file(self.large, 'var a = 1;\n' * 100, 1000)
+        write_file(self.small, 'a', 1000)
+
+    def test_write_read_store(self):
+        table = write_store(
+            self.target, [self.large, self.small, self.large,
+                          join(self.root, 'missing.js')], ('gzip',))
+        self.assertEqual(sorted(table), [self.large, self.small])
+        mapped, table_, key = read_store(self.target)
+        self.assertEqual(table, table_)
+        key, etag, offset, length, variants = table[self.large]
+        self.assertEqual(tuple(key), load(self.large).key)
+        self.assertEqual(etag, load(self.large).etag)
+        self.assertEqual(
+            mapped[offset:offset + length], b'var a = 1;\n' * 100)
+        offset, length = variants['gzip']
+        self.assertEqual(zlib.decompress(
+            mapped[offset:offset + length], 16 + zlib.MAX_WBITS),
+            b'var a = 1;\n' * 100)
+        # not worth compressing.
+        self.assertIsNone(table[self.small][4]['gzip'])
+        # no temporary files left behind.
+        self.assertEqual(
+            [n for n in os.listdir(self.root) if n.startswith('.')], [])
+
+    def test_read_store_invalid(self):
+        with self.assertRaises(ValueError):
+            read_store(self.large)
+
+    def test_get(self):
+        store = SharedContentStore(
+            self.target, [self.large, self.small], ('gzip',))
+        self.assertEqual(len(store), 2)
+        self.assertIn(self.large, store)
+        content = store.get(self.large)
+        self.assertTrue(isinstance(content, SharedContent))
+        self.assertTrue(isinstance(content.data, memoryview))
+        self.assertIs(store.get(self.large), content)
+        self.assertEqual(content.text, 'var a = 1;\n' * 100)
+        self.assertEqual(content.etag, load(self.large).etag)
+        self.assertEqual(content.path, self.large)
+        self.assertEqual(to_bytes(content.data), b'var a = 1;\n' * 100)
+        self.assertTrue(isinstance(content.variant('gzip'), memoryview))
+        self.assertIsNone(store.get(self.small).variant('gzip'))
+        self.assertEqual(store.stats()['hits'], 3)
+        self.assertEqual(store.stats()['entries'], 2)
+        self.assertEqual(
+            store.stats()['bytes'], os.stat(self.target).st_size)
+
+    def test_get_variant_not_stored(self):
+        store = SharedContentStore(self.target, [self.large])
+        content = store.get(self.large)
+        # produced privately for the codings not in the store.
+        variant = content.variant('gzip')
+        self.assertTrue(isinstance(variant, bytes))
+        self.assertIs(content.variant('gzip'), variant)
+
+    def test_get_modified_rebuild(self):
+        store = SharedContentStore(self.target, [self.large])
+        other = SharedContentStore(self.target)
+        self.assertEqual(len(other), 1)
+        write_file(self.large, 'changed', 2000)
+
+        content = store.get(self.large)
+        self.assertFalse(isinstance(content, SharedContent))
+        self.assertEqual(content.data, b'changed')
+        self.assertEqual(store.stats()['misses'], 1)
+        thread = store._rebuilding
+        if thread is not None:
+            thread.join()
+        self.assertEqual(store.rebuilds, 1)
+
+        content = store.get(self.large)
+        self.assertTrue(isinstance(content, SharedContent))
+        self.assertEqual(content.text, 'changed')
+        # the other store (i.e. of another process) maps the new one.
+        content = other.get(self.large)
+        self.assertTrue(isinstance(content, SharedContent))
+        self.assertEqual(content.text, 'changed')
+        self.assertEqual(other.rebuilds, 0)
+
+    def test_get_new_path(self):
+        store = SharedContentStore(self.target, [self.large])
+        self.assertEqual(store.get(self.small).data, b'a')
+        thread = store._rebuilding
+        if thread is not None:
+            thread.join()
+        self.assertIn(self.small, store)
+        self.assertTrue(isinstance(store.get(self.small), SharedContent))
+
+    def test_invalidate(self):
+        store = SharedContentStore(self.target, [self.large])
+        self.assertFalse(store.invalidate(self.small))
+        write_file(self.large, 'changed', 2000)
+        self.assertTrue(store.invalidate(self.large))
+        thread = store._rebuilding
+        if thread is not None:
+            thread.join()
+        self.assertEqual(store.get(self.large).text, 'changed')
+
+    def test_provider(self):
+        setup_generated_mold_registry(self)
+        provider = Provider('/nunja/')
+        store = SharedContentStore(
+            self.target, provider.index.values(), provider.encodings)
+        provider.cache = store
+        response = provider.respond(script)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.path, provider.index[script])
+        self.assertEqual(to_bytes(response.body), load(response.path).data)
+        self.assertIn('define(', provider.fetch_object(script))
+        self.assertEqual(store.stats()['misses'], 0)
+
+
+class ServeNunjaSharedTestCase(unittest.TestCase):
+
+    def test_server_flow(self):
+        stub_stdouts(self)
+        setup_generated_mold_registry(self)
+        providers = []
+
+        class RecordingProvider(Provider):
+            def __init__(self, *a, **kw):
+                super(RecordingProvider, self).__init__(*a, **kw)
+                providers.append(self)
+
+        with self.assertRaises(SystemExit):
+            serve_nunja(
+                RecordingProvider, server_factory=NeuteredServer, port=0,
+                shared_cache=True)
+        provider, = providers
+        self.assertTrue(isinstance(provider.cache, SharedContentStore))
+        self.assertIn(provider.index[script], provider.cache)
+        self.assertFalse(exists(provider.cache.target))
+
+    def test_main_shared_cache(self):
+        stub_item_attr_value(
+            self, sys, 'argv', ['script', '--shared-cache'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(Provider)
+        self.assertTrue(values['shared_cache'])
@@ -3,6 +3,9 @@ import unittest
 import os
 import sys
 import threading
+import time
+import json
+import zlib
 
 from calmjs.testing.utils import mkdtemp
 from calmjs.testing.utils import stub_item_attr_value
@@ -11,15 +14,21 @@ from calmjs.testing.utils import remember_cwd
 
 from nunja.serve.compat import HTTPServer
 from nunja.serve.compat import HTTPConnection
+from nunja.serve.compat import Queue
 
 from nunja.serve import simple
-# from nunja.serve.simple import NunjaHTTPRequestHandler
+from nunja.serve.metrics import Metrics
+from nunja.serve.simple import ChunkedReader
+from nunja.serve.simple import NunjaHTTPRequestHandler
 from nunja.serve.simple import NunjaHTTPRequestHandlerFactory
+from nunja.serve.simple import ThreadPoolHTTPServer
 from nunja.serve.simple import _is_cgi
 from nunja.serve.simple import normpath
 from nunja.serve.simple import main
 from nunja.serve.simple import serve_nunja
+from nunja.serve.simple.scripts import ScriptRunner
 from nunja.serve.testing import DummyProvider
+from nunja.serve.testing import setup_generated_mold_registry
 
 
 def base_setup(inst):
@@ -56,6 +65,33 @@ class SupportTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def test_chunked_reader(self):
+        reader = ChunkedReader(iter([b'hello', b'', b'world!']))
+        self.assertEqual(reader.read(), b'5\r\nhello\r\n')
+        self.assertEqual(reader.read(), b'6\r\nworld!\r\n')
+        self.assertEqual(reader.read(), b'0\r\n\r\n')
+        self.assertEqual(reader.read(), b'')
+        reader = ChunkedReader(iter([b'hello', b'world']), chunked=False)
+        self.assertEqual(reader.read(), b'hello')
+        self.assertEqual(reader.read(), b'world')
+        self.assertEqual(reader.read(), b'')
+
+    def test_chunked_reader_close(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield b'hello'
+                yield b'world'
+            finally:
+                closed.append(True)
+
+        reader = ChunkedReader(chunks())
+        reader.read()
+        reader.close()
+        self.assertEqual(closed, [True])
+        ChunkedReader(iter([])).close()
+
     def test_normpath(self):
         self.assertEqual(normpath('/'), '/')
         self.assertEqual(normpath('/some//where'), '/some/where')
@@ -110,8 +146,9 @@ class RequestHandlerTestCase(unittest.TestCase):
 
     def setUp(self):
         base_setup(self)
-        dummy = DummyProvider('/base', core_subpaths=('config.js',))
-        handler = NunjaHTTPRequestHandlerFactory(dummy, nunja_prefix='/base')
+        self.provider = DummyProvider('/base', core_subpaths=('config.js',))
+        handler = NunjaHTTPRequestHandlerFactory(
+            self.provider, nunja_prefix='/base')
         self.server = HTTPServer(('localhost', 0), handler)
         self.thread = threading.Thread(target=self.server.serve_forever)
         self.host, self.port = self.server.socket.getsockname()
@@ -163,6 +200,457 @@ class RequestHandlerTestCase(unittest.TestCase):
     def test_request_handler_notfound(self):
         self.assertEqual(self.getresponse('/base/notfound').status, 404)
 
+    def test_request_handler_batch(self):
+        response = self.getresponse('/base/_batch?id=config.js&id=notfound')
+        self.assertEqual(
+            response.getheader('Content-Type'), 'application/json')
+        self.assertEqual(json.loads(response.read().decode('utf8')), {
+            'config.js': {'content': 'config:config.js'},
+            'notfound': {'error': 'not found'},
+        })
+
+    def test_request_handler_batch_post(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request(
+            'POST', '/base/_batch?id=a', body=b'["b"]',
+            headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(response.read().decode('utf8')), {
+            'a': {'content': 'object:a'},
+            'b': {'content': 'object:b'},
+        })
+
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('POST', '/base/_batch', body=b'invalid')
+        self.assertEqual(conn.getresponse().status, 400)
+
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('POST', '/base/an_object', body=b'[]')
+        self.assertEqual(conn.getresponse().status, 404)
+
+    def test_request_handler_metrics(self):
+        self.assertEqual(self.getresponse('/base/_metrics').status, 404)
+        self.provider.metrics = Metrics()
+        self.getresponse('/base/an_object').read()
+        response = self.getresponse('/base/_metrics')
+        self.assertEqual(response.status, 200)
+        self.assertIn(
+            b'nunja_requests_total{status="200"} 1\n', response.read())
+
+    def test_request_handler_query_ignored(self):
+        self.assertEqual(
+            self.getresponse_text('/base/an_object?v=1'), 'object:an_object')
+
+    def test_request_handler_encoded(self):
+        self.provider.fetch_object = lambda identifier: 'object:' * 100
+        response = self.getresponse('/base/large', {
+            'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+        body = response.read()
+        self.assertEqual(
+            zlib.decompress(body, 16 + zlib.MAX_WBITS), b'object:' * 100)
+
+    def test_request_handler_conditional(self):
+        response = self.getresponse('/base/config.js')
+        self.assertEqual(response.status, 200)
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+        self.assertIsNotNone(last_modified)
+        response.read()
+
+        response = self.getresponse('/base/config.js', {
+            'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.read(), b'')
+
+        response = self.getresponse('/base/config.js', {
+            'If-None-Match': '"other"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'config:config.js')
+
+
+class RenderRequestHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        base_setup(self)
+        setup_generated_mold_registry(self, core=True)
+        self.provider = DummyProvider('/base', renderer=True)
+        handler = NunjaHTTPRequestHandlerFactory(
+            self.provider, nunja_prefix='/base')
+        self.server = HTTPServer(('localhost', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.host, self.port = self.server.socket.getsockname()
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.server_close()
+        self.server.shutdown()
+
+    def getresponse(self, url, method='GET', body=None):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request(method, url, body=body)
+        return conn.getresponse()
+
+    def test_render(self):
+        response = self.getresponse(
+            '/base/_render/nunja_generated0.mold/m0', 'POST',
+            json.dumps({'cls': 'c', 'value': 'hello'}))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.getheader('Content-Type'), 'text/html; charset=utf-8')
+        self.assertIn(b'<div class="c">hello</div>', response.read())
+
+        response = self.getresponse('/base/_render/nunja_generated0.mold/m0')
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'<div class=""></div>', response.read())
+
+    def test_render_errors(self):
+        self.assertEqual(self.getresponse(
+            '/base/_render/nunja_generated0.mold/none').status, 404)
+        self.assertEqual(self.getresponse(
+            '/base/_render/nunja_generated0.mold/m0', 'POST',
+            'invalid').status, 400)
+
+    def test_stream(self):
+        response = self.getresponse(
+            '/base/_stream/nunja_generated0.mold/m0', 'POST',
+            json.dumps({'cls': 'c', 'value': 'hello'}))
+        self.assertEqual(response.status, 200)
+        # HTTP/1.0, so the end is marked by the closing of connection.
+        self.assertIsNone(response.getheader('Transfer-Encoding'))
+        self.assertIsNone(response.getheader('Content-Length'))
+        self.assertIn(b'<div class="c">hello</div>', response.read())
+        self.assertEqual(self.getresponse(
+            '/base/_stream/nunja_generated0.mold/none').status, 404)
+
+    def test_stream_chunked(self):
+        self.server.RequestHandlerClass.protocol_version = 'HTTP/1.1'
+        conn = HTTPConnection(self.host, self.port)
+        for value in ('first', 'second'):
+            conn.request(
+                'POST', '/base/_stream/nunja_generated0.mold/m0',
+                body=json.dumps({'value': value}))
+            response = conn.getresponse()
+            self.assertEqual(
+                response.getheader('Transfer-Encoding'), 'chunked')
+            self.assertIn(value.encode('utf8'), response.read())
+        conn.close()
+
+    def test_stream_head(self):
+        response = self.getresponse(
+            '/base/_stream/nunja_generated0.mold/m0', 'HEAD')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'')
+
+
+class InProcessRequestHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        base_setup(self)
+        self.provider = DummyProvider('/base')
+        handler = NunjaHTTPRequestHandlerFactory(
+            self.provider, nunja_prefix='/base', scripts=ScriptRunner())
+        self.server = HTTPServer(('localhost', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.host, self.port = self.server.socket.getsockname()
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.server_close()
+        self.server.shutdown()
+
+    def getresponse(self, url, headers={}, method='GET', body=None):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request(method, url, body=body, headers=headers)
+        return conn.getresponse()
+
+    def test_script(self):
+        response = self.getresponse('/script.py?/hello')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), 'text/html')
+        self.assertEqual(response.read().strip(), b'Hello World')
+        # still served by the provider.
+        self.assertEqual(
+            self.getresponse('/base/an_object').read(), b'object:an_object')
+
+    def test_script_http_accept(self):
+        self.assertEqual(self.getresponse('/header.py', {
+            'Accept': 'application/json',
+        }).read().strip(), b'application/json')
+        self.assertNotIn('HTTP_ACCEPT', os.environ)
+
+    def test_script_post(self):
+        with open('echo.py', 'w') as fd:
+            fd.write('import os, sys\n')
+            fd.write('print("Content-Type: text/plain")\n')
+            fd.write('print("")\n')
+            fd.write('print(os.environ["REQUEST_METHOD"])\n')
+            fd.write('print(os.environ["QUERY_STRING"])\n')
+            fd.write('print(sys.stdin.read())\n')
+        response = self.getresponse(
+            '/echo.py?q=1', method='POST', body=b'payload')
+        self.assertEqual(
+            response.read().split(), [b'POST', b'q=1', b'payload'])
+
+    def test_script_head(self):
+        response = self.getresponse('/script.py', method='HEAD')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'')
+
+
+class PathProvider(DummyProvider):
+
+    def fetch_path(self, identifier):
+        if identifier != 'file.txt':
+            raise KeyError('not found')
+        return os.path.join(os.getcwd(), identifier)
+
+
+class SendfileHandler(NunjaHTTPRequestHandler):
+
+    sent = []
+
+    def sendfile(self, source):
+        self.sent.append(source.name)
+        return NunjaHTTPRequestHandler.sendfile(self, source)
+
+
+class SendfileRequestHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        base_setup(self)
+        SendfileHandler.sent = []
+        self.provider = PathProvider('/base', core_subpaths=('config.js',))
+        handler = NunjaHTTPRequestHandlerFactory(
+            self.provider, nunja_prefix='/base', handler_cls=SendfileHandler)
+        self.server = HTTPServer(('localhost', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.host, self.port = self.server.socket.getsockname()
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.server_close()
+        self.server.shutdown()
+
+    def getresponse(self, url, headers={}):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', url, headers=headers)
+        return conn.getresponse()
+
+    def test_file_backed(self):
+        response = self.getresponse('/base/file.txt')
+        self.assertEqual(response.getheader('Content-Length'), '5')
+        self.assertEqual(response.read(), b'hello')
+        self.assertEqual(SendfileHandler.sent, [
+            os.path.join(os.getcwd(), 'file.txt')])
+
+    def test_file_backed_modified(self):
+        original = simple.respond_nunja
+
+        # modified after the body and validators were produced.
+        def respond_nunja(provider, path, headers, body):
+            response = original(provider, path, headers, body)
+            with open(response.path, 'w') as fd:
+                fd.write('goodbye')
+            return response
+
+        stub_item_attr_value(self, simple, 'respond_nunja', respond_nunja)
+        response = self.getresponse('/base/file.txt')
+        self.assertEqual(response.getheader('Content-Length'), '5')
+        self.assertEqual(response.read(), b'hello')
+        self.assertEqual(SendfileHandler.sent, [])
+
+    def test_static_file(self):
+        response = self.getresponse('/file.txt')
+        self.assertEqual(response.getheader('Content-Length'), '5')
+        self.assertEqual(response.read(), b'hello')
+        self.assertEqual(SendfileHandler.sent, [
+            os.path.join(os.getcwd(), 'file.txt')])
+
+    def test_core_in_memory(self):
+        response = self.getresponse('/base/config.js')
+        self.assertEqual(response.read(), b'config:config.js')
+        self.assertEqual(SendfileHandler.sent, [])
+
+    def test_not_found(self):
+        response = self.getresponse('/base/missing')
+        self.assertEqual(response.status, 404)
+        self.assertEqual(response.read(), b'404 NOT FOUND')
+        self.assertEqual(SendfileHandler.sent, [])
+
+    def test_head(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('HEAD', '/base/file.txt')
+        response = conn.getresponse()
+        self.assertEqual(response.getheader('Content-Length'), '5')
+        self.assertEqual(response.read(), b'')
+        self.assertEqual(SendfileHandler.sent, [])
+
+
+class ThreadPoolRequestHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        base_setup(self)
+        self.provider = DummyProvider('/base', core_subpaths=('config.js',))
+        handler = NunjaHTTPRequestHandlerFactory(
+            self.provider, nunja_prefix='/base', protocol_version='HTTP/1.1')
+        self.server = ThreadPoolHTTPServer(('localhost', 0), handler, 2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.host, self.port = self.server.socket.getsockname()
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def getresponse(self, url, headers={}):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', url, headers=headers)
+        return conn.getresponse()
+
+    def test_workers(self):
+        self.assertEqual(self.server.workers, 2)
+        self.assertEqual(len(self.server._workers), 2)
+
+    def test_persistent_connection(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', '/base/config.js')
+        response = conn.getresponse()
+        self.assertEqual(response.version, 11)
+        self.assertEqual(response.read(), b'config:config.js')
+        sock = conn.sock
+        conn.request('GET', '/file.txt')
+        self.assertEqual(conn.getresponse().read(), b'hello')
+        conn.request('GET', '/base/notfound')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+        response.read()
+        # the same socket was used throughout.
+        self.assertIs(conn.sock, sock)
+        conn.close()
+
+    def test_non_ascii_content_length(self):
+        self.provider.fetch_object = lambda identifier: u'\u2603'
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', '/base/snowman')
+        response = conn.getresponse()
+        self.assertEqual(response.getheader('Content-Length'), '3')
+        self.assertEqual(response.read().decode('utf8'), u'\u2603')
+        conn.request('GET', '/base/config.js')
+        self.assertEqual(conn.getresponse().read(), b'config:config.js')
+        conn.close()
+
+    def test_events(self):
+        # served by the provider without a watcher.
+        self.assertEqual(
+            self.getresponse('/base/_events').read(), b'object:_events')
+
+        class FakeWatcher(object):
+            queue = Queue()
+
+            def subscribe(self):
+                return self.queue
+
+            def unsubscribe(self, queue):
+                pass
+
+        self.provider.watcher = FakeWatcher()
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('HEAD', '/base/_events')
+        response = conn.getresponse()
+        self.assertEqual(
+            response.getheader('Content-Type'), 'text/event-stream')
+        self.assertEqual(response.read(), b'')
+        conn.close()
+
+        FakeWatcher.queue.put({'identifiers': ['a'], 'modules': []})
+        FakeWatcher.queue.put(None)
+        response = self.getresponse('/base/_events')
+        self.assertEqual(response.read(), (
+            b'retry: 1000\n\n'
+            b'data: {"identifiers": ["a"], "modules": []}\n\n'
+        ))
+
+    def test_events_not_holding_workers(self):
+        queues = []
+
+        class FakeWatcher(object):
+            def subscribe(self):
+                queues.append(Queue())
+                return queues[-1]
+
+            def unsubscribe(self, queue):
+                pass
+
+        self.provider.watcher = FakeWatcher()
+        streams = []
+        # more streams than there are workers.
+        for i in range(self.server.workers + 1):
+            conn = HTTPConnection(self.host, self.port, timeout=2)
+            conn.request('GET', '/base/_events')
+            response = conn.getresponse()
+            self.assertEqual(response.read(13), b'retry: 1000\n\n')
+            streams.append((conn, response))
+        conn = HTTPConnection(self.host, self.port, timeout=2)
+        conn.request('GET', '/base/config.js')
+        self.assertEqual(conn.getresponse().read(), b'config:config.js')
+        conn.close()
+
+        for queue in queues:
+            queue.put({'identifiers': ['a'], 'modules': []})
+            queue.put(None)
+        for conn, response in streams:
+            self.assertEqual(response.read(), (
+                b'data: {"identifiers": ["a"], "modules": []}\n\n'))
+            conn.close()
+        self.assertEqual(self.server._detached, set())
+
+    def test_concurrent_connections(self):
+        # an idle persistent connection must not block others.
+        idle = HTTPConnection(self.host, self.port)
+        idle.request('GET', '/base/config.js')
+        idle.getresponse().read()
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', '/base/config.js')
+        self.assertEqual(conn.getresponse().read(), b'config:config.js')
+        conn.close()
+        idle.close()
+
+    def test_idle_connections_released(self):
+        # more idle persistent connections than there are workers.
+        idle = []
+        for i in range(self.server.workers):
+            conn = HTTPConnection(self.host, self.port)
+            conn.request('GET', '/base/config.js')
+            self.assertEqual(conn.getresponse().read(), b'config:config.js')
+            idle.append(conn)
+        conn = HTTPConnection(self.host, self.port, timeout=2)
+        start = time.time()
+        conn.request('GET', '/base/config.js')
+        self.assertEqual(conn.getresponse().read(), b'config:config.js')
+        self.assertLess(time.time() - start, 1)
+        conn.close()
+        for conn in idle:
+            conn.close()
+
+    def test_pipelined_requests(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.connect()
+        conn.sock.sendall(
+            b'GET /base/config.js HTTP/1.1\r\nHost: localhost\r\n\r\n'
+            b'GET /base/a.js HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        received = b''
+        while b'object:a.js' not in received:
+            chunk = conn.sock.recv(4096)
+            if not chunk:
+                break
+            received += chunk
+        self.assertIn(b'config:config.js', received)
+        self.assertIn(b'object:a.js', received)
+        conn.close()
+
 
 class NeuteredServer(HTTPServer):
 
@@ -199,6 +687,145 @@ class ServeNunjaTestCase(unittest.TestCase):
         self.assertEqual(values['port'], 8000)
         self.assertEqual(values['bind'], '127.0.0.1')
         self.assertEqual(values['provider_cls'], DummyProvider)
+        self.assertEqual(values['threads'], 0)
+
+    def test_main_threads(self):
+        stub_item_attr_value(self, sys, 'argv', ['script', '--threads', '4'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertEqual(values['threads'], 4)
+
+    def test_main_metrics(self):
+        stub_item_attr_value(self, sys, 'argv', ['script', '--metrics'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertTrue(values['metrics'])
+
+    def test_main_watch(self):
+        stub_item_attr_value(self, sys, 'argv', ['script', '--watch'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertTrue(values['watch'])
+
+    def test_main_in_process(self):
+        stub_item_attr_value(self, sys, 'argv', ['script', '--in-process'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertTrue(values['in_process'])
+
+    def test_main_render(self):
+        stub_item_attr_value(self, sys, 'argv', ['script', '--render'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertTrue(values['render'])
+        self.assertEqual(values['render_processes'], 0)
+        self.assertFalse(values['render_cache'])
+
+    def test_main_render_processes(self):
+        stub_item_attr_value(
+            self, sys, 'argv', ['script', '--render-processes', '2'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertEqual(values['render_processes'], 2)
+
+    def test_main_render_cache(self):
+        stub_item_attr_value(
+            self, sys, 'argv', ['script', '--render', '--render-cache'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertTrue(values['render_cache'])
+
+    def test_main_asyncio(self):
+        stub_item_attr_value(self, sys, 'argv', ['script', '--asyncio'])
+        values = {}
+
+        def fake_serve_nunja(**kw):
+            values.update(kw)
+
+        stub_item_attr_value(self, simple, 'serve_nunja', fake_serve_nunja)
+        main(DummyProvider)
+        self.assertTrue(values['aio'])
+
+    def test_main_asyncio_watch(self):
+        stub_stdouts(self)
+        stub_item_attr_value(
+            self, sys, 'argv', ['script', '--asyncio', '--watch'])
+        with self.assertRaises(SystemExit):
+            main(DummyProvider)
+        self.assertIn('--asyncio', sys.stderr.getvalue())
+
+    def test_server_flow_render_processes(self):
+        base_setup(self)
+        setup_generated_mold_registry(self, core=True)
+        renderers = []
+
+        class FakePoolRenderer(object):
+            def __init__(self, registry_name, processes):
+                self.args = registry_name, processes
+                self.closed = False
+                renderers.append(self)
+
+            def close(self):
+                self.closed = True
+
+        stub_item_attr_value(
+            self, simple, 'ProcessPoolRenderer', FakePoolRenderer)
+        with self.assertRaises(SystemExit):
+            serve_nunja(
+                DummyProvider, server_factory=NeuteredServer, port=0,
+                render_processes=2)
+        renderer, = renderers
+        self.assertEqual(renderer.args, ('nunja.mold', 2))
+        self.assertTrue(renderer.closed)
+
+    def test_server_flow_threads(self):
+        base_setup(self)
+
+        class NeuteredThreadPoolServer(ThreadPoolHTTPServer):
+            def serve_forever(self):
+                raise KeyboardInterrupt
+
+        stub_item_attr_value(
+            self, simple, 'ThreadPoolHTTPServer', NeuteredThreadPoolServer)
+        with self.assertRaises(SystemExit):
+            serve_nunja(DummyProvider, port=0, threads=2)
+        stdout = sys.stdout.getvalue()
+        self.assertIn('Serving HTTP on', stdout)
 
     # This test can't be stopped...
     # def test_server_flow_handling(self):
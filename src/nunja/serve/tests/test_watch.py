@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+import os
+
+from nunja.serve import watch
+from nunja.serve.cache import Content
+from nunja.serve.compat import Queue
+from nunja.serve.rjs import Provider
+from nunja.serve.watch import EventsForwarder
+from nunja.serve.watch import InotifyWatcher
+from nunja.serve.watch import PollingWatcher
+from nunja.serve.watch import iter_events
+from nunja.serve.watch import make_watcher
+
+from nunja.serve.testing import setup_generated_mold_registry
+from nunja.serve.testing import write_file
+
+script = 'nunja.mold/nunja_generated0.mold/m1/index.js'
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_generated_mold_registry(self, packages=1, molds=2)
+        self.provider = Provider('/nunja/')
+        self.path = self.provider.index[script]
+
+    def test_reindex(self):
+        watcher = PollingWatcher(self.provider)
+        self.assertEqual(watcher.identifiers[self.path], [script])
+        self.assertEqual(
+            watcher.modules[self.path], ['nunja_generated0.mold/m1/index'])
+        self.assertEqual(
+            watcher.molds[self.path], 'nunja_generated0.mold/m1')
+
+    def test_changed(self):
+        watcher = PollingWatcher(self.provider)
+        queue = watcher.subscribe()
+        self.provider.fetch_content(script)
+        self.provider.fetch_bundle('nunja_generated0.mold/m1')
+        self.assertIn(self.path, self.provider.cache)
+
+        self.assertIsNone(watcher.changed(['/no/such/path']))
+        event = watcher.changed([self.path])
+        self.assertEqual(event, {
+            'identifiers': [script],
+            'modules': ['nunja_generated0.mold/m1/index'],
+        })
+        self.assertIs(queue.get_nowait(), event)
+        self.assertNotIn(self.path, self.provider.cache)
+        self.assertNotIn('nunja_generated0.mold/m1', self.provider.bundles)
+
+        watcher.unsubscribe(queue)
+        watcher.changed([self.path])
+        self.assertTrue(queue.empty())
+
+    def test_changed_render_cache(self):
+        provider = Provider('/nunja/', render_cache=True)
+        watcher = PollingWatcher(provider)
+        provider.render_cache.get(
+            ('nunja_generated0.mold/m1', (), ''), lambda: Content(b'm1'))
+        provider.render_cache.get(
+            ('nunja_generated0.mold/m0', (), ''), lambda: Content(b'm0'))
+        watcher.changed([self.path])
+        self.assertEqual(len(provider.render_cache), 1)
+        self.assertIn(
+            ('nunja_generated0.mold/m0', (), ''), provider.render_cache)
+
+    def test_changed_fingerprint(self):
+        provider = Provider('/nunja/', fingerprint=True)
+        watcher = PollingWatcher(provider)
+        config = provider.fetch_core('config.js')
+        write_file(self.path, 'define([], function() {});', 1000)
+        event = watcher.changed([self.path])
+        self.assertEqual(
+            event['identifiers'], ['config.js', 'init.js', script])
+        self.assertNotEqual(provider.fetch_core('config.js'), config)
+
+    def test_poll(self):
+        watcher = PollingWatcher(self.provider)
+        self.assertIsNone(watcher.poll())
+        write_file(self.path, 'define([], function() {});', 1000)
+        self.assertEqual(watcher.poll()['identifiers'], [script])
+        self.assertIsNone(watcher.poll())
+        os.remove(self.path)
+        self.assertEqual(watcher.poll()['identifiers'], [script])
+
+    def test_polling_start_stop(self):
+        watcher = PollingWatcher(self.provider, interval=0.01)
+        queue = watcher.subscribe()
+        watcher.start()
+        write_file(self.path, 'define([], function() {});', 1000)
+        self.assertEqual(queue.get(timeout=5)['identifiers'], [script])
+        watcher.stop()
+        self.assertIsNone(queue.get(timeout=5))
+        self.assertIsNone(watcher.thread)
+
+    @unittest.skipIf(watch.libc is None, 'inotify not available')
+    def test_inotify(self):
+        watcher = InotifyWatcher(self.provider, interval=0.01)
+        queue = watcher.subscribe()
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        write_file(self.path, 'define([], function() {});', 1000)
+        self.assertEqual(queue.get(timeout=5)['identifiers'], [script])
+
+    def test_make_watcher(self):
+        watcher = make_watcher(self.provider, inotify=False)
+        self.assertTrue(isinstance(watcher, PollingWatcher))
+        watcher = make_watcher(self.provider, interval=0.5)
+        self.addCleanup(watcher.stop)
+        self.assertEqual(watcher.interval, 0.5)
+        if watch.libc is not None:
+            self.assertTrue(isinstance(watcher, InotifyWatcher))
+
+    def test_provider_watch(self):
+        provider = Provider('/nunja/', watch={'inotify': False})
+        self.addCleanup(provider.watcher.stop)
+        self.assertTrue(isinstance(provider.watcher, PollingWatcher))
+        self.assertIsNotNone(provider.watcher.thread)
+        self.assertIn(
+            'new EventSource("/nunja/_events")',
+            provider.fetch_core('init.js'))
+        self.assertIsNone(self.provider.watcher)
+        self.assertNotIn('EventSource', self.provider.fetch_core('init.js'))
+
+
+class IterEventsTestCase(unittest.TestCase):
+
+    def test_iter_events(self):
+        class FakeWatcher(object):
+            def __init__(self):
+                self.queue = Queue()
+                self.subscribed = True
+
+            def subscribe(self):
+                return self.queue
+
+            def unsubscribe(self, queue):
+                self.subscribed = False
+
+        watcher = FakeWatcher()
+        watcher.queue.put({'identifiers': ['a'], 'modules': ['b']})
+        watcher.queue.put(None)
+        events = iter_events(watcher, keepalive=0.01)
+        self.assertEqual(next(events), b'retry: 1000\n\n')
+        chunk = next(events)
+        self.assertTrue(chunk.startswith(b'data: '))
+        self.assertTrue(chunk.endswith(b'\n\n'))
+        self.assertEqual(json.loads(chunk[6:].decode('utf8')), {
+            'identifiers': ['a'], 'modules': ['b']})
+        self.assertEqual(list(events), [])
+        self.assertFalse(watcher.subscribed)
+
+        watcher = FakeWatcher()
+        events = iter_events(watcher, keepalive=0.01)
+        next(events)
+        self.assertEqual(next(events), b': keepalive\n\n')
+        events.close()
+        self.assertFalse(watcher.subscribed)
+
+    def test_events_forwarder(self):
+        class FakeWatcher(object):
+            def __init__(self):
+                self.queue = Queue()
+                self.subscribed = True
+
+            def subscribe(self):
+                return self.queue
+
+            def unsubscribe(self, queue):
+                self.subscribed = False
+
+        watcher = FakeWatcher()
+        watcher.queue.put({'identifiers': ['a'], 'modules': []})
+        watcher.queue.put(None)
+        chunks = []
+        forwarder = EventsForwarder(watcher, chunks.append, keepalive=0.01)
+        forwarder.start()
+        forwarder.join()
+        self.assertEqual(chunks, [
+            b'retry: 1000\n\n',
+            b'data: {"identifiers": ["a"], "modules": []}\n\n',
+            None,
+        ])
+        self.assertFalse(watcher.subscribed)
+
+        watcher = FakeWatcher()
+        chunks = Queue()
+        forwarder = EventsForwarder(watcher, chunks.put, keepalive=0.01)
+        forwarder.start()
+        self.assertEqual(chunks.get(timeout=1), b'retry: 1000\n\n')
+        forwarder.stop()
+        forwarder.join(1)
+        self.assertFalse(forwarder.is_alive())
+        self.assertFalse(watcher.subscribed)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import unittest
+import json
+from io import BytesIO
+from wsgiref.util import FileWrapper
+from wsgiref.util import setup_testing_defaults
+
+from calmjs.testing.utils import stub_item_attr_value
+
+from nunja.serve import wsgi
+from nunja.serve.compat import Queue
+from nunja.serve.wsgi import Application
+from nunja.serve.wsgi import RJSProvider
+from nunja.serve.wsgi import request_headers
+from nunja.serve.testing import DummyProvider
+from nunja.serve.testing import setup_generated_mold_registry
+
+script = 'nunja.mold/nunja_generated0.mold/m0/index.js'
+
+
+def call(application, path, method='GET', body=None, **environ):
+    environ['REQUEST_METHOD'] = method
+    environ['PATH_INFO'], _, environ['QUERY_STRING'] = path.partition('?')
+    if body is not None:
+        environ['CONTENT_LENGTH'] = str(len(body))
+        environ['wsgi.input'] = BytesIO(body)
+    environ.setdefault('wsgi.file_wrapper', FileWrapper)
+    setup_testing_defaults(environ)
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started.append((status, dict(headers)))
+
+    result = application(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    status, headers = started[0]
+    return status, headers, body, result
+
+
+class FakeWatcher(object):
+
+    def __init__(self):
+        self.queue = Queue()
+
+    def subscribe(self):
+        return self.queue
+
+    def unsubscribe(self, queue):
+        pass
+
+
+class SupportTestCase(unittest.TestCase):
+
+    def test_request_headers(self):
+        self.assertEqual(request_headers({
+            'HTTP_IF_NONE_MATCH': '"abc"',
+            'HTTP_ACCEPT_ENCODING': 'gzip',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': '',
+            'PATH_INFO': '/',
+        }), {
+            'If-None-Match': '"abc"',
+            'Accept-Encoding': 'gzip',
+            'Content-Type': 'application/json',
+        })
+
+
+class ApplicationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = DummyProvider(
+            '/nunja/', core_subpaths=('config.js',), renderer=True)
+        self.application = Application(self.provider)
+
+    def test_object(self):
+        status, headers, body, _ = call(
+            self.application, '/nunja/some/object.js')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b'object:some/object.js')
+        self.assertEqual(headers['Content-Length'], '21')
+
+        status, headers, body, _ = call(
+            self.application, '/nunja/some/object.js',
+            HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(body, b'')
+
+    def test_head(self):
+        status, headers, body, _ = call(
+            self.application, '/nunja/some/object.js', method='HEAD')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Length'], '21')
+        self.assertEqual(body, b'')
+
+    def test_not_found(self):
+        status, headers, body, _ = call(
+            self.application, '/nunja/notfound.js')
+        self.assertEqual(status, '404 Not Found')
+        status, headers, body, _ = call(self.application, '/elsewhere')
+        self.assertEqual(status, '404 Not Found')
+        self.assertEqual(body, b'404 NOT FOUND')
+
+    def test_method_not_allowed(self):
+        status, headers, body, _ = call(
+            self.application, '/nunja/some/object.js', method='DELETE')
+        self.assertEqual(status, '405 Method Not Allowed')
+        self.assertEqual(headers['Allow'], 'GET, HEAD, POST')
+
+    def test_batch(self):
+        status, headers, body, _ = call(
+            self.application, '/nunja/_batch', method='POST',
+            body=b'["a.js"]')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body.decode('utf8')), {
+            'a.js': {'content': 'object:a.js'}})
+
+        status, headers, body, _ = call(
+            self.application, '/nunja/_batch?id=b.js')
+        self.assertEqual(json.loads(body.decode('utf8')), {
+            'b.js': {'content': 'object:b.js'}})
+
+        # objects do not take a body.
+        status, headers, body, _ = call(
+            self.application, '/nunja/a.js', method='POST', body=b'{}')
+        self.assertEqual(status, '404 Not Found')
+
+    def test_stream(self):
+        def stream(mold_id, data, wrapper_tag='div'):
+            return iter([b'<div>', b'</div>'])
+
+        self.provider.renderer.stream = stream
+        status, headers, body, result = call(
+            self.application, '/nunja/_stream/pkg.mold/x', method='POST',
+            body=b'{}')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b'<div></div>')
+        self.assertNotIn('Content-Length', headers)
+
+    def test_events(self):
+        self.provider.watcher = FakeWatcher()
+        self.provider.watcher.queue.put(None)
+        status, headers, body, _ = call(self.application, '/nunja/_events')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/event-stream')
+        self.assertEqual(body, b'retry: 1000\n\n')
+
+    def test_fallback_app(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'app:' + environ['PATH_INFO'].encode('utf8')]
+
+        application = Application(self.provider, app)
+        status, headers, body, _ = call(application, '/elsewhere')
+        self.assertEqual(body, b'app:/elsewhere')
+        status, headers, body, _ = call(application, '/nunja/a.js')
+        self.assertEqual(body, b'object:a.js')
+
+
+class RJSProviderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setup_generated_mold_registry(self)
+
+    def test_file_wrapper(self):
+        application = RJSProvider('/nunja/')()
+        self.assertTrue(isinstance(application, Application))
+        status, headers, body, result = call(
+            application, '/nunja/' + script)
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(isinstance(result, FileWrapper))
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertIn(b'define(', body)
+
+    def test_file_wrapper_modified(self):
+        respond_nunja = wsgi.respond_nunja
+
+        # modified after the body and validators were produced.
+        def respond_modified(provider, path, headers, body):
+            response = respond_nunja(provider, path, headers, body)
+            with open(response.path, 'w') as fd:
+                fd.write('modified')
+            return response
+
+        stub_item_attr_value(self, wsgi, 'respond_nunja', respond_modified)
+        application = RJSProvider('/nunja/')()
+        status, headers, body, result = call(
+            application, '/nunja/' + script)
+        self.assertEqual(result, [body])
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertIn(b'define(', body)
+
+    def test_no_file_wrapper(self):
+        application = RJSProvider('/nunja/')()
+        status, headers, body, result = call(
+            application, '/nunja/' + script, **{'wsgi.file_wrapper': None})
+        self.assertEqual(result, [body])
+        self.assertIn(b'define(', body)
+
+    def test_in_memory(self):
+        application = RJSProvider('/nunja/', encodings=('gzip',))()
+        status, headers, body, result = call(
+            application, '/nunja/config.js', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(result, [body])
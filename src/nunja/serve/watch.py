@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Watchers for the files provided by the molds, such that changes can be
+picked up by the provider and pushed to the browsers as server-sent
+events during development.
+
+Inotify is used where available, otherwise the files in the index of
+the provider are polled.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import sys
+from os.path import dirname
+from os.path import join
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+from nunja.serve.cache import stat_key
+from nunja.serve.compat import Empty
+from nunja.serve.compat import Queue
+
+logger = logging.getLogger(__name__)
+
+# the subpath for the event stream of the changes.
+EVENTS_SUBPATH = '_events'
+
+# the headers for the event stream.
+EVENTS_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+}
+
+# the seconds between the keepalive comments sent for idle streams.
+EVENTS_KEEPALIVE = 15
+
+# the script to be appended to the init script, such that the modules
+# that were changed are required again.
+live_reload_script = """
+if (typeof EventSource !== 'undefined') {
+    new EventSource(%s).onmessage = function(e) {
+        var modules = JSON.parse(e.data).modules;
+        for (var i = 0; i < modules.length; i++) {
+            requirejs.undef(modules[i]);
+        }
+        require(modules, function() {});
+    };
+}
+"""
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE
+)
+_event_header = struct.Struct('iIII')
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+    return libc
+
+
+libc = _load_libc()
+
+
+def iter_events(watcher, keepalive=EVENTS_KEEPALIVE):
+    """
+    Yield the encoded server-sent events for the changes broadcasted by
+    the watcher, with comments sent in between every keepalive seconds
+    such that disconnected clients are noticed.  Ends when the watcher
+    is stopped.
+    """
+
+    queue = watcher.subscribe()
+    try:
+        yield b'retry: 1000\n\n'
+        while True:
+            try:
+                event = queue.get(timeout=keepalive)
+            except Empty:
+                yield b': keepalive\n\n'
+                continue
+            if event is None:
+                return
+            yield ('data: %s\n\n' % json.dumps(
+                event, sort_keys=True)).encode('utf8')
+    finally:
+        watcher.unsubscribe(queue)
+
+
+class EventsForwarder(Thread):
+    """
+    A thread of its own for a stream of events from the watcher, which
+    pass the chunks from iter_events to the callback as they come, and
+    then None once they end, such that the stream does not hold on to a
+    worker of a pool for serving the requests (e.g. the executor of an
+    asyncio loop) while waiting on the events.
+    """
+
+    def __init__(self, watcher, callback, keepalive=EVENTS_KEEPALIVE):
+        super(EventsForwarder, self).__init__()
+        self.daemon = True
+        self.watcher = watcher
+        self.callback = callback
+        self.keepalive = keepalive
+        self.stopped = Event()
+
+    def run(self):
+        events = iter_events(self.watcher, self.keepalive)
+        try:
+            for chunk in events:
+                if self.stopped.is_set():
+                    break
+                self.callback(chunk)
+        finally:
+            events.close()
+            self.callback(None)
+
+    def stop(self):
+        """
+        Stop forwarding, which will be done at the latest by the next
+        keepalive.
+        """
+
+        self.stopped.set()
+
+
+class Watcher(object):
+    """
+    The base watcher for a rjs.Provider; subclasses implement run to
+    find the changed paths and pass them to the changed method.
+    """
+
+    def __init__(self, provider, interval=1.0):
+        """
+        Arguments
+
+        provider
+            The rjs.Provider with the files to be watched.
+        interval
+            The seconds between the polls for changes, which is also
+            the upper bound for stopping the watcher.
+        """
+
+        self.provider = provider
+        self.interval = interval
+        self.lock = Lock()
+        self.subscribers = set()
+        self.stopping = Event()
+        self.thread = None
+        self.reindex()
+
+    def reindex(self):
+        """
+        Rebuild the mapping of the paths to the identifiers, the module
+        names and the molds from the indexes of the provider.
+        """
+
+        identifiers = {}
+        modules = {}
+        molds = {}
+        for identifier, path in self.provider.index.items():
+            identifiers.setdefault(path, []).append(identifier)
+        for mold_id, mapping in self.provider.bundle_index.items():
+            for name, path in mapping.items():
+                modules.setdefault(path, []).append(name)
+                molds[path] = mold_id
+        self.identifiers = identifiers
+        self.modules = modules
+        self.molds = molds
+
+    def subscribe(self):
+        """
+        Return a new Queue that will receive the broadcasted events.
+        """
+
+        queue = Queue()
+        with self.lock:
+            self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers.discard(queue)
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for queue in subscribers:
+            queue.put(event)
+
+    def changed(self, paths):
+        """
+        Invalidate the entries for the changed paths and broadcast the
+        affected identifiers and module names.  Return the event, or
+        None if no watched paths were changed.
+        """
+
+        paths = sorted(set(p for p in paths if p in self.identifiers))
+        if not paths:
+            return None
+
+        provider = self.provider
+        identifiers = set()
+        modules = set()
+        for path in paths:
+            if provider.cache is not None:
+                provider.cache.invalidate(path)
+            mold_id = self.molds.get(path)
+            provider.bundles.pop(mold_id, None)
+            if mold_id and provider.render_cache is not None:
+                provider.render_cache.invalidate(mold_id)
+            identifiers.update(self.identifiers[path])
+            modules.update(self.modules.get(path, ()))
+
+        if provider.fingerprint:
+            # the paths to the molds in the configuration have changed.
+            provider.refresh()
+            self.reindex()
+            identifiers.update(provider.core_names)
+
+        event = {
+            'identifiers': sorted(identifiers),
+            'modules': sorted(modules),
+        }
+        logger.debug('changed: %s', event['identifiers'])
+        self.publish(event)
+        return event
+
+    def run(self):
+        raise NotImplementedError
+
+    def start(self):
+        """
+        Start watching in a daemon thread.  Return self.
+        """
+
+        self.stopping.clear()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop watching, and end the event streams of the subscribers.
+        """
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.publish(None)
+
+
+class PollingWatcher(Watcher):
+    """
+    Stat every file in the index of the provider at every interval.
+    """
+
+    def reindex(self):
+        super(PollingWatcher, self).reindex()
+        self.keys = self.scan()
+
+    def scan(self):
+        keys = {}
+        for path in self.identifiers:
+            try:
+                keys[path] = stat_key(path)
+            except OSError:
+                keys[path] = None
+        return keys
+
+    def poll(self):
+        """
+        Find the paths changed since the last poll and pass them to the
+        changed method, returning its result.
+        """
+
+        keys = self.scan()
+        paths = [path for path, key in keys.items()
+                 if self.keys.get(path) != key]
+        self.keys = keys
+        return self.changed(paths)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:  # pragma: no cover
+                logger.exception('failed to poll for changes')
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watch the directories of the files in the index of the provider
+    with inotify.  Only available on Linux.
+    """
+
+    def __init__(self, provider, interval=1.0):
+        if libc is None:
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        super(InotifyWatcher, self).__init__(provider, interval)
+
+    def reindex(self):
+        super(InotifyWatcher, self).reindex()
+        watched = set(self.directories.values())
+        for directory in set(dirname(path) for path in self.identifiers):
+            if directory in watched:
+                continue
+            wd = libc.inotify_add_watch(
+                self.fd, directory.encode(sys.getfilesystemencoding()),
+                IN_MASK)
+            if wd < 0:
+                logger.warning(
+                    "failed to watch '%s': errno %d", directory,
+                    ctypes.get_errno())
+                continue
+            self.directories[wd] = directory
+
+    def read(self):
+        """
+        Return the paths from the pending events.
+        """
+
+        paths = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError:
+                # EAGAIN, as there are no more events.
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event_header.unpack_from(
+                    data, offset)
+                offset += _event_header.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                directory = self.directories.get(wd)
+                if directory is not None and name:
+                    paths.add(join(directory, name.decode(
+                        sys.getfilesystemencoding())))
+        return paths
+
+    def run(self):
+        while not self.stopping.is_set():
+            ready = select.select([self.fd], [], [], self.interval)[0]
+            if not ready:
+                continue
+            try:
+                self.changed(self.read())
+            except Exception:  # pragma: no cover
+                logger.exception('failed to process changes')
+
+    def stop(self):
+        super(InotifyWatcher, self).stop()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def make_watcher(provider, interval=1.0, inotify=True):
+    """
+    Return a watcher for the provider, using inotify if requested and
+    available, otherwise by polling.
+    """
+
+    if inotify and libc is not None:
+        try:
+            return InotifyWatcher(provider, interval)
+        except OSError as e:
+            logger.warning('falling back to polling: %s', e)
+    return PollingWatcher(provider, interval)
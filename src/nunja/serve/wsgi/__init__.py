@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+This provide a bare WSGI application for serving a provider, such that
+it may be deployed under any WSGI server (e.g. gunicorn with a number of
+worker processes) without the routing of a framework.
+
+Example usage:
+
+>>> from nunja.serve import wsgi
+>>> application = wsgi.RJSProvider('/nunja/')()
+
+Requests outside of the base_url of the provider may be passed on to
+another WSGI application:
+
+>>> application = wsgi.RJSProvider('/nunja/')(other_application)
+"""
+
+from nunja.serve import rjs
+from nunja.serve.base import not_found
+from nunja.serve.base import open_body_file
+from nunja.serve.base import respond_nunja
+from nunja.serve.base import to_bytes
+from nunja.serve.compat import responses
+from nunja.serve.watch import EVENTS_HEADERS
+from nunja.serve.watch import EVENTS_SUBPATH
+from nunja.serve.watch import iter_events
+
+# the size of the blocks for the wsgi.file_wrapper.
+BLOCK_SIZE = 65536
+
+
+def status_line(status):
+    return '%d %s' % (status, responses.get(status, ''))
+
+
+def request_headers(environ):
+    """
+    Return the dict of the request headers from the environ, with the
+    names in the same form as they would have been sent.
+    """
+
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers[key[5:].replace('_', '-').title()] = value
+    for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if environ.get(key):
+            headers[key.replace('_', '-').title()] = environ[key]
+    return headers
+
+
+def request_body(environ):
+    """
+    Return the body of the request, which is None for the methods that
+    do not have one.
+    """
+
+    if environ['REQUEST_METHOD'] != 'POST':
+        return None
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    return environ['wsgi.input'].read(length) if length > 0 else b''
+
+
+class Application(object):
+    """
+    The WSGI application for the provider.
+    """
+
+    def __init__(self, provider, app=None):
+        """
+        Arguments
+
+        provider
+            The provider to serve.
+        app
+            The WSGI application for the requests outside of the
+            base_url of the provider; if not provided, they will be
+            answered with a 404.
+        """
+
+        self.provider = provider
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        identifier = self.provider.to_identifier(path)
+        if identifier is None and self.app is not None:
+            return self.app(environ, start_response)
+
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD', 'POST'):
+            start_response(status_line(405), [
+                ('Allow', 'GET, HEAD, POST'), ('Content-Length', '0')])
+            return []
+
+        watcher = getattr(self.provider, 'watcher', None)
+        if watcher is not None and identifier == EVENTS_SUBPATH:
+            start_response(status_line(200), sorted(EVENTS_HEADERS.items()))
+            return [] if method == 'HEAD' else iter_events(watcher)
+
+        if identifier is None:
+            response = not_found()
+        else:
+            query = environ.get('QUERY_STRING')
+            response = respond_nunja(
+                self.provider, path + ('?' + query if query else ''),
+                request_headers(environ), request_body(environ))
+        return self.send(environ, start_response, response)
+
+    def send(self, environ, start_response, response):
+        """
+        Start the response, and return the iterable for its body.
+        """
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            close = getattr(response.chunks, 'close', None)
+            if close is not None:
+                close()
+            body = []
+        elif response.chunks is not None:
+            # the server will close the chunks once they are sent.
+            body = response.chunks
+        else:
+            # the file is only sent while it is still the one that the
+            # validators were produced from.
+            source = None
+            if file_wrapper is not None:
+                source = open_body_file(response)
+            if source is not None:
+                body = file_wrapper(source, BLOCK_SIZE)
+            else:
+                body = [to_bytes(response.body)]
+
+        start_response(
+            status_line(response.status), sorted(response.headers.items()))
+        return body
+
+
+class WSGIMixin(object):
+    """
+    The base mixin for combining with a provider implementation.
+    """
+
+    def __call__(self, app=None):
+        return Application(self, app)
+
+
+class RJSProvider(WSGIMixin, rjs.Provider):
+    """
+    Using the RJS version for serving base library stuff.
+
+    Example usage:
+
+    >>> from wsgiref.simple_server import make_server
+    >>> from nunja.serve import wsgi
+    >>> application = wsgi.RJSProvider('/nunja/')()
+    >>> make_server('', 9000, application).serve_forever()
+    """